@@ -0,0 +1,130 @@
+'''
+Deterministic synthetic 1-minute data to measure and regression-test the speed of steps 1-4 without the real data.
+Writes <folder>/<ticker>_1_min_data.csv in the schema of the raw files (timestamp in UTC, open, high, low, close, volume,
+vwap) with pre-market and after-hours bars, missing minutes, missing days and the sessions, holidays and half days (session
+closes at 13:00) of the trading calendar of step 1.
+Some days open with a run of bullish/bearish candles and a volume spike, so the screen of step 2 and the long/short
+decision of step 3 have something to pick. Every ticker has its own random stream (seed, ticker number), so a ticker's
+bars don't depend on how many tickers are generated
+
+Run it from the main folder: python benchmarks/generate_synthetic_data.py --tickers 100 --days 60
+'''
+
+import os
+import sys
+import argparse
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.csv as pa_csv # type: ignore
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'step-1-process_historical_data'))
+from trading_calendar import get_calendar, HALF_DAY_CLOSE_MINUTE, FULL_DAY_END_MINUTE, HALF_DAY_END_MINUTE, MINUTE_NS # type: ignore
+
+RAW_DATA_FOLDER = './historical_data_new'
+START_DATE = '2022-11-01' #the screen of step 2 starts on 2022-11-30, the days before it fill the 14-day indicator windows
+NUM_TICKERS = 50
+NUM_DAYS = 60 #trading sessions of the calendar
+SEED = 0
+GAP_PROBABILITY = 0.01 #probability of a missing minute bar
+MISSING_DAY_PROBABILITY = 0.005 #probability that a ticker has no bars at all on a day
+PRE_MARKET_MINUTES = 30 #bars before 09:30 (dropped by step 1)
+AFTER_HOURS_MINUTES = 30 #bars after the close
+OPENING_TREND_PROBABILITY = 0.3 #days whose first 6 candles all go the same way
+HIGH_VOLUME_DAY_PROBABILITY = 0.2 #days with 3x to 10x the usual volume
+
+#trading sessions: (date, close minute) of the first num_days sessions of the calendar from start_date
+def trading_sessions(start_date=START_DATE, num_days=NUM_DAYS):
+    calendar = get_calendar()
+    first = calendar.day_number(start_date)
+    days = first + np.flatnonzero(calendar.is_session[first:])[:num_days]
+    return [(calendar.dates[day], int(calendar.close_minute[day])) for day in days]
+
+#bars of one ticker for all the sessions, as a DataFrame in the raw file schema
+def generate_ticker(ticker_number, sessions, seed=SEED, gap_probability=GAP_PROBABILITY, missing_day_probability=MISSING_DAY_PROBABILITY):
+    rng = np.random.default_rng([seed, ticker_number])
+    price = np.exp(rng.uniform(np.log(5), np.log(500)))
+    sigma = rng.uniform(0.0005, 0.002) #per minute
+    base_volume = np.exp(rng.uniform(np.log(2_000), np.log(50_000)))
+
+    #minute offsets from 09:30 of every bar, session by session
+    counts = np.array([PRE_MARKET_MINUTES + close_minute + 1 + AFTER_HOURS_MINUTES for _, close_minute in sessions])
+    day = np.repeat(np.arange(len(sessions)), counts)
+    first_bar = np.r_[0, np.cumsum(counts)[:-1]]
+    minute = np.arange(counts.sum()) - first_bar[day] - PRE_MARKET_MINUTES
+    close_minute = np.array([close for _, close in sessions])[day]
+    regular = (minute >= 0) & (minute <= close_minute)
+
+    #log returns: overnight gap on the first bar of a day, a run of same-direction candles on trending opens
+    returns = rng.normal(0, sigma, len(minute))
+    returns[first_bar] += rng.normal(0, 0.01, len(sessions))
+    trend = np.where(rng.random(len(sessions)) < OPENING_TREND_PROBABILITY, rng.choice([-1, 1], len(sessions)), 0)[day]
+    opening = (minute >= 0) & (minute < 6) & (trend != 0)
+    returns[opening] = trend[opening] * (np.abs(returns[opening]) + sigma / 4)
+
+    closes = price * np.exp(np.cumsum(returns))
+    opens = np.r_[price, closes[:-1]]
+    highs = np.maximum(opens, closes) * (1 + np.abs(rng.normal(0, sigma / 2, len(minute))))
+    lows = np.minimum(opens, closes) * (1 - np.abs(rng.normal(0, sigma / 2, len(minute))))
+
+    #U-shaped intraday volume, spikes on some days, thin extended hours
+    day_multiplier = np.where(rng.random(len(sessions)) < HIGH_VOLUME_DAY_PROBABILITY, rng.uniform(3, 10, len(sessions)), 1.0)[day]
+    shape = 1 + 3 * np.exp(-np.clip(minute, 0, None) / 30) + np.exp((minute - close_minute) / 30).clip(0, 1)
+    volumes = base_volume * day_multiplier * shape * rng.lognormal(0, 0.5, len(minute))
+    volumes = np.where(regular, volumes, volumes * 0.05).round()
+
+    #the bar at the end of the trading window (15:55, 12:55 on half days) is never dropped, step 3 exits there
+    end_of_window = minute == np.where(close_minute == HALF_DAY_CLOSE_MINUTE, HALF_DAY_END_MINUTE, FULL_DAY_END_MINUTE)[day]
+    keep = ((rng.random(len(minute)) >= gap_probability) | end_of_window) & (rng.random(len(sessions)) >= missing_day_probability)[day]
+    calendar = get_calendar()
+    open_ns = np.array([calendar.minute_epoch_ns(date, 0) for date, _ in sessions], dtype='int64')[day]
+    timestamps = pd.to_datetime(open_ns + minute * MINUTE_NS, utc=True)
+
+    return pd.DataFrame({
+        'timestamp': timestamps,
+        'open': opens.round(4),
+        'high': highs.round(4),
+        'low': lows.round(4),
+        'close': closes.round(4),
+        'volume': volumes,
+        'vwap': ((highs + lows + closes) / 3).round(4)
+    })[keep]
+
+#write bars in the raw csv format (timestamps as '2022-11-01 13:00:00+00:00'), pyarrow's writer is much faster than to_csv
+def write_raw_file(bars, file_path):
+    timestamps = np.datetime_as_string(bars['timestamp'].dt.tz_localize(None).to_numpy(), unit='s')
+    table = pa.Table.from_pandas(bars.assign(timestamp=np.char.add(np.char.replace(timestamps, 'T', ' '), '+00:00')), preserve_index=False)
+    with open(file_path, 'wb') as f:
+        f.write((','.join(table.column_names) + '\n').encode())
+        pa_csv.write_csv(table, f, write_options=pa_csv.WriteOptions(include_header=False, quoting_style='none'))
+
+#write the raw files of num_tickers tickers (SYN0000, SYN0001, ...), returns the tickers and the number of rows written
+def generate_synthetic_data(folder=RAW_DATA_FOLDER, num_tickers=NUM_TICKERS, num_days=NUM_DAYS, start_date=START_DATE, seed=SEED,
+                            gap_probability=GAP_PROBABILITY, missing_day_probability=MISSING_DAY_PROBABILITY):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    sessions = trading_sessions(start_date, num_days)
+
+    tickers = [f"SYN{number:04d}" for number in range(num_tickers)]
+    rows = 0
+    for number, ticker in enumerate(tickers):
+        bars = generate_ticker(number, sessions, seed, gap_probability, missing_day_probability)
+        write_raw_file(bars, os.path.join(folder, f"{ticker}_1_min_data.csv"))
+        rows += len(bars)
+
+    return {'tickers': tickers, 'rows': rows, 'sessions': len(sessions)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic raw 1-minute files')
+    parser.add_argument('--folder', default=RAW_DATA_FOLDER)
+    parser.add_argument('--tickers', type=int, default=NUM_TICKERS)
+    parser.add_argument('--days', type=int, default=NUM_DAYS)
+    parser.add_argument('--start-date', default=START_DATE)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--gap-probability', type=float, default=GAP_PROBABILITY)
+    parser.add_argument('--missing-day-probability', type=float, default=MISSING_DAY_PROBABILITY)
+    args = parser.parse_args()
+
+    result = generate_synthetic_data(args.folder, args.tickers, args.days, args.start_date, args.seed, args.gap_probability,
+                                     args.missing_day_probability)
+    print(f"{len(result['tickers'])} tickers, {result['sessions']} sessions, {result['rows']} rows written to {args.folder}")
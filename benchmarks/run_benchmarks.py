@@ -0,0 +1,207 @@
+'''
+End-to-end benchmark of steps 1-4 on synthetic data (generate_synthetic_data.py).
+The data is generated into a scratch folder (so the real data is never touched) and every stage runs there in its own
+fresh process, with the stage's wall time, peak RSS (of the stage process and of its worker processes) and rows/sec:
+- step1: preprocess_historical_data (raw rows)
+- step2: find_top_stocks (processed bars)
+- step3: the day loop of orb_stat_main.run_backtest (candidate ticker-days)
+- step4: run_trade_calculations (trade log rows)
+The timers and counters of instrumentation.py (parquet reads, screen, entry/exit scans, log writes, ...) are recorded too.
+The results are saved as JSON, and with --compare the run is checked against a previous result file: a stage that got
+slower than REGRESSION_TOLERANCE is reported and the exit code is 1
+
+Run it from the main folder: python benchmarks/run_benchmarks.py --tickers 100 --days 60 --compare benchmark_results.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import multiprocessing
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+
+from generate_synthetic_data import generate_synthetic_data, NUM_TICKERS, NUM_DAYS, START_DATE, SEED, GAP_PROBABILITY, MISSING_DAY_PROBABILITY # type: ignore
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEP_FOLDERS = ['step-1-process_historical_data', 'step-2-get_candidate_stocks', 'step-3-run_strategy', 'step-4-result']
+STAGES = ['step1', 'step2', 'step3', 'step4']
+WORK_FOLDER = './benchmark_run' #scratch folder with the synthetic data and every output of the stages
+RESULTS_FILE = 'benchmark_results.json'
+REGRESSION_TOLERANCE = 0.2 #a stage is a regression if its wall time grew by more than 20%
+STEP1_OUTPUTS = ['processed_data_new', 'market_data_store', 'bar_cube', 'arrow_data_plane.arrow', 'opening_range_table.parquet'] #removed before step 1 so it runs from scratch
+
+#peak resident memory in MB of this process and of its (finished) child processes
+def peak_rss_mb():
+    scale = 1024**2 if sys.platform == 'darwin' else 1024 #ru_maxrss is in bytes on macOS and in KB on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+#run one stage in the work folder, returns the number of input rows it handled
+def run_stage(stage):
+    if stage == 'step1':
+        from process_historical_data import preprocess_historical_data, RAW_DATA_FOLDER # type: ignore
+        preprocess_historical_data()
+        files = [os.path.join(RAW_DATA_FOLDER, file) for file in os.listdir(RAW_DATA_FOLDER) if file.endswith('_1_min_data.csv')]
+        return sum(sum(1 for _ in open(file)) - 1 for file in files)
+
+    if stage == 'step2':
+        from get_candidate_stocks import find_top_stocks, data_folder # type: ignore
+        top_stocks = find_top_stocks(data_folder)
+        top_stocks.to_csv('step-2-get_candidate_stocks/top_20_qualified_daily_stocks.csv', index=False)
+        with open(os.path.join(data_folder, 'manifest.json')) as f:
+            return sum(entry['rows'] for entry in json.load(f).values())
+
+    if stage == 'step3':
+        from orb_stat_main import run_backtest, TOP_STOCKS_FILE # type: ignore
+        run_backtest()
+        return len(pd.read_csv(TOP_STOCKS_FILE, usecols=['ticker']))
+
+    if stage == 'step4':
+        from trade_calculations import run_trade_calculations, load_trade_log # type: ignore
+        run_trade_calculations()
+        return len(load_trade_log())
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+#child process of a stage: runs it with the console output silenced (unless verbose) and sends back the measurements
+def stage_process(stage, work_folder, verbose, connection):
+    os.chdir(work_folder)
+    sys.path[:0] = [os.path.join(REPO_ROOT, folder) for folder in STEP_FOLDERS]
+    if not verbose:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1) #also silences the worker processes of the stage
+
+    try:
+        import instrumentation # type: ignore
+        instrumentation.enable()
+        rss_before, _ = peak_rss_mb()
+        start = time.perf_counter()
+        rows = run_stage(stage)
+        wall_seconds = time.perf_counter() - start
+        rss_peak, worker_rss_peak = peak_rss_mb()
+        recorded = instrumentation.report()
+        connection.send({
+            'wall_seconds': round(wall_seconds, 4),
+            'rows': rows,
+            'rows_per_second': round(rows / wall_seconds, 1) if wall_seconds > 0 else None,
+            'rss_before_mb': round(rss_before, 1),
+            'peak_rss_mb': round(rss_peak, 1),
+            'peak_worker_rss_mb': round(worker_rss_peak, 1),
+            'timers': {name: {'calls': timer['calls'], 'total_seconds': timer['total_seconds']} for name, timer in recorded['timers'].items()},
+            'counters': recorded['counters']
+        })
+    except Exception as e:
+        connection.send({'error': f"{type(e).__name__}: {e}"})
+    finally:
+        connection.close()
+
+def benchmark_stage(stage, work_folder, verbose=False):
+    context = multiprocessing.get_context('spawn') #fresh interpreter: imports, caches and peak RSS don't carry over between stages
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=stage_process, args=(stage, work_folder, verbose, sender))
+    process.start()
+    sender.close()
+    result = receiver.recv() if receiver.poll(None) else {'error': 'no result'}
+    process.join()
+
+    return result
+
+#prepare the work folder (synthetic raw data and the folders the stages write to), returns the generation summary
+def prepare_work_folder(work_folder, num_tickers, num_days, start_date, seed, gap_probability, missing_day_probability):
+    if os.path.exists(work_folder):
+        shutil.rmtree(work_folder)
+    for folder in ['step-2-get_candidate_stocks', 'step-4-result', 'logs']:
+        os.makedirs(os.path.join(work_folder, folder))
+
+    start = time.perf_counter()
+    summary = generate_synthetic_data(os.path.join(work_folder, 'historical_data_new'), num_tickers, num_days, start_date, seed,
+                                      gap_probability, missing_day_probability)
+    summary['seconds'] = round(time.perf_counter() - start, 4)
+    summary['tickers'] = len(summary['tickers'])
+
+    return summary
+
+def run_benchmarks(work_folder=WORK_FOLDER, stages=STAGES, num_tickers=NUM_TICKERS, num_days=NUM_DAYS, start_date=START_DATE, seed=SEED,
+                   gap_probability=GAP_PROBABILITY, missing_day_probability=MISSING_DAY_PROBABILITY, verbose=False):
+    work_folder = os.path.abspath(work_folder)
+    generation = prepare_work_folder(work_folder, num_tickers, num_days, start_date, seed, gap_probability, missing_day_probability)
+    print(f"Synthetic data: {generation['tickers']} tickers, {generation['sessions']} sessions, {generation['rows']} rows ({generation['seconds']}s)")
+
+    results = {}
+    for stage in stages:
+        if stage == 'step1':
+            for output in STEP1_OUTPUTS:
+                path = os.path.join(work_folder, output)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.remove(path)
+        results[stage] = benchmark_stage(stage, work_folder, verbose)
+        print(f"{stage}: {dict((key, value) for key, value in results[stage].items() if key not in ('timers', 'counters'))}")
+        if 'error' in results[stage]:
+            break #the next stages need this stage's output
+
+    return {
+        'created': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'config': {'tickers': num_tickers, 'days': num_days, 'start_date': start_date, 'seed': seed,
+                   'gap_probability': gap_probability, 'missing_day_probability': missing_day_probability},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                        'numpy': np.__version__, 'pandas': pd.__version__, 'pyarrow': pa.__version__},
+        'generation': generation,
+        'stages': results
+    }
+
+#wall time of every stage compared with a previous run, returns the stages that got slower than the tolerance
+def compare_results(current, previous, tolerance=REGRESSION_TOLERANCE):
+    if current['config'] != previous['config']:
+        print(f"Warning: the runs have different configs ({previous['config']} vs {current['config']})")
+
+    regressions = []
+    for stage, result in current['stages'].items():
+        before = previous['stages'].get(stage, {}).get('wall_seconds')
+        after = result.get('wall_seconds')
+        if not before or after is None:
+            continue
+        ratio = after / before
+        flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+        print(f"{stage}: {before:.3f}s -> {after:.3f}s ({ratio:.2f}x) {flag}")
+        if flag:
+            regressions.append(stage)
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark steps 1-4 on synthetic data')
+    parser.add_argument('--work-folder', default=WORK_FOLDER)
+    parser.add_argument('--stages', nargs='*', default=STAGES, choices=STAGES)
+    parser.add_argument('--tickers', type=int, default=NUM_TICKERS)
+    parser.add_argument('--days', type=int, default=NUM_DAYS)
+    parser.add_argument('--start-date', default=START_DATE)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--gap-probability', type=float, default=GAP_PROBABILITY)
+    parser.add_argument('--missing-day-probability', type=float, default=MISSING_DAY_PROBABILITY)
+    parser.add_argument('--output', default=RESULTS_FILE, help='JSON file the results are saved to')
+    parser.add_argument('--compare', help='previous JSON result to compare the wall times with')
+    parser.add_argument('--keep-data', action='store_true', help='keep the work folder after the run')
+    parser.add_argument('--verbose', action='store_true', help="show the stages' console output")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.work_folder, args.stages, args.tickers, args.days, args.start_date, args.seed,
+                             args.gap_probability, args.missing_day_probability, args.verbose)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f"Results saved in {args.output}")
+
+    if not args.keep_data:
+        shutil.rmtree(os.path.abspath(args.work_folder))
+
+    failed = any('error' in result for result in results['stages'].values())
+    if args.compare:
+        with open(args.compare) as f:
+            failed |= bool(compare_results(results, json.load(f)))
+    sys.exit(1 if failed else 0)
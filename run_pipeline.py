@@ -0,0 +1,261 @@
+'''
+Runs steps 1-4 in one process from one config, with a cache of every stage's output.
+The config is a dict stage -> {module constant: value} (defaults are the constants of the step modules, change them with
+--config file.json or --set step3.STOP_LOSS_PERCENTAGE=0.03). A stage is only run when the key of its output changes:
+sha256 of its config, of the source files it runs and of the hashes of its inputs (the raw files for step 1, the output
+of the stages before it otherwise). Changing only STOP_LOSS_PERCENTAGE reruns steps 3 and 4, steps 1 and 2 are reused.
+- step 1 writes its output in place (processed files, opening range table, store), its hash is the hash of the manifest
+  and of the config the files were processed with.
+  A config change (e.g. the indicator windows) rebuilds every ticker, new raw rows are processed incrementally as usual
+- steps 2-4 outputs are copied to PIPELINE_CACHE_FOLDER/<stage>/<key>/ and copied back on a cache hit (the output paths
+  are the ones of the step modules, e.g. the trade log of LOG_FORMAT)
+- the row step 4 appends to its test results file is cached too and appended on a cache hit if the file doesn't have it yet
+
+Run it from the main folder: python run_pipeline.py --set step3.STOP_LOSS_PERCENTAGE=0.03 (--force step3 to ignore the cache)
+'''
+
+import os
+import sys
+import json
+import glob
+import shutil
+import hashlib
+import argparse
+
+STEP_FOLDERS = {'step1': 'step-1-process_historical_data', 'step2': 'step-2-get_candidate_stocks',
+                'step3': 'step-3-run_strategy', 'step4': 'step-4-result'}
+for folder in STEP_FOLDERS.values():
+    sys.path.append(f'./{folder}')
+
+import instrumentation # type: ignore
+
+STAGES = ['step1', 'step2', 'step3', 'step4']
+PIPELINE_CACHE_FOLDER = './pipeline_cache'
+ARTIFACT_FILE = 'artifact.json'
+LAST_STEP1_FILE = 'last_step1.json' #config of the processed files in place
+
+#module and constants of the config of each stage (settings that change the output or where it is read from and written to)
+STAGE_PARAMETERS = {
+    'step1': ('process_historical_data', ['ATR_WINDOW', 'VOLUME_WINDOW', 'BUILD_OPENING_RANGE_TABLE', 'BUILD_MARKET_DATA_STORE', 'BUILD_BAR_CUBE', 'BUILD_ARROW_DATA_PLANE']),
+    'step2': ('get_candidate_stocks', ['SCREEN_CRITERIA', 'TOP_STOCKS_COUNT', 'start_date', 'end_date', 'start_time', 'end_time']),
+    'step3': ('orb_stat_main', ['STOP_LOSS_PERCENTAGE', 'atr_value', 'PERCENTAGE_CHANGE_BEFORE_ENTRY', 'STOP_CHECK_INTERVAL', 'LOG_FORMAT',
+                                'USE_OPENING_RANGE_TABLE', 'USE_MARKET_DATA_STORE', 'USE_BAR_CACHE', 'USE_BAR_CUBE', 'USE_ARROW_DATA_PLANE']),
+    'step4': ('trade_calculations', ['starting_capital', 'risk_free_rate', 'commission_per_share'])
+}
+STAGE_INPUTS = {'step1': [], 'step2': ['step1'], 'step3': ['step1', 'step2'], 'step4': ['step1', 'step3']}
+STAGE_SOURCES = {'step1': ['step1'], 'step2': ['step2', 'step1'], 'step3': ['step3', 'step1'], 'step4': ['step4', 'step3', 'step1']} #folders of the code a stage runs
+TOP_STOCKS_FILE = 'step-2-get_candidate_stocks/top_20_qualified_daily_stocks.csv'
+
+logger = instrumentation.get_logger('pipeline')
+
+def stage_module(stage):
+    return __import__(STAGE_PARAMETERS[stage][0])
+
+#output files of steps 2-4 (from the module constants after apply_config)
+def stage_outputs(stage):
+    if stage == 'step2':
+        return [TOP_STOCKS_FILE]
+    if stage == 'step3':
+        return [f"logs/{stage_module('step3').LOG_FILE}"]
+    if stage == 'step4':
+        module = stage_module('step4')
+        return [module.trade_details_file, module.metrics_output_file]
+    return []
+
+#files a stage appends one row to on every run (shared by all the runs, so they aren't part of its output hash)
+def stage_appended_files(stage):
+    return [stage_module('step4').test_results_file] if stage == 'step4' else []
+
+#config with the current values of the module constants
+def default_config():
+    return {stage: {name: getattr(stage_module(stage), name) for name in names} for stage, (_, names) in STAGE_PARAMETERS.items()}
+
+#override config values with 'stage.NAME=value' strings (values are parsed as JSON, plain strings otherwise)
+def apply_overrides(config, overrides):
+    for override in overrides:
+        path, value = override.split('=', 1)
+        stage, name = path.split('.', 1)
+        if stage not in config or name not in config[stage]:
+            raise KeyError(f"Unknown config value: {path}")
+        try:
+            config[stage][name] = json.loads(value)
+        except json.JSONDecodeError:
+            config[stage][name] = value
+
+    return config
+
+#set the module constants of a stage from the config
+def apply_config(stage, stage_config):
+    module = stage_module(stage)
+    for name, value in stage_config.items():
+        setattr(module, name, value)
+    if stage == 'step1':
+        module.HISTORY_BARS = max(module.ATR_WINDOW, module.VOLUME_WINDOW)
+    elif stage == 'step3': #trade log of LOG_FORMAT
+        module.LOG_FILE = f'trade_log_initial.{module.LOG_FORMAT}'
+        module.TRADE_LEDGER = module.TradeLedger(f'logs/{module.LOG_FILE}', columns=module.LOG_COLUMNS, flush_every=module.LEDGER_FLUSH_RECORDS)
+
+def hash_json(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+def hash_file(file_path):
+    from process_historical_data import file_hash # type: ignore
+    return file_hash(file_path)
+
+def source_hash(stage):
+    files = sorted(file for key in STAGE_SOURCES[stage] for file in glob.glob(os.path.join(STEP_FOLDERS[key], '*.py')))
+    return hash_json({os.path.basename(file): hash_file(file) for file in files})
+
+#size and mtime of every raw file (step 1 checks the content itself, see its manifest)
+def raw_data_fingerprint():
+    from process_historical_data import RAW_DATA_FOLDER # type: ignore
+    files = sorted(file for file in os.listdir(RAW_DATA_FOLDER) if file.endswith('_1_min_data.csv'))
+    return hash_json([(file, os.stat(os.path.join(RAW_DATA_FOLDER, file)).st_size, os.stat(os.path.join(RAW_DATA_FOLDER, file)).st_mtime_ns) for file in files])
+
+#hash of the output of a stage as it is on disk, None if it is missing
+def output_hash(stage):
+    if stage == 'step1': #raw files processed (manifest) and the config they were processed with
+        from process_historical_data import MANIFEST_FILE # type: ignore
+        last = read_json(os.path.join(PIPELINE_CACHE_FOLDER, LAST_STEP1_FILE))
+        return hash_json([hash_file(MANIFEST_FILE), last['config']]) if os.path.exists(MANIFEST_FILE) and last is not None else None
+    outputs = stage_outputs(stage)
+    if not all(os.path.exists(path) for path in outputs):
+        return None
+    return hash_json([hash_file(path) for path in outputs])
+
+def stage_key(stage, stage_config, input_hashes):
+    inputs = dict(input_hashes, raw_data=raw_data_fingerprint()) if stage == 'step1' else input_hashes
+    return hash_json({'stage': stage, 'config': stage_config, 'source': source_hash(stage), 'inputs': inputs})
+
+def read_json(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)
+
+def write_json(file_path, value):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'w') as f:
+        json.dump(value, f, indent=1, sort_keys=True, default=str)
+
+#output of a cached run of the stage put back in place, returns the output hash (None on a cache miss)
+def restore_stage(stage, key):
+    folder = os.path.join(PIPELINE_CACHE_FOLDER, stage, key)
+    artifact = read_json(os.path.join(folder, ARTIFACT_FILE))
+    if artifact is None:
+        return None
+    if stage == 'step1': #in place, only valid if the processed files weren't changed since
+        return artifact['output'] if output_hash('step1') == artifact['output'] else None
+
+    for path in stage_outputs(stage):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(folder, os.path.basename(path)), path)
+    for path in stage_appended_files(stage):
+        append_cached_row(os.path.join(folder, os.path.basename(path)), path)
+
+    return artifact['output']
+
+#append the row of a cached run to a shared file (with the header if the file doesn't exist), unless the file already has it
+def append_cached_row(cached_path, path):
+    if not os.path.exists(cached_path):
+        return
+    with open(cached_path) as f:
+        header, row = f.readlines()
+    if os.path.exists(path):
+        with open(path) as f:
+            if row in f.readlines():
+                return
+    with open(path, 'a') as f:
+        f.write(row if os.path.getsize(path) else header + row)
+
+def save_stage(stage, key, stage_config, input_hashes):
+    folder = os.path.join(PIPELINE_CACHE_FOLDER, stage, key)
+    tmp_folder = folder + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for path in stage_outputs(stage):
+        shutil.copyfile(path, os.path.join(tmp_folder, os.path.basename(path)))
+    for path in stage_appended_files(stage):
+        if os.path.exists(path): #header and row of the run
+            with open(path) as f:
+                lines = f.readlines()
+            with open(os.path.join(tmp_folder, os.path.basename(path)), 'w') as f:
+                f.writelines([lines[0], lines[-1]])
+
+    output = output_hash(stage)
+    write_json(os.path.join(tmp_folder, ARTIFACT_FILE), {'stage': stage, 'config': stage_config, 'inputs': input_hashes, 'output': output})
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+    return output
+
+def run_stage(stage, config):
+    module = stage_module(stage)
+    if stage == 'step1':
+        #processed files built with another config are rebuilt from scratch (the manifest only tracks the raw files)
+        last_path = os.path.join(PIPELINE_CACHE_FOLDER, LAST_STEP1_FILE)
+        last = read_json(last_path)
+        if last is not None and last['config'] != hash_json(config['step1']) and os.path.exists(module.MANIFEST_FILE):
+            logger.info("Step 1 config changed, every ticker is processed again")
+            os.remove(module.MANIFEST_FILE)
+        module.preprocess_historical_data()
+        write_json(last_path, {'config': hash_json(config['step1'])})
+    elif stage == 'step2':
+        top_stocks = module.find_top_stocks(module.data_folder)
+        top_stocks.to_csv(TOP_STOCKS_FILE, index=False)
+    elif stage == 'step3':
+        module.run_backtest()
+    elif stage == 'step4':
+        step3 = config['step3']
+        module.run_trade_calculations(module.load_trade_log(stage_outputs('step3')[0]), strategy_params={'stop_loss_percent': step3['STOP_LOSS_PERCENTAGE'], 'atr_value': step3['atr_value'],
+                                                       'entry_%_change (X 100)': step3['PERCENTAGE_CHANGE_BEFORE_ENTRY'],
+                                                       'check_interval': step3['STOP_CHECK_INTERVAL']})
+
+#run the stages whose key changed, returns the action of every stage ('cached' or 'ran')
+def run_pipeline(config=None, force=()):
+    config = config or default_config()
+    hashes = {}
+    actions = {}
+
+    for stage in STAGES:
+        apply_config(stage, config[stage])
+        input_hashes = {name: hashes[name] for name in STAGE_INPUTS[stage]}
+        key = stage_key(stage, config[stage], input_hashes)
+
+        output = restore_stage(stage, key) if stage not in force else None
+        if output is not None:
+            actions[stage] = 'cached'
+        else:
+            with instrumentation.stage(stage):
+                run_stage(stage, config)
+            output = save_stage(stage, key, config[stage], input_hashes)
+            actions[stage] = 'ran'
+        hashes[stage] = output
+        logger.info(f"{stage}: {actions[stage]} (key {key[:12]})")
+
+    return actions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run steps 1-4 with a cache of every stage output')
+    parser.add_argument('--config', help='JSON file with {stage: {NAME: value}} overrides')
+    parser.add_argument('--set', nargs='*', default=[], help='overrides as stage.NAME=value')
+    parser.add_argument('--force', nargs='*', default=[], choices=STAGES, help='stages to run even if they are cached')
+    parser.add_argument('--show-config', action='store_true', help='print the config and exit')
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    instrumentation.setup(sys.argv[1:])
+
+    config = default_config()
+    if args.config:
+        with open(args.config) as f:
+            for stage, values in json.load(f).items():
+                apply_overrides(config, [f"{stage}.{name}={json.dumps(value)}" for name, value in values.items()])
+    apply_overrides(config, args.set)
+
+    if args.show_config:
+        print(json.dumps(config, indent=1, default=str))
+    else:
+        run_pipeline(config, args.force)
+    instrumentation.finish()
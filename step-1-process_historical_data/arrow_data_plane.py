@@ -0,0 +1,149 @@
+'''
+Shared-memory data plane written by step 1 (optional): the processed bars of every ticker are decoded once into one
+uncompressed Arrow IPC file (one record batch per ticker, the ticker order is in the schema metadata).
+Readers open it memory-mapped, so the columns are read only views of the file's pages: no parquet decoding and no copy
+per process, and every worker process of step 3 shares the same pages through the OS page cache (the memory of a worker
+doesn't grow with the number of workers or with the tickers it reads, only the OS page cache holds the bars once).
+NaN indicators are stored as NaN values (not as nulls) so every column converts to NumPy/pandas without a copy.
+The schema metadata also holds the version of the processed bars of every ticker (see processed_data_versions in step 1),
+steps 2 and 3 only read the file while it matches the manifest of step 1.
+File (ARROW_DATA_FILE):
+    timestamp  timestamp[ns, tz=US/Eastern]
+    open, high, low, close  float32
+    volume  int64
+    ATR_14, Avg_Volume_14d, Relative_Volume  float32
+'''
+
+import os
+import json
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.compute as pc # type: ignore
+import pyarrow.parquet as pq # type: ignore
+import instrumentation # type: ignore
+from trading_calendar import get_calendar, TIMEZONE # type: ignore
+
+logger = instrumentation.get_logger('arrow_data_plane')
+
+PROCESSED_DATA_FOLDER = './processed_data_new'
+ARROW_DATA_FILE = './arrow_data_plane.arrow'
+TICKERS_METADATA_KEY = b'tickers' #JSON list of the tickers in record batch order
+VERSIONS_METADATA_KEY = b'versions' #JSON {ticker: version of the processed bars the file was written from}
+ARROW_SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('ns', tz=TIMEZONE)),
+    ('open', pa.float32()), ('high', pa.float32()), ('low', pa.float32()), ('close', pa.float32()),
+    ('volume', pa.int64()),
+    ('ATR_14', pa.float32()), ('Avg_Volume_14d', pa.float32()), ('Relative_Volume', pa.float32())
+])
+
+#bars of one processed file as a record batch of ARROW_SCHEMA (one contiguous chunk per column, nulls as NaN)
+def read_ticker_batch(file_path):
+    table = pq.read_table(file_path, columns=ARROW_SCHEMA.names)
+    columns = []
+    for field in ARROW_SCHEMA:
+        column = table[field.name].cast(field.type)
+        if pa.types.is_floating(field.type) and column.null_count:
+            column = pc.fill_null(column, np.nan)
+        columns.append(column.combine_chunks() if column.num_chunks != 1 else column.chunk(0))
+
+    return pa.record_batch(columns, schema=ARROW_SCHEMA)
+
+#(re)write the data plane from the processed files (written to a temporary file and swapped in, processes that have the
+#old file mapped keep reading it until they reopen), versions: {ticker: version of its processed bars}
+def build_arrow_data_plane(tickers=None, processed_folder=PROCESSED_DATA_FOLDER, file_path=ARROW_DATA_FILE, versions=None):
+    if tickers is None:
+        tickers = sorted(f.split('.parquet')[0] for f in os.listdir(processed_folder) if f.endswith('.parquet'))
+
+    #tickers with bars (row counts from the parquet footers), the ticker list goes into the schema before any batch
+    paths = {}
+    for ticker in tickers:
+        path = os.path.join(processed_folder, f'{ticker}.parquet')
+        if not os.path.exists(path):
+            logger.warning(f'Processed data not found for ticker: {ticker}')
+        elif pq.read_metadata(path).num_rows:
+            paths[ticker] = path
+
+    temp_path = f'{file_path}.tmp'
+    schema = ARROW_SCHEMA.with_metadata({TICKERS_METADATA_KEY: json.dumps(list(paths)), VERSIONS_METADATA_KEY: json.dumps(versions or {})})
+    with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, schema) as writer:
+        for ticker, path in paths.items(): #one ticker in memory at a time
+            with instrumentation.timer('arrow_write', ticker=ticker):
+                writer.write_batch(read_ticker_batch(path))
+    os.replace(temp_path, file_path)
+    _open_planes.clear()
+    logger.info(f"Arrow data plane updated: {len(paths)} tickers, {os.path.getsize(file_path) / 1024**2:.1f} MB")
+
+#memory-mapped data plane, every array is a read only view of the file
+class ArrowDataPlane:
+    def __init__(self, file_path=ARROW_DATA_FILE):
+        self.file_path = file_path
+        self.source = pa.memory_map(file_path, 'r')
+        self.reader = pa.ipc.open_file(self.source)
+        self.tickers = json.loads(self.reader.schema.metadata[TICKERS_METADATA_KEY])
+        self.versions = json.loads(self.reader.schema.metadata.get(VERSIONS_METADATA_KEY, b'{}'))
+        self.batch_index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.epochs = {} #ticker -> int64 view of its timestamps (UTC epoch ns), for the row lookups
+
+    def has_ticker(self, ticker):
+        return ticker in self.batch_index
+
+    #record batch of a ticker (zero copy), None if the ticker isn't in the file
+    def batch(self, ticker):
+        i = self.batch_index.get(ticker)
+        return None if i is None else self.reader.get_batch(i)
+
+    def epoch_ns(self, ticker):
+        if ticker not in self.epochs:
+            self.epochs[ticker] = self.batch(ticker).column('timestamp').to_numpy(zero_copy_only=True).view('int64')
+        return self.epochs[ticker]
+
+    #rows (start, stop) of the bars of a ticker in [start_ns, end_ns) (UTC epoch ns)
+    def row_range(self, ticker, start_ns=None, end_ns=None):
+        epoch_ns = self.epoch_ns(ticker)
+        start = 0 if start_ns is None else int(np.searchsorted(epoch_ns, start_ns, side='left'))
+        stop = len(epoch_ns) if end_ns is None else int(np.searchsorted(epoch_ns, end_ns, side='left'))
+        return start, stop
+
+    #NumPy views of the columns of a ticker (timestamp as int64 UTC epoch ns), None if the ticker isn't in the file
+    def arrays(self, ticker, columns=None, start_ns=None, end_ns=None):
+        if not self.has_ticker(ticker):
+            return None
+        start, stop = self.row_range(ticker, start_ns, end_ns)
+        batch = self.batch(ticker).slice(start, stop - start)
+        names = columns if columns is not None else batch.schema.names
+        arrays = {name: batch.column(name).to_numpy(zero_copy_only=True) for name in names}
+        if 'timestamp' in arrays:
+            arrays['timestamp'] = arrays['timestamp'].view('int64')
+        return arrays
+
+    #bars of a ticker as a DataFrame indexed by 'timestamp' (US/Eastern), the same frame as the processed file but with
+    #columns and index backed by the mapped file; None if the ticker isn't in the file
+    def frame(self, ticker, columns=None, start_ns=None, end_ns=None):
+        if not self.has_ticker(ticker):
+            return None
+        start, stop = self.row_range(ticker, start_ns, end_ns)
+        batch = self.batch(ticker).slice(start, stop - start)
+        if columns is not None:
+            batch = batch.select(['timestamp'] + list(columns))
+        df = batch.to_pandas(split_blocks=True, zero_copy_only=True)
+        df.index = pd.DatetimeIndex(df.pop('timestamp'), copy=False, name='timestamp')
+        return df
+
+    #bars of a ticker on one date (see frame)
+    def day_frame(self, ticker, date, columns=None):
+        start_ns, end_ns = get_calendar().date_range_ns(date, date)
+        return self.frame(ticker, columns, start_ns, end_ns)
+
+_open_planes = {} #file_path -> (modification time, ArrowDataPlane), the file is mapped once per process
+
+#data plane of the file, None if it wasn't built (reopened when step 1 rewrote it)
+def open_arrow_data_plane(file_path=ARROW_DATA_FILE):
+    try:
+        modified = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if file_path not in _open_planes or _open_planes[file_path][0] != modified:
+        _open_planes[file_path] = (modified, ArrowDataPlane(file_path))
+
+    return _open_planes[file_path][1]
@@ -0,0 +1,134 @@
+'''
+Dense bar cube written by step 1 (optional): every session is the same 391 minute grid (09:30 to 16:00), so the bars of a
+ticker are stored as arrays indexed by [day, minute] in .npy files that are opened memory-mapped.
+Readers index by integer minute offset (0 = 09:30, 5 = 09:35, 385 = 15:55) instead of slicing by tz-aware timestamps,
+slices of the cube are views without copies, and processes reading the same ticker share its pages through the OS page cache.
+Files per ticker (in CUBE_FOLDER/<ticker>/):
+    prices.npy  float32 [days, 391, 4] open, high, low, close (NaN where there is no bar)
+    volume.npy  int64   [days, 391] (0 where there is no bar)
+    valid.npy   bool    [days, 391] True where there is a bar
+    dates.npy   datetime64[D] [days] trading date of each day, sorted
+    version.txt version of the processed bars the cube was built from (see processed_data_versions in step 1), step 3
+                only reads the cube while it matches the manifest of step 1
+plus the coarse bars (5-minute by default) of coarse_bars.py on the same day axis
+'''
+
+import os
+import shutil
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import instrumentation # type: ignore
+from coarse_bars import build_coarse_bars, coarse_file_names, COARSE_INTERVALS # type: ignore
+from trading_calendar import get_calendar, SESSION_MINUTES # type: ignore
+
+logger = instrumentation.get_logger('bar_cube')
+
+PROCESSED_DATA_FOLDER = './processed_data_new'
+CUBE_FOLDER = './bar_cube'
+CUBE_FIELDS = ['open', 'high', 'low', 'close'] #fields of prices.npy (last axis)
+OPEN, HIGH, LOW, CLOSE = range(len(CUBE_FIELDS))
+
+#build (or rebuild) the cube of one ticker from its processed parquet file, version is the version of the processed bars
+def build_ticker_cube(ticker, processed_folder=PROCESSED_DATA_FOLDER, cube_folder=CUBE_FOLDER, version=None):
+    df = pd.read_parquet(os.path.join(processed_folder, f'{ticker}.parquet'), columns=CUBE_FIELDS + ['volume'])
+    calendar = get_calendar()
+    days, minutes = calendar.session_minutes(df.index.asi8)
+    inside = (minutes >= 0) & (minutes < SESSION_MINUTES)
+
+    day_numbers, day_index = np.unique(days[inside], return_inverse=True)
+    dates = calendar.first_day + day_numbers.astype('timedelta64[D]')
+    minutes = minutes[inside]
+    prices = np.full((len(dates), SESSION_MINUTES, len(CUBE_FIELDS)), np.nan, dtype='float32')
+    volume = np.zeros((len(dates), SESSION_MINUTES), dtype='int64')
+    valid = np.zeros((len(dates), SESSION_MINUTES), dtype=bool)
+
+    #bars are written last to first, so for a duplicated minute the first bar wins
+    order = np.arange(len(minutes))[::-1]
+    prices[day_index[order], minutes[order]] = df[CUBE_FIELDS].to_numpy(dtype='float32')[inside][order]
+    volume[day_index[order], minutes[order]] = df['volume'].to_numpy()[inside][order]
+    valid[day_index, minutes] = True
+
+    folder = os.path.join(cube_folder, ticker)
+    tmp_folder = folder + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+    for name, values in (('prices', prices), ('volume', volume), ('valid', valid), ('dates', dates)):
+        np.save(os.path.join(tmp_folder, f'{name}.npy'), values)
+    for interval in COARSE_INTERVALS:
+        for file_name, values in zip(coarse_file_names(interval).values(), build_coarse_bars(prices, volume, valid, interval)):
+            np.save(os.path.join(tmp_folder, file_name), values)
+    if version is not None:
+        with open(os.path.join(tmp_folder, 'version.txt'), 'w') as f:
+            f.write(version)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+#build the cubes of the given tickers (all processed tickers if None), versions: {ticker: version of its processed bars}
+def build_bar_cube(tickers=None, processed_folder=PROCESSED_DATA_FOLDER, cube_folder=CUBE_FOLDER, versions=None):
+    os.makedirs(cube_folder, exist_ok=True)
+    if tickers is None:
+        tickers = sorted(f.split('.parquet')[0] for f in os.listdir(processed_folder) if f.endswith('.parquet'))
+
+    for ticker in tickers:
+        build_ticker_cube(ticker, processed_folder, cube_folder, (versions or {}).get(ticker))
+    _open_cubes.clear()
+    logger.info(f"Bar cube updated: {len(tickers)} tickers")
+
+#{ticker: version of the processed bars its cube was built from} (tickers whose cube has no version are left out)
+def bar_cube_versions(cube_folder=CUBE_FOLDER):
+    versions = {}
+    for ticker in os.listdir(cube_folder):
+        path = os.path.join(cube_folder, ticker, 'version.txt')
+        if os.path.isfile(path):
+            with open(path) as f:
+                versions[ticker] = f.read()
+
+    return versions
+
+#memory-mapped cube of one ticker, arrays are read only views of the files
+class BarCube:
+    def __init__(self, folder):
+        self.prices = np.load(os.path.join(folder, 'prices.npy'), mmap_mode='r')
+        self.volume = np.load(os.path.join(folder, 'volume.npy'), mmap_mode='r')
+        self.valid = np.load(os.path.join(folder, 'valid.npy'), mmap_mode='r')
+        self.dates = np.load(os.path.join(folder, 'dates.npy'))
+        self.folder = folder
+        self.coarse = {} #interval -> (prices, volume, last_minute), mapped on first use
+
+    #row of the date in the cube, None if the ticker has no bars on that date
+    def day_index(self, date):
+        day = np.datetime64(str(date)[:10], 'D')
+        i = int(np.searchsorted(self.dates, day))
+        return i if i < len(self.dates) and self.dates[i] == day else None
+
+    #(391, 4) prices of the date (view, NaN where there is no bar), None if the ticker has no bars on that date
+    def day_prices(self, date):
+        i = self.day_index(date)
+        return None if i is None else self.prices[i]
+
+    #coarse bars of an interval (see coarse_bars.py), None if they weren't built
+    def coarse_bars(self, interval):
+        if interval not in self.coarse:
+            paths = [os.path.join(self.folder, file_name) for file_name in coarse_file_names(interval).values()]
+            self.coarse[interval] = tuple(np.load(path, mmap_mode='r') for path in paths) if all(os.path.isfile(path) for path in paths) else None
+        return self.coarse[interval]
+
+    #(bins, 4) coarse prices and (bins,) last minutes of the date (views), None if missing
+    def day_coarse(self, date, interval):
+        i = self.day_index(date)
+        coarse = self.coarse_bars(interval) if i is not None else None
+        return None if coarse is None else (coarse[0][i], coarse[2][i])
+
+_open_cubes = {} #(cube_folder, ticker) -> BarCube, a cube is mapped once per process
+
+#cube of a ticker, None if it wasn't built
+def open_bar_cube(ticker, cube_folder=CUBE_FOLDER):
+    key = (cube_folder, ticker)
+    if key not in _open_cubes:
+        folder = os.path.join(cube_folder, ticker)
+        _open_cubes[key] = BarCube(folder) if os.path.isfile(os.path.join(folder, 'dates.npy')) else None
+
+    return _open_cubes[key]
@@ -0,0 +1,51 @@
+'''
+Coarse (5-minute, optionally 15-minute) bars built by step 1 next to the 1-minute bars of the bar cube (bar_cube.py).
+Bins are aligned to 09:30 (minute offset // interval, the same bins as resample('5min') since 09:30 is a multiple of 5 and
+15 minutes) and labelled by their first minute, so the coarse bar of any 1-minute bar is coarse_bin(minute, interval).
+A coarse bar holds open (first bar), high, low, close (last bar) and volume of its 1-minute bars, and the minute of its
+last 1-minute bar (-1 for an empty bin) so a reader knows which bars it includes (e.g. whether it has bars after an entry).
+Files per ticker and interval (in CUBE_FOLDER/<ticker>/, same day axis as the 1-minute cube):
+    prices_<interval>m.npy       float32 [days, bins, 4] open, high, low, close (NaN for an empty bin)
+    volume_<interval>m.npy       int64   [days, bins]
+    last_minute_<interval>m.npy  int16   [days, bins]
+'''
+
+import numpy as np # type: ignore
+
+COARSE_INTERVALS = [5] #intervals in minutes built with the bar cube (add 15 for 15-minute bars)
+OPEN, HIGH, LOW, CLOSE = range(4) #same price layout as the bar cube
+
+#coarse bar (bin) of minute offsets and the first minute of bins
+def coarse_bin(minutes, interval):
+    return np.asarray(minutes) // interval
+
+def bin_start_minute(bins, interval):
+    return np.asarray(bins) * interval
+
+def coarse_file_names(interval):
+    return {name: f'{name}_{interval}m.npy' for name in ('prices', 'volume', 'last_minute')}
+
+#coarse bars of 1-minute grids: prices [days, minutes, 4], volume and valid [days, minutes]
+#returns prices [days, bins, 4], volume [days, bins] and last_minute [days, bins] (-1 where the bin has no bar)
+def build_coarse_bars(prices, volume, valid, interval):
+    days, n_minutes = valid.shape
+    n_bins = -(-n_minutes // interval)
+    pad = n_bins * interval - n_minutes
+
+    binned_valid = np.pad(valid, ((0, 0), (0, pad))).reshape(days, n_bins, interval)
+    binned_prices = np.pad(prices, ((0, 0), (0, pad), (0, 0)), constant_values=np.nan).reshape(days, n_bins, interval, prices.shape[2])
+    has_bar = binned_valid.any(axis=2)
+    first = binned_valid.argmax(axis=2)
+    last = interval - 1 - binned_valid[:, :, ::-1].argmax(axis=2)
+
+    coarse = np.full((days, n_bins, prices.shape[2]), np.nan, dtype=prices.dtype)
+    coarse[:, :, OPEN] = np.take_along_axis(binned_prices[:, :, :, OPEN], first[:, :, None], axis=2)[:, :, 0]
+    coarse[:, :, HIGH] = np.fmax.reduce(binned_prices[:, :, :, HIGH], axis=2)
+    coarse[:, :, LOW] = np.fmin.reduce(binned_prices[:, :, :, LOW], axis=2)
+    coarse[:, :, CLOSE] = np.take_along_axis(binned_prices[:, :, :, CLOSE], last[:, :, None], axis=2)[:, :, 0]
+    coarse[~has_bar] = np.nan
+
+    coarse_volume = np.pad(volume, ((0, 0), (0, pad))).reshape(days, n_bins, interval).sum(axis=2)
+    last_minute = np.where(has_bar, bin_start_minute(np.arange(n_bins), interval)[None, :] + last, -1).astype('int16')
+
+    return coarse, coarse_volume, last_minute
@@ -0,0 +1,251 @@
+'''
+Indicator engine of step 1: the rolling indicators of the processed files (ATR_14, Avg_Volume_14d and Relative_Volume) as
+running sums over ring buffers, with two modes that give the same values:
+- compute(bars): vectorized over a whole chunk of bars (the windows continue from the state of the previous chunk)
+- update(bar) and values(): one bar at a time, O(1) per bar whatever the window (streaming mode of step 3)
+The state of the engine is a checkpoint (checkpoint()/restore(), saved as .npz by save_checkpoint), so new bars are
+appended without reading the history again.
+The values are the same as the pandas rolling().mean() of the original step 1 (float32 results): the true ranges are
+float64 differences of float32 prices and the volumes are integers, so the window sums are exact and don't depend on
+where the data was split into chunks or on the order of the additions.
+An indicator is a class with columns (the columns it outputs), compute(bars) -> {column: array}, update(bar), values() ->
+{column: value of the last bar}, state() -> {name: array} and restore(state); bars are a DataFrame (or a dict of arrays) with at least
+open, high, low, close and volume, and a bar is a dict of the same fields. Every indicator of the engine is updated in
+the same pass over the bars, so a new one (e.g. VWAP deviation, opening gap, N-day ATR on daily bars) is added to the
+list of the engine and needs no other pass over the data
+'''
+
+import os
+import numpy as np # type: ignore
+
+#sums of every run of 'window' consecutive values (len(values) - window + 1 sums), O(1) per value whatever the window:
+#the values are split into blocks of 'window' values and the window starting at i is the sum of the values from i to the
+#end of its block (suffix sums) plus the sum of the values from the start of the next block to i + window - 1 (prefix sums).
+#Each part adds at most 'window' values like a direct window sum, so exact sums stay exact (a cumulative sum over the whole
+#chunk would add up to CSV_CHUNK_ROWS values and could round)
+def window_sums(values, window):
+    n_blocks = -(-len(values) // window)
+    blocks = np.zeros(n_blocks * window, dtype=values.dtype)
+    blocks[:len(values)] = values
+    blocks = blocks.reshape(n_blocks, window)
+    prefix = np.cumsum(blocks, axis=1).ravel()
+    suffix = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+
+    start = np.arange(len(values) - window + 1)
+    return np.where(start % window == 0, suffix[start], suffix[start] + prefix[start + window - 1])
+
+#sums over a rolling window of the last 'window' values (NaN values are counted apart, the window of a NaN has no sum)
+class RollingWindow:
+    def __init__(self, window, dtype='float64'):
+        self.window = window
+        self.buffer = np.zeros(window, dtype=dtype) #ring buffer, value number 'count' is at slot count % window
+        self.count = 0
+        self.total = self.buffer.dtype.type(0).item() #sum of the non-NaN values of the window
+        self.missing = 0 #NaN values in the window
+
+    #last values in time order (at most window - 1, the ones still in the window of the next value)
+    def tail(self):
+        n = min(self.count, self.window - 1)
+        return self.buffer[np.arange(self.count - n, self.count) % self.window]
+
+    def is_full(self):
+        return self.count >= self.window
+
+    #last value added
+    def last(self):
+        return self.buffer[(self.count - 1) % self.window].item()
+
+    #add one value (python float or int)
+    def push(self, value):
+        slot = self.count % self.window
+        old = self.buffer[slot].item()
+        self.buffer[slot] = value
+        if self.buffer.dtype.kind == 'f':
+            self.total += (value if value == value else 0.0) - (old if old == old else 0.0)
+            self.missing += (value != value) - (old != old)
+        else:
+            self.total += value - old
+        self.count += 1
+
+    #add values (vectorized), returns the sums, NaN counts and full window flags of every new value
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.buffer.dtype)
+        if len(values) == 0:
+            return values.copy(), np.zeros(0, dtype='int64'), np.zeros(0, dtype=bool)
+        window = self.window
+        n_tail = min(self.count, window - 1)
+        series = np.concatenate([self.tail(), values])
+        is_nan = np.isnan(series) if self.buffer.dtype.kind == 'f' else np.zeros(len(series), dtype=bool)
+        clean = np.where(is_nan, 0, series)
+
+        sums = np.zeros(len(values), dtype=self.buffer.dtype)
+        missing = np.zeros(len(values), dtype='int64')
+        full = np.arange(self.count, self.count + len(values)) >= window - 1
+        first = window - 1 - n_tail #first new value with a full window
+        if len(series) >= window:
+            if self.buffer.dtype.kind == 'f':
+                sums[first:] = window_sums(clean, window)
+            else:
+                cumulative = np.concatenate([[0], np.cumsum(clean)])
+                sums[first:] = cumulative[window:] - cumulative[:-window]
+            nan_counts = np.concatenate([[0], np.cumsum(is_nan)])
+            missing[first:] = nan_counts[window:] - nan_counts[:-window]
+
+        #ring buffer and running sums after the new values
+        self.count += len(values)
+        kept = series[-min(self.count, window):]
+        self.buffer[np.arange(self.count - len(kept), self.count) % window] = kept
+        kept_nan = np.isnan(kept) if self.buffer.dtype.kind == 'f' else np.zeros(len(kept), dtype=bool)
+        self.total = np.where(kept_nan, 0, kept).sum().item()
+        self.missing = int(kept_nan.sum())
+
+        return sums, missing, full
+
+    def state(self):
+        return {'buffer': self.buffer.copy(), 'count': np.int64(self.count), 'total': self.total, 'missing': np.int64(self.missing)}
+
+    def restore(self, state):
+        if state['buffer'].shape != self.buffer.shape:
+            raise ValueError(f"Checkpoint window of {len(state['buffer'])} values, {self.window} expected")
+        self.buffer = state['buffer'].astype(self.buffer.dtype)
+        self.count = int(state['count'])
+        self.total = self.buffer.dtype.type(state['total']).item()
+        self.missing = int(state['missing'])
+
+#mean true range over the last 'window' bars (NaN until the window is full)
+class AverageTrueRange:
+    def __init__(self, window, column='ATR_14'):
+        self.columns = [column]
+        self.ranges = RollingWindow(window, 'float64')
+        self.prev_close = np.nan
+
+    #max of the three ranges skipping NaN (as DataFrame.max(axis=1)), the first bar has no previous close
+    @staticmethod
+    def true_range(high, low, prev_close):
+        return np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+
+    def mean(self, sums, missing, full):
+        return np.where(full & (missing == 0), sums / self.ranges.window, np.nan).astype('float32')
+
+    def compute(self, bars):
+        high, low, close = (np.asarray(bars[name], dtype='float64') for name in ('high', 'low', 'close'))
+        if len(close) == 0:
+            return {self.columns[0]: np.zeros(0, dtype='float32')}
+        true_ranges = self.true_range(high, low, np.r_[self.prev_close, close[:-1]])
+        self.prev_close = float(close[-1])
+
+        return {self.columns[0]: self.mean(*self.ranges.extend(true_ranges))}
+
+    def update(self, bar):
+        high, low, prev_close = float(bar['high']), float(bar['low']), self.prev_close
+        self.ranges.push(max([value for value in (high - low, abs(high - prev_close), abs(low - prev_close)) if value == value], default=np.nan))
+        self.prev_close = float(bar['close'])
+
+    def values(self):
+        ranges = self.ranges
+        return {self.columns[0]: float(np.float32(ranges.total / ranges.window)) if ranges.is_full() and not ranges.missing else np.nan}
+
+    def state(self):
+        return dict(self.ranges.state(), prev_close=np.float64(self.prev_close))
+
+    def restore(self, state):
+        self.ranges.restore(state)
+        self.prev_close = float(state['prev_close'])
+
+#mean volume over the last 'window' bars and the volume of the bar relative to it (NaN until the window is full)
+class RelativeVolume:
+    def __init__(self, window, average_column='Avg_Volume_14d', relative_column='Relative_Volume'):
+        self.columns = [average_column, relative_column]
+        self.volumes = RollingWindow(window, 'int64')
+
+    def compute(self, bars):
+        volume = np.asarray(bars['volume'], dtype='int64')
+        sums, _, full = self.volumes.extend(volume)
+        average = np.where(full, sums / self.volumes.window, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = volume / average
+
+        return {self.columns[0]: average.astype('float32'), self.columns[1]: relative.astype('float32')}
+
+    def update(self, bar):
+        self.volumes.push(int(bar['volume']))
+
+    def values(self):
+        if not self.volumes.is_full():
+            return {self.columns[0]: np.nan, self.columns[1]: np.nan}
+        average = self.volumes.total / self.volumes.window
+        volume = self.volumes.last()
+        relative = volume / average if average else (np.inf if volume else np.nan)
+
+        return {self.columns[0]: float(np.float32(average)), self.columns[1]: float(np.float32(relative))}
+
+    def state(self):
+        return self.volumes.state()
+
+    def restore(self, state):
+        self.volumes.restore(state)
+
+#indicators updated together over the same bars
+class IndicatorEngine:
+    def __init__(self, indicators):
+        self.indicators = list(indicators)
+
+    @property
+    def columns(self):
+        return [column for indicator in self.indicators for column in indicator.columns]
+
+    #{column: values} of a chunk of bars (oldest first), continuing the windows of the previous chunks
+    def compute(self, bars):
+        values = {}
+        for indicator in self.indicators:
+            values.update(indicator.compute(bars))
+        return values
+
+    #add one bar (dict of its fields)
+    def update(self, bar):
+        for indicator in self.indicators:
+            indicator.update(bar)
+
+    #{column: value} of the last bar
+    def values(self):
+        values = {}
+        for indicator in self.indicators:
+            values.update(indicator.values())
+        return values
+
+    #state of every indicator as flat {'<indicator number>.<name>': array}
+    def checkpoint(self):
+        return {f'{i}.{name}': value for i, indicator in enumerate(self.indicators) for name, value in indicator.state().items()}
+
+    #raises ValueError (state unchanged) if the checkpoint is of other indicators or windows
+    def restore(self, checkpoint):
+        states = [{} for _ in self.indicators]
+        for key, value in checkpoint.items():
+            i, name = key.split('.', 1)
+            if not i.isdigit() or int(i) >= len(states):
+                raise ValueError(f"Checkpoint of other indicators: {key}")
+            states[int(i)][name] = value
+        previous = [indicator.state() for indicator in self.indicators]
+        try:
+            for indicator, state in zip(self.indicators, states):
+                indicator.restore(state)
+        except (KeyError, ValueError) as e:
+            for indicator, state in zip(self.indicators, previous):
+                indicator.restore(state)
+            raise ValueError(f"Checkpoint doesn't match the indicators: {e}")
+
+#save the engine state with metadata strings (e.g. the timestamp of the last bar), written to a temporary file and swapped in
+def save_checkpoint(file_path, engine, **metadata):
+    temp_path = f'{file_path}.tmp.npz'
+    np.savez(temp_path, **engine.checkpoint(), **{f'meta.{name}': np.array(str(value)) for name, value in metadata.items()})
+    os.replace(temp_path, file_path)
+
+#(checkpoint, metadata) saved by save_checkpoint, None if there is none
+def load_checkpoint(file_path):
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as saved:
+        checkpoint = {key: saved[key] for key in saved.files if not key.startswith('meta.')}
+        metadata = {key[len('meta.'):]: str(saved[key]) for key in saved.files if key.startswith('meta.')}
+
+    return checkpoint, metadata
@@ -0,0 +1,267 @@
+'''
+Instrumentation shared by steps 1-4: leveled logging (instead of print), timers and counters around the hot paths
+(parquet reads, timezone filtering, the screen, the entry/exit scans, log writes) and optional per-stage profiling.
+Timers and counters cost almost nothing while disabled; they are enabled by asking for a report (--report, JSON with the
+totals per timer and counter) or a trace (--trace, Chrome trace event file, open it in chrome://tracing or Perfetto).
+Worker processes record their own timers and send them back with their results (worker_call / merge_worker_result).
+Profiling is switched on per stage: --profile step1 step3 --profiler cprofile (pstats file) or sampling (folded stacks)
+
+Every script takes the same options, e.g.: python step-3-run_strategy/orb_stat_main.py --log-level DEBUG --report --trace
+'''
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import cProfile
+import pstats
+import io
+from collections import Counter
+from contextlib import contextmanager
+
+STAGES = ['step1', 'step2', 'step3', 'step4']
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LOG_LEVEL = os.environ.get('ORB_LOG_LEVEL', 'INFO') #per file/ticker/day progress messages are DEBUG
+OUTPUT_FOLDER = './instrumentation' #default folder of the report, trace and profile files
+MAX_TRACE_EVENTS = 500_000 #spans kept for the trace file (the timer totals of the report keep counting after that)
+SAMPLING_INTERVAL = 0.005 #seconds between two samples of the sampling profiler
+PROFILE_TOP_FUNCTIONS = 25 #functions listed in the log at the end of a profiled stage
+
+logger = logging.getLogger('orb')
+
+_enabled = False
+_timers = {} #name -> [count, total seconds, max seconds]
+_counters = Counter()
+_spans = [] #trace events of this process
+_options = {'report': None, 'trace': None, 'profile': [], 'profiler': 'cprofile', 'log_level': LOG_LEVEL}
+
+def get_logger(name):
+    return logging.getLogger(f'orb.{name}')
+
+def configure_logging(level=LOG_LEVEL):
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+
+def is_enabled():
+    return _enabled
+
+class _Timer:
+    __slots__ = ('name', 'category', 'args', 'start', 'wall_start')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        totals = _timers.get(self.name)
+        if totals is None:
+            totals = _timers[self.name] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+        if len(_spans) < MAX_TRACE_EVENTS:
+            _spans.append({'name': self.name, 'cat': self.category, 'ph': 'X', 'ts': round(self.wall_start * 1e6, 1), 'dur': round(seconds * 1e6, 1),
+                           'pid': os.getpid(), 'tid': threading.get_ident() % 100_000, 'args': self.args})
+        return False
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer()
+
+#time a block: with timer('parquet_read', file=path): ...
+def timer(name, category='orb', **args):
+    return _Timer(name, category, args) if _enabled else _NO_TIMER
+
+#add to a counter (e.g. files, bytes and rows read)
+def count(name, value=1):
+    if _enabled:
+        _counters[name] += value
+
+#counters of a parquet read: files, bytes on disk and rows
+def count_parquet_read(paths, rows):
+    if _enabled:
+        paths = [paths] if isinstance(paths, str) else paths
+        _counters['parquet_files'] += len(paths)
+        _counters['parquet_bytes'] += sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+        _counters['parquet_rows'] += int(rows)
+
+#timers, counters and trace events recorded in this process
+def snapshot():
+    return {'timers': {name: list(totals) for name, totals in _timers.items()}, 'counters': dict(_counters), 'spans': list(_spans)}
+
+def reset():
+    _timers.clear()
+    _counters.clear()
+    _spans.clear()
+
+#add the snapshot of another process (a worker) to this one
+def merge(recorded):
+    if not recorded:
+        return
+    for name, (calls, seconds, longest) in recorded['timers'].items():
+        totals = _timers.setdefault(name, [0, 0.0, 0.0])
+        totals[0] += calls
+        totals[1] += seconds
+        totals[2] = max(totals[2], longest)
+    _counters.update(recorded['counters'])
+    _spans.extend(recorded['spans'][:max(MAX_TRACE_EVENTS - len(_spans), 0)])
+
+#settings a worker process needs to record like its parent
+def worker_settings():
+    return {'enabled': _enabled, 'log_level': logger.level or LOG_LEVEL}
+
+#run function(*args) in a worker process, returns (result, what the worker recorded) for merge_worker_result
+def worker_call(settings, function, *args):
+    enable(settings['enabled'])
+    configure_logging(settings['log_level'])
+    reset()
+    result = function(*args)
+    recorded = snapshot() if _enabled else None
+    reset()
+
+    return result, recorded
+
+def merge_worker_result(value):
+    result, recorded = value
+    merge(recorded)
+    return result
+
+#samples the stack of a thread every SAMPLING_INTERVAL seconds (collapsed stacks, as used by flame graph tools)
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=SAMPLING_INTERVAL):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    #functions with the most samples at the top of the stack
+    def top(self, n=PROFILE_TOP_FUNCTIONS):
+        leaves = Counter()
+        for stack, samples in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        return leaves.most_common(n)
+
+    def write(self, file_path):
+        with open(file_path, 'w') as f:
+            for stack, samples in self.samples.most_common():
+                f.write(f"{stack} {samples}\n")
+
+def _output_path(file_name):
+    if not os.path.exists(OUTPUT_FOLDER):
+        os.makedirs(OUTPUT_FOLDER)
+    return os.path.join(OUTPUT_FOLDER, file_name)
+
+#a pipeline stage: timed as a whole and profiled if it was selected with --profile
+@contextmanager
+def stage(name):
+    profiler = None
+    if name in _options['profile'] or 'all' in _options['profile']:
+        profiler = cProfile.Profile() if _options['profiler'] == 'cprofile' else SamplingProfiler()
+        profiler.enable() if isinstance(profiler, cProfile.Profile) else profiler.start()
+
+    try:
+        with timer(f'stage:{name}', category='stage'):
+            yield
+    finally:
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            file_path = _output_path(f'{name}.prof')
+            profiler.dump_stats(file_path)
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+            logger.info(f"Profile of {name} saved in {file_path}\n{summary.getvalue()}")
+        elif profiler is not None:
+            profiler.stop()
+            file_path = _output_path(f'{name}.folded')
+            profiler.write(file_path)
+            top = '\n'.join(f"{samples:>8} {function}" for function, samples in profiler.top())
+            logger.info(f"Sampling profile of {name} saved in {file_path} ({sum(profiler.samples.values())} samples)\n{top}")
+
+#totals of every timer and counter
+def report():
+    timers = {name: {'calls': calls, 'total_seconds': round(seconds, 6), 'max_seconds': round(longest, 6),
+                     'mean_ms': round(seconds / calls * 1000, 4) if calls else 0.0}
+              for name, (calls, seconds, longest) in sorted(_timers.items(), key=lambda item: -item[1][1])}
+
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'timers': timers, 'counters': dict(sorted(_counters.items()))}
+
+def write_report(file_path):
+    with open(file_path, 'w') as f:
+        json.dump(report(), f, indent=1)
+
+def write_chrome_trace(file_path):
+    with open(file_path, 'w') as f:
+        json.dump({'traceEvents': _spans, 'displayTimeUnit': 'ms'}, f)
+
+#command line options of the instrumentation (shared by every script)
+def add_arguments(parser):
+    parser.add_argument('--log-level', default=LOG_LEVEL, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str.upper)
+    parser.add_argument('--report', nargs='?', const=os.path.join(OUTPUT_FOLDER, 'report.json'), help='save the timers and counters as JSON')
+    parser.add_argument('--trace', nargs='?', const=os.path.join(OUTPUT_FOLDER, 'trace.json'), help='save a Chrome trace of the timed blocks')
+    parser.add_argument('--profile', nargs='*', default=[], choices=STAGES + ['all'], help='stages to profile')
+    parser.add_argument('--profiler', default='cprofile', choices=['cprofile', 'sampling'])
+
+#configure logging, timers and profiling from the command line (sys.argv if argv is None), unknown options are ignored
+def setup(argv=None, description=None):
+    parser = argparse.ArgumentParser(description=description)
+    add_arguments(parser)
+    args, _ = parser.parse_known_args(argv)
+
+    _options.update(report=args.report, trace=args.trace, profile=args.profile, profiler=args.profiler, log_level=args.log_level)
+    configure_logging(args.log_level)
+    enable(bool(args.report or args.trace))
+
+    return args
+
+#write the report and the trace asked for in setup()
+def finish():
+    for option, write in (('report', write_report), ('trace', write_chrome_trace)):
+        file_path = _options[option]
+        if file_path:
+            directory = os.path.dirname(file_path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            write(file_path)
+            logger.info(f"Instrumentation {option} saved in {file_path}")
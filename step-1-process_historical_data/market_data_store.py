@@ -0,0 +1,178 @@
+'''
+Consolidated market data store built from the processed parquet files (one file per ticker) of step 1.
+Bars of all tickers are written to one parquet file per trading date (or per month), sorted by ticker and timestamp,
+so the row group statistics let a reader skip everything except the tickers, minutes and columns it asks for.
+Use read_bars() to load the bars instead of reading the whole history of each ticker
+'''
+
+import os
+import json
+import shutil
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.compute as pc # type: ignore
+import pyarrow.parquet as pq # type: ignore
+import instrumentation # type: ignore
+from trading_calendar import get_calendar, TIMEZONE, MARKET_OPEN_MINUTE # type: ignore
+
+logger = instrumentation.get_logger('market_data_store')
+
+PROCESSED_DATA_FOLDER = './processed_data_new'
+STORE_FOLDER = './market_data_store'
+STORE_INFO_FILE = 'store_info.json'
+PARTITION_FILE = 'bars.parquet'
+PARTITION_BY = 'date' #'date' (one file per trading day) or 'month' (one file per month, fewer and bigger files)
+STORE_ROW_GROUP_ROWS = 16 * 1024 #~40 tickers of a full day per row group, small enough to skip the other tickers
+STORE_COMPRESSION = 'zstd' #'minute' column is the offset from 09:30 (09:30 = 0, 16:00 = 390)
+
+_store_info = {} #partition layout of each opened store
+
+def partition_key(date, partition_by):
+    return str(date)[:10] if partition_by == 'date' else str(date)[:7]
+
+#months (YYYY-MM) covered by a processed file, read from the parquet statistics without loading the data
+def months_in_file(file_path):
+    metadata = pq.ParquetFile(file_path).metadata
+    if metadata.num_rows == 0:
+        return set()
+    column = metadata.schema.names.index('timestamp')
+    start = pd.Timestamp(metadata.row_group(0).column(column).statistics.min)
+    end = pd.Timestamp(metadata.row_group(metadata.num_row_groups - 1).column(column).statistics.max)
+    start, end = (t.tz_localize('UTC') if t.tz is None else t for t in (start, end))
+    calendar = get_calendar()
+    first_day, last_day = calendar.date_strings(calendar.session_minutes([start.value, end.value])[0])
+
+    return {str(month) for month in pd.period_range(first_day, last_day, freq='M')}
+
+#bars of one ticker for one month (pushed down to the parquet row groups) with ticker, date and minute columns added
+def load_month(file_path, ticker, month):
+    start_ns, end_ns = get_calendar().date_range_ns(f"{month}-01", str(pd.Period(month).end_time.date()))
+    start, end = pd.Timestamp(start_ns, tz=TIMEZONE), pd.Timestamp(end_ns, tz=TIMEZONE)
+    with instrumentation.timer('parquet_read', file=file_path):
+        table = pq.read_table(file_path, filters=[('timestamp', '>=', start), ('timestamp', '<', end)])
+    instrumentation.count_parquet_read(file_path, table.num_rows)
+    if table.num_rows == 0:
+        return None
+
+    df = table.to_pandas().reset_index()
+    days, minutes = get_calendar().session_minutes(pd.DatetimeIndex(df['timestamp']).asi8)
+    df.insert(0, 'ticker', ticker)
+    df.insert(1, 'date', get_calendar().date_strings(days))
+    df.insert(3, 'minute', minutes.astype('int16'))
+
+    return df
+
+def write_partition(df, folder):
+    tmp_folder = folder + '.tmp'
+    if os.path.exists(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.makedirs(tmp_folder)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.set_column(0, 'ticker', pc.dictionary_encode(table.column('ticker')))
+    table = table.set_column(1, 'date', pc.dictionary_encode(table.column('date')))
+    pq.write_table(table, os.path.join(tmp_folder, PARTITION_FILE), row_group_size=STORE_ROW_GROUP_ROWS,
+                   compression=STORE_COMPRESSION, write_statistics=True)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp_folder, folder)
+
+#build (or rebuild) the store from the processed files
+#only the given months are rewritten (all months if None), one month of all tickers is held in memory at a time
+def build_market_data_store(months=None, processed_folder=PROCESSED_DATA_FOLDER, store_folder=STORE_FOLDER, partition_by=PARTITION_BY):
+    info_path = os.path.join(store_folder, STORE_INFO_FILE)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f)['partition_by'] != partition_by:
+                shutil.rmtree(store_folder) #layout changed, rebuild everything
+                months = None
+    os.makedirs(store_folder, exist_ok=True)
+
+    files = {f.split('.parquet')[0]: os.path.join(processed_folder, f) for f in sorted(os.listdir(processed_folder)) if f.endswith('.parquet')}
+    file_months = {ticker: months_in_file(file_path) for ticker, file_path in files.items()}
+    all_months = sorted(set().union(*file_months.values())) if file_months else []
+    months = all_months if months is None else sorted(set(months) & set(all_months))
+
+    for month in months:
+        frames = [load_month(files[ticker], ticker, month) for ticker in files if month in file_months[ticker]]
+        frames = [df for df in frames if df is not None]
+        if not frames:
+            continue
+        month_df = pd.concat(frames, ignore_index=True).sort_values(['date', 'ticker', 'timestamp'], kind='stable')
+
+        if partition_by == 'date':
+            for date, day_df in month_df.groupby('date', sort=True):
+                write_partition(day_df, os.path.join(store_folder, date))
+        else:
+            write_partition(month_df, os.path.join(store_folder, month))
+        logger.info(f"Market data store updated: {month}")
+
+    with open(info_path, 'w') as f:
+        json.dump({'partition_by': partition_by, 'row_group_rows': STORE_ROW_GROUP_ROWS}, f)
+    _store_info.pop(store_folder, None)
+
+def get_partition_by(store_folder=STORE_FOLDER):
+    if store_folder not in _store_info:
+        with open(os.path.join(store_folder, STORE_INFO_FILE)) as f:
+            _store_info[store_folder] = json.load(f)['partition_by']
+
+    return _store_info[store_folder]
+
+#trading dates available in the store
+def list_dates(store_folder=STORE_FOLDER):
+    if get_partition_by(store_folder) == 'date':
+        return sorted(name for name in os.listdir(store_folder) if os.path.isfile(os.path.join(store_folder, name, PARTITION_FILE)))
+
+    dates = set()
+    for name in sorted(os.listdir(store_folder)):
+        path = os.path.join(store_folder, name, PARTITION_FILE)
+        if os.path.isfile(path):
+            dates.update(pq.read_table(path, columns=['date']).column('date').to_pylist())
+
+    return sorted(dates)
+
+def time_to_minute(time_str):
+    hours, minutes = time_str.split(':')[:2]
+    return int(hours) * 60 + int(minutes) - MARKET_OPEN_MINUTE
+
+#read bars for the given tickers (all if None) on a date (all dates if None), between start_time and end_time ('HH:MM', inclusive)
+#ticker, date and minute filters and the column selection are pushed into the parquet scan
+#returns a DataFrame indexed by the US/Eastern timestamp with a 'ticker' column, sorted by ticker and timestamp
+def read_bars(tickers=None, date=None, start_time=None, end_time=None, columns=None, start_date=None, end_date=None, store_folder=STORE_FOLDER):
+    partition_by = get_partition_by(store_folder)
+
+    if date is not None:
+        start_date = end_date = str(date)[:10]
+    keys = sorted(name for name in os.listdir(store_folder) if os.path.isfile(os.path.join(store_folder, name, PARTITION_FILE)))
+    if start_date is not None:
+        keys = [key for key in keys if key >= partition_key(start_date, partition_by)]
+    if end_date is not None:
+        keys = [key for key in keys if key <= partition_key(end_date, partition_by)]
+    paths = [os.path.join(store_folder, key, PARTITION_FILE) for key in keys]
+
+    filters = []
+    if tickers is not None:
+        filters.append(('ticker', 'in', list(tickers)))
+    if partition_by == 'month' and start_date is not None:
+        filters.append(('date', '>=', str(start_date)[:10]))
+    if partition_by == 'month' and end_date is not None:
+        filters.append(('date', '<=', str(end_date)[:10]))
+    if start_time is not None:
+        filters.append(('minute', '>=', time_to_minute(start_time)))
+    if end_time is not None:
+        filters.append(('minute', '<=', time_to_minute(end_time)))
+
+    read_columns = None if columns is None else ['ticker', 'timestamp'] + [c for c in columns if c not in ('ticker', 'timestamp')]
+    with instrumentation.timer('parquet_read', files=len(paths)):
+        tables = [pq.read_table(path, columns=read_columns, filters=filters or None) for path in paths]
+    instrumentation.count_parquet_read(paths, sum(table.num_rows for table in tables))
+    if not tables:
+        return pd.DataFrame(columns=read_columns or ['ticker', 'timestamp']).set_index('timestamp')
+
+    df = pa.concat_tables(tables).to_pandas()
+    df['ticker'] = df['ticker'].astype(str)
+    if 'date' in df.columns:
+        df['date'] = df['date'].astype(str)
+
+    return df.set_index('timestamp')
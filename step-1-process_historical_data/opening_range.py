@@ -0,0 +1,91 @@
+'''
+Opening range table written by step 1: one row per (ticker, date) with the six opening candles (09:30 to 09:35).
+For each candle it holds OHLCV and the indicators (ATR_14, Avg_Volume_14d, Relative_Volume), so the screen of step 2
+(which takes the first candle that fits the criteria) and the long/short decision of step 3 can run off this table
+without reading the minute bars. Columns are named <field>_<HHMM>, e.g. close_0935 or Relative_Volume_0930
+'''
+
+import os
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.parquet as pq # type: ignore
+from trading_calendar import get_calendar # type: ignore
+
+OPENING_RANGE_FILE = './opening_range_table.parquet'
+OPENING_RANGE_MINUTES = 6 #09:30 to 09:35 (inclusive)
+CANDLE_LABELS = [f"09{30 + k}" for k in range(OPENING_RANGE_MINUTES)] #'0930', ..., '0935'
+CANDLE_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'ATR_14', 'Avg_Volume_14d', 'Relative_Volume']
+SUMMARY_COLUMNS = ['n_candles', 'bullish_count', 'or_high', 'or_low', 'body_high', 'body_low']
+ROW_GROUP_ROWS = 64 * 1024
+
+def candle_columns(field):
+    return [f"{field}_{label}" for label in CANDLE_LABELS]
+
+#opening range rows of one ticker from its processed bars (DataFrame indexed by the US/Eastern timestamp)
+def compute_opening_range_rows(bars, ticker):
+    days, minute = get_calendar().session_minutes(bars.index.asi8)
+    inside = (minute >= 0) & (minute < OPENING_RANGE_MINUTES)
+    bars, days, minute = bars[inside], days[inside], minute[inside]
+    first = ~bars.index.duplicated(keep='first')
+    bars, days, minute = bars[first], days[first], minute[first]
+    if bars.empty:
+        return None
+
+    candles = bars[CANDLE_FIELDS].copy()
+    candles['date'] = get_calendar().date_strings(days)
+    candles['candle'] = minute
+    wide = candles.pivot(index='date', columns='candle', values=CANDLE_FIELDS)
+    wide = wide.reindex(columns=pd.MultiIndex.from_product([CANDLE_FIELDS, range(OPENING_RANGE_MINUTES)]))
+    wide.columns = [f"{field}_{CANDLE_LABELS[k]}" for field, k in wide.columns]
+    for field in CANDLE_FIELDS: #pivot upcasts everything to float64, keep float32 for prices and indicators (volume stays float64 for missing candles)
+        if field != 'volume':
+            wide[candle_columns(field)] = wide[candle_columns(field)].astype('float32')
+
+    opens = wide[candle_columns('open')].to_numpy(dtype='float64')
+    closes = wide[candle_columns('close')].to_numpy(dtype='float64')
+    wide['n_candles'] = np.isfinite(closes).sum(axis=1)
+    wide['bullish_count'] = (closes > opens).sum(axis=1) #missing candles count as not bullish (same as the minute bar check)
+    wide['or_high'] = wide[candle_columns('high')].max(axis=1)
+    wide['or_low'] = wide[candle_columns('low')].min(axis=1)
+    wide['body_high'] = np.fmax(wide[candle_columns('open')].max(axis=1), wide[candle_columns('close')].max(axis=1))
+    wide['body_low'] = np.fmin(wide[candle_columns('open')].min(axis=1), wide[candle_columns('close')].min(axis=1))
+
+    wide = wide.reset_index()
+    wide.insert(0, 'ticker', ticker)
+
+    return wide
+
+#merge new rows into the table: rows of ticker 'ticker' from date 'replace_from' on (all of them if None) are replaced
+def update_opening_range_table(updates, table_file=OPENING_RANGE_FILE):
+    frames = []
+    if os.path.exists(table_file):
+        existing = pd.read_parquet(table_file)
+        keep = np.ones(len(existing), dtype=bool)
+        for ticker, (replace_from, _) in updates.items():
+            replaced = (existing['ticker'] == ticker).to_numpy()
+            if replace_from is not None:
+                replaced &= (existing['date'] >= replace_from).to_numpy()
+            keep &= ~replaced
+        frames.append(existing[keep])
+    frames += [rows for _, rows in updates.values() if rows is not None]
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return
+
+    table = pd.concat(frames, ignore_index=True).sort_values(['date', 'ticker'], kind='stable').reset_index(drop=True)
+    tmp_file = table_file + '.tmp'
+    pq.write_table(pa.Table.from_pandas(table, preserve_index=False), tmp_file, row_group_size=ROW_GROUP_ROWS, compression='zstd')
+    os.replace(tmp_file, table_file)
+
+#load the table (or some of its columns) for a date range, the date filter is pushed into the parquet scan
+def load_opening_range_table(columns=None, start_date=None, end_date=None, table_file=OPENING_RANGE_FILE):
+    filters = []
+    if start_date is not None:
+        filters.append(('date', '>=', str(start_date)[:10]))
+    if end_date is not None:
+        filters.append(('date', '<=', str(end_date)[:10]))
+    if columns is not None:
+        columns = ['ticker', 'date'] + [c for c in columns if c not in ('ticker', 'date')]
+
+    return pd.read_parquet(table_file, columns=columns, filters=filters or None)
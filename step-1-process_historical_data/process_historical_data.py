@@ -1,55 +1,386 @@
 '''
 This file only need to run once in the beginning or if new dataset are added in historical_data folder.
-It process all the data in the historical_data folder and store in Processed_data folder 
+It process all the data in the historical_data folder and store in Processed_data folder
+A manifest (size, mtime, content hash and last processed timestamp per ticker) is kept next to the processed files, so
+re-running it skips unchanged tickers and only processes the new bars of tickers whose raw file got new rows appended
+(the indicator windows continue from the checkpoint of indicator_engine.py saved next to the processed file)
+Raw files are read in chunks of CSV_CHUNK_ROWS rows, so peak memory depends on the chunk size and not on the file size
 '''
 
 import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd # type: ignore
 import numpy as np # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.parquet as pq # type: ignore
+from market_data_store import build_market_data_store, STORE_FOLDER # type: ignore
+from opening_range import compute_opening_range_rows, update_opening_range_table, OPENING_RANGE_FILE, OPENING_RANGE_MINUTES # type: ignore
+from trading_calendar import get_calendar, TIMEZONE, SESSION_MINUTES, FULL_DAY_CLOSE_MINUTE, MINUTE_NS # type: ignore
+from bar_cube import build_bar_cube, bar_cube_versions, CUBE_FOLDER # type: ignore
+from arrow_data_plane import build_arrow_data_plane, open_arrow_data_plane, ARROW_DATA_FILE # type: ignore
+from indicator_engine import IndicatorEngine, AverageTrueRange, RelativeVolume, save_checkpoint, load_checkpoint # type: ignore
+import instrumentation # type: ignore
+
+logger = instrumentation.get_logger('step1')
 
 RAW_DATA_FOLDER = './historical_data_new'
 PROCESSED_DATA_FOLDER = './processed_data_new'
+MANIFEST_FILE = os.path.join(PROCESSED_DATA_FOLDER, 'manifest.json')
+CHECKPOINT_SUFFIX = '.indicators.npz' #state of the indicator windows after the last processed bar of a ticker
+USE_PROCESS_POOL = True #spread the tickers across all cores (set False to process one file at a time)
+NUM_WORKERS = os.cpu_count()
+
+#raw csv ingestion and parquet output
+CSV_CHUNK_ROWS = 250_000 #rows parsed at a time (~25 MB of typed data per chunk, lower it to reduce peak memory)
+ROW_GROUP_ROWS = 64 * 1024 #rows per parquet row group
+PARQUET_COMPRESSION = 'zstd' #any codec supported by pyarrow ('snappy', 'gzip', 'zstd', 'lz4', 'none')
+RAW_DTYPES = {'open': 'float32', 'high': 'float32', 'low': 'float32', 'close': 'float32', 'volume': 'float64'} #volume is parsed as float (raw files may write 1234.0) and stored as int64
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+INDICATOR_COLUMNS = ['ATR_14', 'Avg_Volume_14d', 'Relative_Volume']
+OUTPUT_COLUMNS = PRICE_COLUMNS + ['volume'] + INDICATOR_COLUMNS #only the columns read by step 2 and 3 (+ high/low needed to continue the ATR)
+BUILD_OPENING_RANGE_TABLE = True #also update the opening range table (opening_range.py) used for the screen and the long/short decision
+BUILD_MARKET_DATA_STORE = True #also update the consolidated store (market_data_store.py) read by step 2 and 3
+BUILD_BAR_CUBE = False #also update the memory-mapped day x minute bar cube (bar_cube.py) read by step 3
+BUILD_ARROW_DATA_PLANE = False #also rewrite the memory-mapped Arrow file of all the bars (arrow_data_plane.py) shared by the worker processes of step 3
+OUTPUT_FORMAT_VERSION = 2 #bump when the processed file layout changes, so the manifest forces a rebuild
+
+#rolling windows used by the indicators (14 bars for ATR and 14 days of 390 bars for the average volume)
+ATR_WINDOW = 14
+VOLUME_WINDOW = 14*390
+HISTORY_BARS = max(ATR_WINDOW, VOLUME_WINDOW) #bars of already processed data needed to continue the rolling windows
+
+#module constants read by the worker processes, passed to them when the pool starts (a spawned worker imports this module
+#again and would otherwise run with the defaults and not with the values set by e.g. run_pipeline.py)
+WORKER_CONSTANTS = ['RAW_DATA_FOLDER', 'PROCESSED_DATA_FOLDER', 'CHECKPOINT_SUFFIX', 'CSV_CHUNK_ROWS', 'ROW_GROUP_ROWS', 'PARQUET_COMPRESSION',
+                    'RAW_DTYPES', 'OUTPUT_COLUMNS', 'OUTPUT_FORMAT_VERSION', 'ATR_WINDOW', 'VOLUME_WINDOW', 'HISTORY_BARS']
+POOL_START_METHOD = None #start method of the worker processes: 'fork', 'spawn' or 'forkserver' (None for the platform default)
+
+def worker_constants():
+    return {name: globals()[name] for name in WORKER_CONSTANTS}
+
+#initializer of the worker processes
+def set_worker_constants(constants):
+    globals().update(constants)
+
+#indicator engine of the processed files: ATR, Average Volume & Relative Volume (add indicators to the list and their
+#columns to OUTPUT_COLUMNS)
+def indicator_engine():
+    return IndicatorEngine([AverageTrueRange(ATR_WINDOW, 'ATR_14'), RelativeVolume(VOLUME_WINDOW, 'Avg_Volume_14d', 'Relative_Volume')])
 
 #calculate ATR, Average Volume & Relative Volume
-def calculate_indicators(df):
-    df['high_low'] = df['high'] - df['low']
-    df['high_close'] = np.abs(df['high'] - df['close'].shift())
-    df['low_close'] = np.abs(df['low'] - df['close'].shift())
-    df['true_range'] = df[['high_low', 'high_close', 'low_close']].max(axis=1)
-    df['ATR_14'] = df['true_range'].rolling(window=14).mean()
-    df['Avg_Volume_14d'] = df['volume'].rolling(window=14*390).mean()
-    df['Relative_Volume'] = df['volume'] / df['Avg_Volume_14d']
+#history is the tail of the already processed bars (if any), it is only used to carry the rolling windows over and is not returned
+#(process_ticker keeps one engine across chunks and runs instead)
+def calculate_indicators(df, history=None):
+    engine = indicator_engine()
+    if history is not None and len(history):
+        engine.compute(history)
+
+    return df.assign(**engine.compute(df))
+
+#hash of the first 'size' bytes of a file (whole file if size is None)
+def file_hash(file_path, size=None):
+    sha = hashlib.sha256()
+    remaining = size if size is not None else float('inf')
+    with open(file_path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(int(min(1 << 20, remaining)))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+
+    return sha.hexdigest()
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE) as f:
+        return json.load(f)
+
+def save_manifest(manifest):
+    tmp_file = MANIFEST_FILE + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, MANIFEST_FILE) #replace in one step so an interrupted run never leaves a broken manifest
+
+#version of the processed bars of every ticker of the manifest (rows, last bar and hash of the raw file), recorded by the
+#bar cube and the Arrow data plane so step 3 only reads them while they hold the bars of the last run
+def processed_data_versions(manifest=None):
+    manifest = load_manifest() if manifest is None else manifest
+    return {ticker: f"{entry['rows']}|{entry['last_timestamp']}|{entry['source_hash']}" for ticker, entry in manifest.items()}
+
+#parse raw timestamps to UTC (ISO strings are parsed with a fixed format which is much faster than inferring it per chunk)
+def parse_timestamps(timestamps):
+    if timestamps.dtype == object:
+        try:
+            return pd.to_datetime(timestamps, utc=True, format='ISO8601')
+        except ValueError:
+            pass
+
+    return pd.to_datetime(timestamps, utc=True)
+
+#read raw bars in chunks of CSV_CHUNK_ROWS (whole file, or only the rows appended after byte 'offset') and keep the trading hours
+def iter_raw_chunks(raw_file_path, offset=0):
+    with open(raw_file_path) as f:
+        columns = f.readline().strip().split(',')
+        if offset > 0:
+            f.seek(offset)
+        reader = pd.read_csv(f, names=columns, header=None, usecols=['timestamp'] + list(RAW_DTYPES), dtype=RAW_DTYPES, chunksize=CSV_CHUNK_ROWS)
+
+        for chunk in reader:
+            instrumentation.count('raw_rows', len(chunk))
+            with instrumentation.timer('timezone_filter'):
+                # Convert 'timestamp' to int64 epoch (ns) and keep the trading hours (09:30 to 16:00 inclusive) by their offset from 09:30
+                epoch_ns = parse_timestamps(chunk['timestamp']).astype('int64').to_numpy()
+                _, offsets = get_calendar().open_offsets_ns(epoch_ns)
+                keep = (offsets >= 0) & (offsets <= FULL_DAY_CLOSE_MINUTE * MINUTE_NS)
+
+                index = pd.DatetimeIndex(epoch_ns[keep], name='timestamp').tz_localize('UTC').tz_convert(TIMEZONE)
+                df = pd.DataFrame({column: chunk[column].to_numpy()[keep] for column in PRICE_COLUMNS}, index=index)
+                df['volume'] = chunk['volume'].to_numpy()[keep].round().astype('int64')
+            yield df
+
+#last 'n_rows' of a processed file, reading only the row groups at the end
+def read_processed_tail(processed_file_path, n_rows):
+    parquet_file = pq.ParquetFile(processed_file_path)
+    row_groups = []
+    rows = 0
+    for i in reversed(range(parquet_file.num_row_groups)):
+        row_groups.insert(0, i)
+        rows += parquet_file.metadata.row_group(i).num_rows
+        if rows >= n_rows:
+            break
+
+    with instrumentation.timer('parquet_read', file=processed_file_path):
+        tail = parquet_file.read_row_groups(row_groups).to_pandas().iloc[-n_rows:]
+    instrumentation.count_parquet_read(processed_file_path, rows)
+
+    return tail
+
+#restore the indicator windows saved after the bar of last_timestamp, False if there is no such checkpoint
+def restore_indicators(engine, checkpoint_file_path, last_timestamp):
+    saved = load_checkpoint(checkpoint_file_path)
+    if saved is None or saved[1].get('last_timestamp') != str(last_timestamp):
+        return False
+    try:
+        engine.restore(saved[0])
+    except ValueError as e: #windows changed since the checkpoint
+        logger.debug(f"Indicator checkpoint not used ({checkpoint_file_path}): {e}")
+        return False
+
+    return True
 
-    return df
+#decide what has to be done for a raw file: 'skip', 'append' (only new rows) or 'full' (rebuild)
+def plan_update(raw_file_path, processed_file_path, entry):
+    stat = os.stat(raw_file_path)
+    if not entry or entry.get('format') != OUTPUT_FORMAT_VERSION or not os.path.exists(processed_file_path):
+        return 'full'
+    if stat.st_size == entry['source_size'] and stat.st_mtime_ns == entry['source_mtime']:
+        return 'skip'
+    if stat.st_size == entry['source_size'] and file_hash(raw_file_path) == entry['source_hash']:
+        return 'skip' #touched but same content
+    if stat.st_size > entry['source_size'] and file_hash(raw_file_path, entry['source_size']) == entry['source_hash']:
+        with open(raw_file_path, 'rb') as f:
+            f.seek(entry['source_size'] - 1)
+            if f.read(1) == b'\n': #old content ends on a full row, so the new bytes are whole rows
+                return 'append'
+
+    return 'full'
+
+#bars from 09:30 to 09:35
+def opening_bars(bars):
+    _, minute = get_calendar().session_minutes(bars.index.asi8)
+    return bars[(minute >= 0) & (minute < OPENING_RANGE_MINUTES)]
+
+#process a single raw file, returns (ticker, action, manifest entry, opening range update)
+#the opening range update is (first date to replace or None for all dates, new rows) and is None if nothing changed
+def process_ticker(file, entry=None, rebuild_opening_range=False):
+    with instrumentation.timer('process_ticker', file=file):
+        return _process_ticker(file, entry, rebuild_opening_range)
+
+def _process_ticker(file, entry, rebuild_opening_range):
+    ticker = file.replace('_1_min_data.csv', '')
+    raw_file_path = os.path.join(RAW_DATA_FOLDER, file)
+    processed_file_path = os.path.join(PROCESSED_DATA_FOLDER, f"{ticker}.parquet")
+
+    action = plan_update(raw_file_path, processed_file_path, entry)
+    stat = os.stat(raw_file_path)
+
+    if action == 'skip':
+        opening_range_update = None
+        if rebuild_opening_range: #table is missing, rebuild it from the processed file
+            opening_range_update = (None, compute_opening_range_rows(opening_bars(pd.read_parquet(processed_file_path)), ticker))
+        return ticker, action, dict(entry, source_mtime=stat.st_mtime_ns), opening_range_update
+
+    # Stream the processed bars into a temporary file, row group by row group, and replace the old file at the end
+    tmp_file_path = processed_file_path + '.tmp'
+    writer = None
+    rows = 0
+    last_timestamp = None
+    engine = indicator_engine()
+    checkpoint_file_path = os.path.join(PROCESSED_DATA_FOLDER, f"{ticker}{CHECKPOINT_SUFFIX}")
+    opening_range_bars = [] #09:30 - 09:35 bars of the new data (small, ~6 rows per day)
+    replace_from = None
+
+    try:
+        if action == 'append':
+            #copy the already processed bars and continue the indicators from the checkpoint (or from their tail)
+            existing = pq.ParquetFile(processed_file_path)
+            writer = pq.ParquetWriter(tmp_file_path, existing.schema_arrow, compression=PARQUET_COMPRESSION)
+            for batch in existing.iter_batches(batch_size=ROW_GROUP_ROWS):
+                writer.write_batch(batch)
+            rows = existing.metadata.num_rows
+            last_timestamp = pd.Timestamp(entry['last_timestamp']) if entry['last_timestamp'] else None
+            #indicator windows from the checkpoint of the last run, from the tail of the processed bars if it's missing or stale
+            restored = restore_indicators(engine, checkpoint_file_path, entry['last_timestamp'])
+            history = read_processed_tail(processed_file_path, SESSION_MINUTES if restored else HISTORY_BARS)
+            if not restored:
+                engine.compute(history)
+            if last_timestamp is not None:
+                #the first new day may have started in the old data, so its opening range is rebuilt with the old candles
+                replace_from = last_timestamp.strftime('%Y-%m-%d')
+                history_days, _ = get_calendar().session_minutes(history.index.asi8)
+                opening_range_bars.append(opening_bars(history[history_days == get_calendar().day_number(replace_from)]))
+
+        for bars in iter_raw_chunks(raw_file_path, offset=entry['source_size'] if action == 'append' else 0):
+            if last_timestamp is not None:
+                bars = bars[bars.index > last_timestamp] #in case the appended rows overlap the processed ones
+            if bars.empty:
+                continue
+
+            # Calculate ATR for trading hours and update Dataframe
+            with instrumentation.timer('indicators'):
+                bars = bars.assign(**engine.compute(bars))[OUTPUT_COLUMNS]
+
+            with instrumentation.timer('parquet_write'):
+                table = pa.Table.from_pandas(bars, schema=writer.schema if writer else None, preserve_index=True)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_file_path, table.schema, compression=PARQUET_COMPRESSION)
+                writer.write_table(table, row_group_size=ROW_GROUP_ROWS)
+            instrumentation.count('processed_rows', len(bars))
+
+            opening_range_bars.append(opening_bars(bars))
+            rows += len(bars)
+            last_timestamp = bars.index[-1]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None: #no trading hours bars at all
+        pd.DataFrame(columns=OUTPUT_COLUMNS, index=pd.DatetimeIndex([], name='timestamp', tz=TIMEZONE)).to_parquet(tmp_file_path)
+    os.replace(tmp_file_path, processed_file_path)
+    if last_timestamp is not None:
+        save_checkpoint(checkpoint_file_path, engine, last_timestamp=last_timestamp)
+    elif os.path.exists(checkpoint_file_path):
+        os.remove(checkpoint_file_path)
+
+    new_entry = {
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime_ns,
+        'source_hash': file_hash(raw_file_path, stat.st_size),
+        'last_timestamp': str(last_timestamp) if last_timestamp is not None else None,
+        'rows': rows,
+        'format': OUTPUT_FORMAT_VERSION
+    }
+
+    if rebuild_opening_range and action == 'append': #table is missing, the old days are needed too
+        replace_from = None
+        opening_range_bars = [opening_bars(pd.read_parquet(processed_file_path))]
+    opening_range_rows = compute_opening_range_rows(pd.concat(opening_range_bars), ticker) if opening_range_bars else None
+
+    return ticker, action, new_entry, (replace_from, opening_range_rows)
 
 def preprocess_historical_data():
     if not os.path.exists(PROCESSED_DATA_FOLDER):
         os.makedirs(PROCESSED_DATA_FOLDER)
 
-    for file in os.listdir(RAW_DATA_FOLDER):
-        if file.endswith('_1_min_data.csv'):
-            ticker = file.replace('_1_min_data.csv', '')
-            raw_file_path = os.path.join(RAW_DATA_FOLDER, file)
-            processed_file_path = os.path.join(PROCESSED_DATA_FOLDER, f"{ticker}.parquet")
+    manifest = load_manifest()
+    files = sorted(file for file in os.listdir(RAW_DATA_FOLDER) if file.endswith('_1_min_data.csv'))
+    changed_months = set() #months of the store that have to be rewritten
+    full_rebuild = False
+    changed_tickers = [] #tickers with new or rewritten bars
+    opening_range_updates = {}
+    rebuild_opening_range = BUILD_OPENING_RANGE_TABLE and not os.path.exists(OPENING_RANGE_FILE)
+
+    def handle_result(ticker, action, entry, opening_range_update):
+        nonlocal full_rebuild
+        previous = manifest.get(ticker)
+        manifest[ticker] = entry
+        if opening_range_update is not None:
+            opening_range_updates[ticker] = opening_range_update
+        if action != 'skip':
+            changed_tickers.append(ticker)
+        if action == 'full':
+            full_rebuild = True
+        elif action == 'append' and previous['last_timestamp'] and entry['last_timestamp']:
+            start = pd.Timestamp(previous['last_timestamp']).tz_localize(None)
+            end = pd.Timestamp(entry['last_timestamp']).tz_localize(None)
+            changed_months.update(str(month) for month in pd.period_range(start, end, freq='M'))
 
+        instrumentation.count(f'tickers_{action}')
+        if action == 'skip':
+            logger.debug(f"Unchanged, skipped: {ticker}")
+        elif action == 'append':
+            logger.debug(f"Processed new bars and saved: {ticker}")
+        else:
+            logger.debug(f"Processed and saved: {ticker}")
+
+    if USE_PROCESS_POOL and NUM_WORKERS and NUM_WORKERS > 1:
+        settings = instrumentation.worker_settings()
+        context = multiprocessing.get_context(POOL_START_METHOD) if POOL_START_METHOD else None
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS, mp_context=context, initializer=set_worker_constants, initargs=(worker_constants(),)) as executor:
+            futures = {executor.submit(instrumentation.worker_call, settings, process_ticker, file, manifest.get(file.replace('_1_min_data.csv', '')), rebuild_opening_range): file
+                       for file in files}
+            for future in as_completed(futures):
+                ticker = futures[future].replace('_1_min_data.csv', '')
+                try:
+                    handle_result(*instrumentation.merge_worker_result(future.result()))
+                except Exception as e:
+                    manifest.pop(ticker, None) #rebuild this ticker on the next run
+                    logger.error(f"Error processing {ticker}: {e}")
+    else:
+        for file in files:
+            ticker = file.replace('_1_min_data.csv', '')
             try:
-                # Load raw CSV
-                df = pd.read_csv(raw_file_path, parse_dates=['timestamp'])
+                handle_result(*process_ticker(file, manifest.get(ticker), rebuild_opening_range))
+            except Exception as e:
+                manifest.pop(ticker, None)
+                logger.error(f"Error processing {ticker}: {e}")
 
-                # Convert 'timestamp' to timezone-aware and set as index
-                df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert('US/Eastern')
-                df.set_index('timestamp', inplace=True)
+    save_manifest(manifest)
+    logger.info(f"Processed {len(changed_tickers)} of {len(files)} raw files ({len(files) - len(changed_tickers)} unchanged)")
 
-                # Filter trading hours
-                trading_hours = df.between_time('09:30', '16:00').copy()
+    if BUILD_OPENING_RANGE_TABLE and opening_range_updates:
+        with instrumentation.timer('opening_range_table'):
+            update_opening_range_table(opening_range_updates)
 
-                # Calculate ATR for trading hours and update Dataframe
-                trading_hours = calculate_indicators(trading_hours)
+    if BUILD_MARKET_DATA_STORE and (full_rebuild or changed_months or not os.path.exists(STORE_FOLDER)):
+        with instrumentation.timer('market_data_store'):
+            build_market_data_store(months=changed_months if changed_months and not full_rebuild and os.path.exists(STORE_FOLDER) else None,
+                                    processed_folder=PROCESSED_DATA_FOLDER)
 
-                # Save in Parquet format
-                trading_hours.to_parquet(processed_file_path)
-                print(f"Processed and saved: {ticker}")
-            except Exception as e:
-                print(f"Error processing {ticker}: {e}")
+    if BUILD_BAR_CUBE:
+        #cubes of the changed tickers and of the tickers whose cube is missing or older than their processed bars
+        versions = processed_data_versions(manifest)
+        cube_versions = bar_cube_versions() if os.path.exists(CUBE_FOLDER) else {}
+        tickers = sorted(set(changed_tickers) | {ticker for ticker, version in versions.items() if cube_versions.get(ticker) != version})
+        if tickers:
+            with instrumentation.timer('bar_cube'):
+                build_bar_cube(tickers, processed_folder=PROCESSED_DATA_FOLDER, versions=versions)
+
+    if BUILD_ARROW_DATA_PLANE:
+        #rewritten when a ticker changed or the file is missing or older than the processed bars
+        versions = processed_data_versions(manifest)
+        data_plane = open_arrow_data_plane()
+        if changed_tickers or data_plane is None or data_plane.versions != versions:
+            with instrumentation.timer('arrow_data_plane'):
+                build_arrow_data_plane(sorted(manifest), processed_folder=PROCESSED_DATA_FOLDER, versions=versions)
 
-preprocess_historical_data()
+if __name__ == "__main__":
+    instrumentation.setup(description='Process the raw 1-minute files')
+    with instrumentation.stage('step1'):
+        preprocess_historical_data()
+    instrumentation.finish()
@@ -0,0 +1,142 @@
+'''
+Trading calendar shared by all steps: every calendar day from CALENDAR_START to CALENDAR_END with the epoch of its
+US/Eastern midnight, whether it is a session (weekday that isn't an exchange holiday), and for sessions the half-day
+flag (13:00 close) and the cut points as minute offsets from 09:30: close (390 or 210) and end of the trading window
+(15:55 = 385 or 12:55 = 205). Bars are located with integer arithmetic on their UTC epoch (day by searchsorted on the
+midnights, offset by subtraction of the day's 09:30 epoch), so slicing a day or a time window needs no timezone conversion.
+Offsets are exact from 03:00 on (clocks change at 02:00), which covers the trading hours and the extended hours.
+Holidays and half days follow the NYSE rules (observed holidays, Juneteenth from 2022, early close on July 3, the day
+after Thanksgiving and Christmas Eve when they fall on Monday to Thursday) plus the SPECIAL_CLOSURES
+'''
+
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+from pandas.tseries.holiday import (AbstractHolidayCalendar, Holiday, GoodFriday, USMartinLutherKingJr, USPresidentsDay, USMemorialDay, # type: ignore
+                                    USLaborDay, USThanksgivingDay, nearest_workday, sunday_to_monday)
+
+TIMEZONE = 'US/Eastern'
+CALENDAR_START = '2000-01-01'
+CALENDAR_END = '2040-12-31'
+MARKET_OPEN_MINUTE = 9*60 + 30 #09:30 in minutes since midnight, minute offsets are counted from it
+SESSION_MINUTES = 391 #09:30 to 16:00 inclusive, minute 0 is 09:30
+ENTRY_START_MINUTE = 5 #09:35
+FULL_DAY_CLOSE_MINUTE = 390 #16:00
+HALF_DAY_CLOSE_MINUTE = 210 #13:00
+FULL_DAY_END_MINUTE = 385 #15:55, end of the trading window
+HALF_DAY_END_MINUTE = 205 #12:55
+SPECIAL_CLOSURES = ['2001-09-11', '2001-09-12', '2001-09-13', '2001-09-14', '2004-06-11', '2007-01-02', '2012-10-29', '2012-10-30',
+                    '2018-12-05', '2025-01-09'] #closures outside the holiday rules
+MINUTE_NS = 60 * 10**9
+
+class ExchangeHolidayCalendar(AbstractHolidayCalendar):
+    rules = [
+        Holiday('New Years Day', month=1, day=1, observance=sunday_to_monday), #not observed on Friday when it falls on a Saturday
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+        Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas', month=12, day=25, observance=nearest_workday)
+    ]
+
+#early closes (13:00) between two dates: July 3, the day after Thanksgiving and December 24 when they are Monday to Thursday
+def half_day_dates(start, end):
+    days = pd.date_range(start, end, freq='D')
+    thanksgiving = pd.DatetimeIndex(USThanksgivingDay.dates(start, end))
+    july_3 = (days.month == 7) & (days.day == 3) & (days.weekday < 4)
+    christmas_eve = (days.month == 12) & (days.day == 24) & (days.weekday < 4)
+
+    return days[july_3 | christmas_eve].union(thanksgiving + pd.Timedelta(days=1))
+
+class TradingCalendar:
+    def __init__(self, start=CALENDAR_START, end=CALENDAR_END):
+        days = pd.date_range(start, end, freq='D')
+        self.first_day = days[0].to_datetime64().astype('datetime64[D]')
+        opens = days + pd.Timedelta(minutes=MARKET_OPEN_MINUTE)
+        self.midnight_ns = days.tz_localize(TIMEZONE).asi8 #epoch (ns) of the US/Eastern midnight of every day
+        self.open_ns = opens.tz_localize(TIMEZONE).asi8 #epoch (ns) of 09:30 of every day
+        self.naive_open_ns = opens.asi8 #same without the UTC offset (naive local timestamps)
+        self.end_ns = (days[-1] + pd.Timedelta(days=1)).tz_localize(TIMEZONE).value
+        self.dates = np.datetime_as_string(days.to_numpy(), unit='D').astype(object)
+
+        holidays = ExchangeHolidayCalendar().holidays(start, end).union(pd.DatetimeIndex(SPECIAL_CLOSURES))
+        self.is_session = (days.weekday < 5) & ~days.isin(holidays)
+        self.half_day = self.is_session & days.isin(half_day_dates(start, end))
+        self.close_minute = np.where(self.half_day, HALF_DAY_CLOSE_MINUTE, FULL_DAY_CLOSE_MINUTE)
+        self.end_minute = np.where(self.half_day, HALF_DAY_END_MINUTE, FULL_DAY_END_MINUTE)
+
+    #day number (days since the first day of the calendar) of dates ('YYYY-MM-DD', date or timestamp)
+    def day_number(self, date):
+        day = int((np.datetime64(str(date)[:10], 'D') - self.first_day).astype(int))
+        if day < 0 or day >= len(self.dates):
+            raise ValueError(f"{date} is outside the trading calendar ({self.dates[0]} to {self.dates[-1]})")
+        return day
+
+    #day numbers and nanoseconds since 09:30 (negative before the open) of UTC epochs (ns)
+    def open_offsets_ns(self, epoch_ns):
+        epoch_ns = np.asarray(epoch_ns, dtype='int64')
+        if epoch_ns.size and (epoch_ns.min() < self.midnight_ns[0] or epoch_ns.max() >= self.end_ns):
+            raise ValueError(f"Timestamps outside the trading calendar ({self.dates[0]} to {self.dates[-1]})")
+        days = np.searchsorted(self.midnight_ns, epoch_ns, side='right') - 1
+
+        return days, epoch_ns - self.open_ns[days]
+
+    #day numbers and minute offsets from 09:30 (0 = 09:30, 390 = 16:00) of UTC epochs (ns)
+    def session_minutes(self, epoch_ns):
+        days, offsets = self.open_offsets_ns(epoch_ns)
+        return days, offsets // MINUTE_NS
+
+    #naive US/Eastern timestamps (datetime64[ns]) of UTC epochs (ns)
+    def local_naive(self, epoch_ns):
+        days, offsets = self.open_offsets_ns(epoch_ns)
+        return (self.naive_open_ns[days] + offsets).view('datetime64[ns]')
+
+    #offset (ns) from 09:30 of a time of day ('HH:MM:SS')
+    @staticmethod
+    def time_offset_ns(time):
+        return pd.Timedelta(time).value - MARKET_OPEN_MINUTE * MINUTE_NS
+
+    def date_strings(self, days):
+        return self.dates[days]
+
+    def is_half_day(self, date):
+        return bool(self.half_day[self.day_number(date)])
+
+    #last minute a trade can stay open on the date (15:55, 12:55 on half days)
+    def session_end_minute(self, date):
+        return int(self.end_minute[self.day_number(date)])
+
+    #trading sessions between two dates (inclusive) as 'YYYY-MM-DD'
+    def sessions(self, start_date, end_date):
+        first, last = self.day_number(start_date), self.day_number(end_date)
+        return self.dates[first:last + 1][self.is_session[first:last + 1]].tolist()
+
+    #UTC epochs (ns) of the US/Eastern midnight of start_date and of the day after end_date (bars of the dates are in [start, end))
+    def date_range_ns(self, start_date, end_date):
+        return int(self.midnight_ns[self.day_number(start_date)]), int(self.midnight_ns[self.day_number(end_date) + 1])
+
+    #UTC epoch (ns) of a minute offset on the date
+    def minute_epoch_ns(self, date, minute):
+        return int(self.open_ns[self.day_number(date)]) + int(minute) * MINUTE_NS
+
+    #tz-aware (US/Eastern) timestamp of a minute offset on the date
+    def minute_to_timestamp(self, date, minute):
+        return pd.Timestamp(self.minute_epoch_ns(date, minute), tz=TIMEZONE)
+
+    #positions (start, stop) of the bars of the date from first_minute to last_minute (inclusive) in sorted UTC epochs (ns)
+    def minute_range(self, epoch_ns, date, first_minute=0, last_minute=SESSION_MINUTES - 1):
+        start = np.searchsorted(epoch_ns, self.minute_epoch_ns(date, first_minute), side='left')
+        stop = np.searchsorted(epoch_ns, self.minute_epoch_ns(date, last_minute), side='right')
+        return int(start), int(stop)
+
+_calendar = None
+
+#calendar of the process (built on first use)
+def get_calendar():
+    global _calendar
+    if _calendar is None:
+        _calendar = TradingCalendar()
+    return _calendar
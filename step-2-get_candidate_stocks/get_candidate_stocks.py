@@ -2,8 +2,19 @@
 
 import os
 import pandas as pd # type: ignore
-from datetime import datetime
-import pytz # type: ignore
+import pyarrow.parquet as pq # type: ignore
+import sys
+from screener import screen_bars, screen_opening_range, rank_top_stocks, StreamingTopK, SCREEN_COLUMNS, OUTPUT_COLUMNS # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+from market_data_store import read_bars, list_dates, STORE_FOLDER # type: ignore
+from opening_range import OPENING_RANGE_FILE, CANDLE_LABELS # type: ignore
+from trading_calendar import get_calendar # type: ignore
+from arrow_data_plane import open_arrow_data_plane # type: ignore
+from process_historical_data import processed_data_versions # type: ignore
+import instrumentation # type: ignore
+
+logger = instrumentation.get_logger('step2')
 
 #conditions for filtering stocks
 MIN_OPEN_PRICE = 5.0
@@ -11,80 +22,149 @@ MIN_AVG_VOLUME = 10000
 MIN_ATR = 0.5
 MIN_RELATIVE_VOLUME = 2.0
 TOP_STOCKS_COUNT = 20 #max 20 stocks for a certain trading day
+SCREEN_CRITERIA = {'open': MIN_OPEN_PRICE, 'Avg_Volume_14d': MIN_AVG_VOLUME, 'ATR_14': MIN_ATR, 'Relative_Volume': MIN_RELATIVE_VOLUME} #column -> minimum value
 
 #folders and trading hours
 data_folder = './processed_data_new'
+USE_OPENING_RANGE_TABLE = True #screen the stocks off the opening range table of step 1 (if it exists), no minute bars are read
+USE_MARKET_DATA_STORE = True #read only the opening minutes from the consolidated store of step 1 (if it exists) instead of every ticker's file
+USE_ARROW_DATA_PLANE = True #read the opening minutes from the memory-mapped Arrow file of step 1 (if it was built and holds the bars of the last step 1 run) instead of the store or the files
+USE_STREAMING_TOP_K = False #screen in batches and keep only the running top stocks of each day (bounded memory for very large universes)
+SCREEN_BATCH_TICKERS = 250 #ticker files screened at a time
+SCREEN_BATCH_ROWS = 100_000 #opening range rows screened at a time
 start_time = '09:30:00'
 end_time = '09:35:00' #end time is 9:35, so that we only choose those stocks which fits our criteria in the first 5 mins
 start_date = '2022-11-30' #date that fits all dataset after calculating all the indicatros ATR, 14_day_avg and Relative Volume
 end_date = '2024-11-27' #end date for our dataset
 
 #load and filter data
-def load_filtered_data(file_path):
+def load_filtered_data(file_path, columns=None):
     #df = pd.read_csv(file_path, parse_dates=['timestamp']) #this format will work for .csv not for .parquet
 
     #for .parquet file and since 'timestamp' is a index and not a regular columns
-    df = pd.read_parquet(file_path)
-    df['timestamp'] = df.index
-    
-    # Define start and end timestamps dynamically in 'America/New_York'
-    eastern = pytz.timezone('America/New_York')
-    start_timestamp = eastern.localize(pd.Timestamp(f"{start_date} 09:30:00"))
-    end_timestamp = eastern.localize(pd.Timestamp(f"{end_date} 09:35:00"))
-
-    #filter by date and time
-    df = df[(df['timestamp'] >= start_timestamp) & (df['timestamp'] <= end_timestamp)]
-
-    #ensure 'timestamp' is in datetime format without the last UTC part (-5:00)
-    df['timestamp'] = pd.to_datetime(df['timestamp'], utc=True).dt.tz_convert('America/New_York').dt.tz_localize(None)
-    df = df[df['timestamp'].dt.time.between(datetime.strptime(start_time, '%H:%M:%S').time(), datetime.strptime(end_time, '%H:%M:%S').time())]
+    with instrumentation.timer('parquet_read', file=file_path):
+        df = pd.read_parquet(file_path, columns=columns)
+    instrumentation.count_parquet_read(file_path, len(df))
+
+    return filter_screen_window(df)
+
+#bars between start_date and end_date and between start_time and end_time (US/Eastern) with a naive 'timestamp' column
+def filter_screen_window(df):
+    with instrumentation.timer('timezone_filter'):
+        #filter by date and time of day (US/Eastern) with the day numbers and offsets from 09:30 of the trading calendar
+        calendar = get_calendar()
+        epoch_ns = df.index.asi8
+        days, offsets = calendar.open_offsets_ns(epoch_ns)
+        keep = ((days >= calendar.day_number(start_date)) & (days <= calendar.day_number(end_date))
+                & (offsets >= calendar.time_offset_ns(start_time)) & (offsets <= calendar.time_offset_ns(end_time)))
+        #'timestamp' as naive US/Eastern time (without the UTC offset)
+        df = df[keep].assign(timestamp=calendar.local_naive(epoch_ns[keep]))
 
     return df
 
-#select top stocks that fits the above criteria
-def select_top_stocks(df,ticker):
-    df = df[(df['open'] >= MIN_OPEN_PRICE) & (df['Avg_Volume_14d'] >= MIN_AVG_VOLUME)
-            & (df['ATR_14'] >= MIN_ATR) & (df['Relative_Volume'] >= MIN_RELATIVE_VOLUME)]
-
-    #select one entry per day meeting the criteria (the first entry of each stock each day to later filter out the top 20 stocks)
-    df['date'] = df['timestamp'].dt.date
-    daily_stocks = df.groupby('date').apply(lambda x: x.head(1)).reset_index(drop=True)
-    daily_stocks['ticker'] = ticker
-
-    return daily_stocks
+#screened rows from the opening range table, read a batch of rows at a time
+def screen_batches_from_opening_range():
+    columns = ['ticker', 'date'] + [f"{column}_{label}" for column in SCREEN_COLUMNS for label in CANDLE_LABELS]
+    for batch in pq.ParquetFile(OPENING_RANGE_FILE).iter_batches(batch_size=SCREEN_BATCH_ROWS, columns=columns):
+        instrumentation.count('parquet_rows', batch.num_rows)
+        table = batch.to_pandas()
+        table = table[(table['date'] >= start_date) & (table['date'] <= end_date)]
+        with instrumentation.timer('screen', rows=len(table)):
+            screened = screen_opening_range(table, SCREEN_CRITERIA, CANDLE_LABELS)
+        yield screened
+
+#screened rows from the market data store, one trading day at a time (time filter and columns are pushed into the scan)
+def screen_batches_from_store():
+    for date in list_dates():
+        if start_date <= date <= end_date:
+            bars = read_bars(date=date, start_time=start_time, end_time=end_time, columns=SCREEN_COLUMNS)
+            bars['timestamp'] = bars.index.tz_localize(None)
+            with instrumentation.timer('screen', rows=len(bars)):
+                screened = screen_bars(bars.reset_index(drop=True), SCREEN_CRITERIA)
+            yield screened
+
+#the Arrow data plane of step 1 if it holds the processed bars of the manifest (None if it wasn't built or is stale)
+def current_arrow_data_plane():
+    data_plane = open_arrow_data_plane() if USE_ARROW_DATA_PLANE else None
+    if data_plane is not None and data_plane.versions != processed_data_versions():
+        logger.warning("The Arrow data plane is older than the processed data of step 1, it isn't used until step 1 rebuilds it")
+        return None
+    return data_plane
+
+#screened rows from the Arrow data plane, SCREEN_BATCH_TICKERS tickers at a time (views of the mapped file, no parquet reads)
+def screen_batches_from_plane(data_plane):
+    start_ns, _ = get_calendar().date_range_ns(start_date, start_date)
+    _, end_ns = get_calendar().date_range_ns(end_date, end_date)
+    for i in range(0, len(data_plane.tickers), SCREEN_BATCH_TICKERS):
+        frames = []
+        for ticker in data_plane.tickers[i:i + SCREEN_BATCH_TICKERS]:
+            df = filter_screen_window(data_plane.frame(ticker, SCREEN_COLUMNS, start_ns, end_ns))
+            df['ticker'] = ticker
+            frames.append(df)
+
+        with instrumentation.timer('screen', tickers=len(frames)):
+            screened = screen_bars(pd.concat(frames, ignore_index=True), SCREEN_CRITERIA)
+        yield screened
+
+#screened rows from the per ticker files, SCREEN_BATCH_TICKERS files at a time
+def screen_batches_from_files(data_folder):
+    files = sorted(filename for filename in os.listdir(data_folder) if filename.endswith(".parquet"))
+    for i in range(0, len(files), SCREEN_BATCH_TICKERS):
+        frames = []
+        for filename in files[i:i + SCREEN_BATCH_TICKERS]:
+            logger.debug(f"Processing file ----------------------------------------------->: {filename}")
+            df = load_filtered_data(os.path.join(data_folder, filename), columns=SCREEN_COLUMNS)
+            df['ticker'] = filename.split(".parquet")[0]
+            frames.append(df)
+
+        with instrumentation.timer('screen', files=len(frames)):
+            screened = screen_bars(pd.concat(frames, ignore_index=True), SCREEN_CRITERIA)
+        yield screened
 
 #process all tickers and find top stocks per day
 def find_top_stocks(data_folder):
-    all_stocks = pd.DataFrame()
-
-    for filename in os.listdir(data_folder):
-        print(f"Processing file ----------------------------------------------->: {filename}")
-        if filename.endswith(".parquet"):
-            ticker = filename.split(".parquet")[0] 
-            file_path = os.path.join(data_folder, filename)
-
-            df = load_filtered_data(file_path)
-            print(f"\nAfter loading data --------------{df.shape}------------------- and head:\n")
-
-            daily_stocks = select_top_stocks(df, ticker)
-            print(f"\nAfter applying filter and selecting top stocks -------{daily_stocks.shape}---------------\n")
-
-            all_stocks = pd.concat([all_stocks, daily_stocks], ignore_index=True)
+    use_opening_range = USE_OPENING_RANGE_TABLE and os.path.exists(OPENING_RANGE_FILE)
+    data_plane = current_arrow_data_plane() if not use_opening_range else None
+    if use_opening_range:
+        batches = screen_batches_from_opening_range()
+    elif data_plane is not None:
+        batches = screen_batches_from_plane(data_plane)
+    elif USE_MARKET_DATA_STORE and os.path.exists(STORE_FOLDER):
+        batches = screen_batches_from_store()
+    else:
+        batches = screen_batches_from_files(data_folder)
+
+    #running top stocks of each day, only (days x TOP_STOCKS_COUNT) rows are kept in memory
+    if USE_STREAMING_TOP_K:
+        top_k = StreamingTopK(TOP_STOCKS_COUNT)
+        for screened in batches:
+            top_k.update(screened)
+        return top_k.result()
+
+    all_stocks = [screened for screened in batches if not screened.empty]
+    if not all_stocks:
+        return pd.DataFrame(columns=OUTPUT_COLUMNS)
+    all_stocks = pd.concat(all_stocks, ignore_index=True)
+    logger.info(f"After applying filter and selecting the first entry of each stock each day -------{all_stocks.shape}---------------")
 
     #top 20 stocks each day based on relative volume
-    top_daily_stocks = all_stocks.sort_values(by=['date', 'Relative_Volume'], ascending=[True, False]).groupby('date') \
-                       .head(TOP_STOCKS_COUNT).reset_index(drop=True)
+    with instrumentation.timer('rank_top_stocks'):
+        top_daily_stocks = rank_top_stocks(all_stocks, TOP_STOCKS_COUNT)
     
     #without 20 limit
-    #top_daily_stocks = all_stocks.sort_values(by=['date', 'Relative_Volume'], ascending=[True, False]).reset_index(drop=True)
+    #top_daily_stocks = rank_top_stocks(all_stocks, None)
     
     return top_daily_stocks
 
 #run the find_top_stocks and save the result in top_20_qualified_daily_stocks.csv file
-top_stocks = find_top_stocks(data_folder)
-print(f"The final result of top stocks------------------------{top_stocks.shape}---------------------------------")
-
-if top_stocks.shape[0] > 0:
-    top_stocks.to_csv('step-2-get_candidate_stocks/top_20_qualified_daily_stocks.csv', index=False)
-else:
-    print("No data available for the selected criteria.")
+if __name__ == "__main__":
+    instrumentation.setup(description='Find the top stocks of each trading day')
+    with instrumentation.stage('step2'):
+        top_stocks = find_top_stocks(data_folder)
+        logger.info(f"The final result of top stocks------------------------{top_stocks.shape}---------------------------------")
+
+        if top_stocks.shape[0] > 0:
+            top_stocks.to_csv('step-2-get_candidate_stocks/top_20_qualified_daily_stocks.csv', index=False)
+        else:
+            logger.warning("No data available for the selected criteria.")
+    instrumentation.finish()
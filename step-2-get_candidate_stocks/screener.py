@@ -0,0 +1,73 @@
+'''
+Vectorized screen used by get_candidate_stocks.py.
+Bars (or opening range rows) of many tickers are screened at once: the criteria are applied as one mask, the first
+qualifying bar of each (ticker, date) is taken with a first-occurrence operation and the top stocks of each day are
+ranked by Relative_Volume in one sort. StreamingTopK keeps only the best rows of each day so the screen can run over
+batches of tickers with bounded memory
+'''
+
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+
+SCREEN_COLUMNS = ['open', 'ATR_14', 'Avg_Volume_14d', 'Relative_Volume'] #the only columns needed by the screen
+OUTPUT_COLUMNS = SCREEN_COLUMNS + ['timestamp', 'date', 'ticker']
+MARKET_OPEN_MINUTE = 9*60 + 30
+
+#criteria is a dict of column -> minimum value, e.g. {'open': 5.0, 'ATR_14': 0.5}
+def qualifying_mask(columns, criteria):
+    mask = None
+    for column, minimum in criteria.items():
+        column_mask = columns[column] >= minimum #missing values never qualify
+        mask = column_mask if mask is None else mask & column_mask
+
+    return mask
+
+#first qualifying bar of each (ticker, date)
+#bars is a long DataFrame with ticker, timestamp (naive US/Eastern) and the screen columns, sorted by ticker and timestamp
+def screen_bars(bars, criteria):
+    mask = np.asarray(qualifying_mask({column: bars[column].to_numpy() for column in criteria}, criteria))
+    qualified = bars[mask]
+    qualified = qualified.assign(date=qualified['timestamp'].dt.strftime('%Y-%m-%d'))
+    first = ~qualified.duplicated(subset=['ticker', 'date'], keep='first')
+
+    return qualified[first][OUTPUT_COLUMNS].reset_index(drop=True)
+
+#same as screen_bars but on the opening range table (one row per ticker and date, one column per candle and field)
+def screen_opening_range(table, criteria, candle_labels):
+    values = {column: table[[f"{column}_{label}" for label in candle_labels]].to_numpy() for column in SCREEN_COLUMNS}
+    mask = qualifying_mask(values, criteria) #shape (rows, candles)
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    candle = mask[rows].argmax(axis=1) #first qualifying candle of each row
+    dates = table['date'].to_numpy()[rows]
+
+    screened = pd.DataFrame({column: values[column][rows, candle] for column in SCREEN_COLUMNS})
+    screened['timestamp'] = pd.to_datetime(dates) + pd.to_timedelta(MARKET_OPEN_MINUTE + candle, unit='m')
+    screened['date'] = dates
+    screened['ticker'] = table['ticker'].to_numpy()[rows]
+
+    return screened
+
+#top 'top_n' stocks of each day by Relative_Volume (ties are broken by ticker so the result doesn't depend on the input order)
+def rank_top_stocks(screened, top_n):
+    ranked = screened.sort_values(by=['date', 'Relative_Volume', 'ticker'], ascending=[True, False, True], kind='stable')
+    if top_n is not None:
+        ranked = ranked[ranked.groupby('date').cumcount().to_numpy() < top_n]
+
+    return ranked.reset_index(drop=True)
+
+#keeps the running top 'top_n' rows of each day while batches of screened rows are added
+#memory is bounded by (days x top_n) + one batch, whatever the number of tickers
+class StreamingTopK:
+    def __init__(self, top_n):
+        self.top_n = top_n
+        self.top = None
+
+    def update(self, screened):
+        if screened is None or screened.empty:
+            return
+        combined = screened if self.top is None else pd.concat([self.top, screened], ignore_index=True)
+        self.top = rank_top_stocks(combined, self.top_n)
+
+    def result(self):
+        return self.top if self.top is not None else pd.DataFrame(columns=OUTPUT_COLUMNS)
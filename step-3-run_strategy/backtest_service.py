@@ -0,0 +1,196 @@
+'''
+Long-lived backtest service: the candidate lists of step 2 and the bars of every traded ticker-day are loaded once
+(prepare_trading_day of orb_stat_main.py, with its data sources and long/short decisions) and kept in memory, so a query
+only runs the entry/exit scan of process_trading_day and the step-4 metrics (trade_calculations.py) in memory.
+A query is a dict of settings (any missing one takes the module constant of orb_stat_main.py):
+    {'start_date': '2023-01-01', 'end_date': '2023-12-31', 'stop_loss_percentage': 0.05, 'atr': 0.15,
+     'entry_change': 0.0025, 'check_interval': 5, 'include_trades': False}
+and the result has the final metrics, the number of trades and (with include_trades) the trade details.
+Results of recent queries are cached by their settings (RESULT_CACHE_SIZE, least recently used are dropped).
+Python API: BacktestService().load(), then service.run(query) (thread safe). HTTP on localhost (ThreadingHTTPServer, one
+thread per request): POST /backtest with the query as JSON, GET /stats, GET /health; request_backtest() is a small client
+
+Run it from the main folder after steps 1 and 2: python step-3-run_strategy/backtest_service.py
+'''
+
+import sys
+import json
+import time
+import threading
+import urllib.request
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np # type: ignore
+
+from orb_stat_main import prepare_trading_day, process_trading_day, get_unique_dates, strategy_settings, TOP_STOCKS_FILE, LOG_COLUMNS # type: ignore
+from trade_ledger import TradeLedger # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+import instrumentation # type: ignore
+
+sys.path.append('./step-4-result')
+from trade_calculations import calculate_trades, final_metrics # type: ignore
+from performance_metrics import load_benchmark # type: ignore
+
+logger = instrumentation.get_logger('backtest_service')
+
+SERVICE_HOST = '127.0.0.1' #localhost only
+SERVICE_PORT = 8765
+RESULT_CACHE_SIZE = 256 #results of recent queries kept in memory
+QUERY_SETTINGS = ['stop_loss_percentage', 'atr', 'entry_change', 'check_interval'] #settings of process_trading_day
+
+#None for NaN (valid JSON) and plain python numbers for numpy scalars
+def to_json_value(value):
+    if isinstance(value, (np.floating, float)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+class BacktestService:
+    def __init__(self, cache_size=RESULT_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.days = {} #date -> output of prepare_trading_day
+        self.dates = []
+        self.benchmark = None
+        self.results = OrderedDict() #query key -> result, least recently used first
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.cache_hits = 0
+        self.load_seconds = 0.0
+
+    #load the traded ticker-days of every trading day of the step-2 file (and the benchmark of step 4)
+    def load(self):
+        start = time.perf_counter()
+        self.dates = [trading_date.strftime('%Y-%m-%d') for trading_date in get_unique_dates(TOP_STOCKS_FILE)]
+        for date in self.dates:
+            with instrumentation.timer('load_bars', date=date):
+                self.days[date] = prepare_trading_day(date)
+        self.benchmark = load_benchmark()
+        self.load_seconds = time.perf_counter() - start
+        logger.info(f"Loaded {len(self.dates)} trading days ({sum(len(day[0]) for day in self.days.values())} traded ticker-days) in {self.load_seconds:.2f}s")
+
+        return self
+
+    #settings of a query with the defaults filled in, and its cache key
+    def normalize(self, query):
+        settings = strategy_settings()
+        unknown = set(query) - set(QUERY_SETTINGS) - {'start_date', 'end_date', 'include_trades'}
+        if unknown:
+            raise ValueError(f"Unknown query settings: {sorted(unknown)}")
+        settings.update({name: query[name] for name in QUERY_SETTINGS if name in query})
+        settings['check_interval'] = int(settings['check_interval'])
+        settings['start_date'] = str(query.get('start_date') or self.dates[0])[:10] if self.dates else None
+        settings['end_date'] = str(query.get('end_date') or self.dates[-1])[:10] if self.dates else None
+        settings['include_trades'] = bool(query.get('include_trades', False))
+
+        return settings, json.dumps(settings, sort_keys=True)
+
+    def _backtest(self, settings):
+        scan_settings = {name: settings[name] for name in QUERY_SETTINGS}
+        trade_log = TradeLedger(columns=LOG_COLUMNS) #in memory only
+        dates = [date for date in self.dates if settings['start_date'] <= date <= settings['end_date']]
+        for date in dates:
+            process_trading_day(date, trade_log, prepared=self.days[date], settings=scan_settings)
+
+        result = {'settings': settings, 'trading_days': len(dates), 'trades': len(trade_log) // 2}
+        if len(trade_log):
+            trade_details, equity = calculate_trades(trade_log.to_frame())
+            result['metrics'] = {name: to_json_value(value) for name, value in final_metrics(equity, self.benchmark).items()}
+            if settings['include_trades']:
+                trade_details = trade_details.assign(entry_time=trade_details['entry_time'].astype(str), exit_time=trade_details['exit_time'].astype(str))
+                result['trade_details'] = [{name: to_json_value(value) for name, value in record.items()} for record in trade_details.to_dict('records')]
+        else:
+            result['metrics'] = {}
+
+        return result
+
+    #backtest of a query (see the module docstring), cached by its settings
+    def run(self, query=None):
+        settings, key = self.normalize(query or {})
+        with self.lock:
+            self.queries += 1
+            if key in self.results:
+                self.cache_hits += 1
+                self.results.move_to_end(key)
+                return dict(self.results[key], cached=True)
+
+        start = time.perf_counter()
+        with instrumentation.timer('backtest_query'):
+            result = self._backtest(settings)
+        result['seconds'] = round(time.perf_counter() - start, 6)
+
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.cache_size:
+                self.results.popitem(last=False)
+
+        return dict(result, cached=False)
+
+    def stats(self):
+        with self.lock:
+            return {'trading_days': len(self.dates), 'ticker_days': sum(len(day[0]) for day in self.days.values()),
+                    'load_seconds': round(self.load_seconds, 3), 'queries': self.queries, 'cache_hits': self.cache_hits,
+                    'cached_results': len(self.results)}
+
+#HTTP handler of the service (the service is the server's 'service' attribute)
+class BacktestRequestHandler(BaseHTTPRequestHandler):
+    def _send(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self._send(200, self.server.service.stats())
+        else:
+            self._send(404, {'error': f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/backtest':
+            self._send(404, {'error': f"Unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(length) or b'{}')
+            self._send(200, self.server.service.run(query))
+        except (ValueError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+        except Exception as e:
+            logger.error(f"Backtest query failed: {e}")
+            self._send(500, {'error': f"{type(e).__name__}: {e}"})
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+#HTTP server of a loaded service (serve_forever() to run it, shutdown() from another thread to stop it)
+def create_server(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    server = ThreadingHTTPServer((host, port), BacktestRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+#send a query to a running service, returns the result
+def request_backtest(query=None, host=SERVICE_HOST, port=SERVICE_PORT, timeout=60):
+    request = urllib.request.Request(f'http://{host}:{port}/backtest', data=json.dumps(query or {}).encode(),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Backtest service on localhost with the market data kept in memory')
+    service = BacktestService().load()
+    server = create_server(service)
+    logger.info(f"Backtest service listening on http://{SERVICE_HOST}:{SERVICE_PORT} (POST /backtest, GET /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        instrumentation.finish()
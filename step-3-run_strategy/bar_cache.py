@@ -0,0 +1,124 @@
+'''
+In-memory cache of minute bars for the backtest loop of orb_stat_main.py.
+Bars are kept per (ticker, day) as compact numpy arrays. On a miss the ticker's bars of the requested day and the
+following prefetch window are loaded in one read, so a ticker that shows up on many days is read once per window and
+not once per day.
+The cache has a memory budget (bytes) and evicts the least recently used days when it is exceeded;
+hit/miss/eviction counters (stats()) help to size the budget
+'''
+
+import sys
+from collections import OrderedDict
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+from trading_calendar import get_calendar, TIMEZONE # type: ignore
+
+ENTRY_OVERHEAD_BYTES = 512 #rough python overhead per cached day (dict entry, object, array headers)
+
+#bars of one ticker on one day
+class DayBars:
+    __slots__ = ('timestamps', 'columns', 'nbytes')
+
+    def __init__(self, timestamps, columns):
+        self.timestamps = timestamps #int64 ns since epoch (UTC)
+        self.columns = columns #column name -> numpy array
+        self.nbytes = timestamps.nbytes + sum(values.nbytes for values in columns.values()) + ENTRY_OVERHEAD_BYTES
+
+    #DataFrame indexed by the US/Eastern timestamp (same layout as the processed files)
+    def to_frame(self):
+        index = pd.DatetimeIndex(self.timestamps, name='timestamp').tz_localize('UTC').tz_convert(TIMEZONE)
+        return pd.DataFrame(self.columns, index=index, copy=False)
+
+#split bars of one ticker (DataFrame indexed by tz-aware timestamp, sorted) into (date, DayBars) pairs
+def split_days(df, columns):
+    timestamps = df.index.asi8
+    local_days, _ = get_calendar().session_minutes(timestamps)
+    starts = np.flatnonzero(np.r_[True, local_days[1:] != local_days[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+    values = {column: df[column].to_numpy() for column in columns}
+
+    days = []
+    for start, end in zip(starts, ends):
+        date = get_calendar().dates[local_days[start]]
+        days.append((date, DayBars(timestamps[start:end].copy(), {column: values[column][start:end].copy() for column in columns})))
+
+    return days
+
+class BarCache:
+    #load_bars(tickers, start_date, end_date) returns the bars of the tickers between the two dates ('YYYY-MM-DD', inclusive)
+    #as a DataFrame indexed by the tz-aware timestamp with a 'ticker' column and the given columns
+    def __init__(self, load_bars, columns, memory_budget_bytes, prefetch_days=90):
+        self.load_bars = load_bars
+        self.columns = list(columns)
+        self.memory_budget_bytes = memory_budget_bytes
+        self.prefetch_days = prefetch_days #calendar days loaded after the requested one
+        self.days = OrderedDict() #(ticker, date) -> DayBars, least recently used first
+        self.loaded = {} #ticker -> (first, last) date loaded and still complete in the cache (days in it without an entry have no bars)
+        self.bytes_used = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    def _is_known(self, ticker, date):
+        if (ticker, date) in self.days:
+            return True
+        first, last = self.loaded.get(ticker, (None, None))
+        return first is not None and first <= date <= last
+
+    def _insert(self, ticker, date, day_bars):
+        key = (ticker, date)
+        if key in self.days:
+            self.bytes_used -= self.days.pop(key).nbytes
+        self.days[key] = day_bars
+        self.bytes_used += day_bars.nbytes
+        self.peak_bytes = max(self.peak_bytes, self.bytes_used)
+
+    def _evict(self):
+        while self.bytes_used > self.memory_budget_bytes and self.days:
+            (ticker, _), day_bars = self.days.popitem(last=False)
+            self.bytes_used -= day_bars.nbytes
+            self.loaded.pop(ticker, None) #an evicted day has to be read again
+            self.evictions += 1
+
+    #bars of the tickers on the date, as a dict ticker -> DayBars (tickers without bars on that day are left out)
+    def get_days(self, tickers, date):
+        missing = [ticker for ticker in tickers if not self._is_known(ticker, date)]
+        self.hits += len(tickers) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            self.loads += 1
+            end_date = str((pd.Timestamp(date) + pd.Timedelta(days=self.prefetch_days)).date())
+            bars = self.load_bars(missing, date, end_date)
+            for ticker, df in bars.groupby('ticker', sort=False):
+                #latest days first so that the days coming next in the backtest are the most recently used
+                for day, day_bars in reversed(split_days(df, self.columns)):
+                    self._insert(ticker, day, day_bars)
+            for ticker in missing:
+                self.loaded[ticker] = (date, end_date)
+
+        result = {}
+        for ticker in tickers:
+            key = (ticker, date)
+            if key in self.days:
+                self.days.move_to_end(key)
+                result[ticker] = self.days[key]
+        self._evict()
+
+        return result
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'loads': self.loads,
+            'cached_days': len(self.days),
+            'bytes_used': self.bytes_used,
+            'peak_bytes': self.peak_bytes,
+            'memory_budget_bytes': self.memory_budget_bytes
+        }
@@ -0,0 +1,219 @@
+'''
+Vectorized entry/exit engine for the ORB strategy of orb_stat_main.py.
+A (ticker, day) is a row of a dense minute grid (09:30 to 16:00, NaN where there is no bar), so a whole batch of
+ticker-days is evaluated with a few array operations: the long/short decision counts the bullish opening candles of every
+row at once (opening_range_stats), the entry is the first bar of the entry window that crosses the
+entry level (boolean mask + argmax) and the exit is the first stop loss breach on the 5-minute closes after the entry,
+or the close of the session end bar (15:55, 12:55 on half days). Results are the same as the row by row loop it replaces.
+sweep_exits evaluates many stop settings (and the trailing stop) at once, with the settings as an extra array axis.
+The check closes are binned from the minute grid, or taken from precomputed coarse bars (coarse_bars.py in step 1)
+'''
+
+import sys
+import numpy as np # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+from trading_calendar import (get_calendar, TIMEZONE, MARKET_OPEN_MINUTE, SESSION_MINUTES, ENTRY_START_MINUTE, # type: ignore
+                              FULL_DAY_END_MINUTE, HALF_DAY_END_MINUTE)
+
+LONG = 1
+SHORT = -1
+
+#last minute (offset from 09:30) a trade can stay open on the date (12:55 on the half days of the trading calendar)
+def session_end_minute(date):
+    return get_calendar().session_end_minute(date)
+
+#minute of each bar as the offset from 09:30 (US/Eastern), index is a tz-aware DatetimeIndex
+def minute_offsets(index):
+    return get_calendar().session_minutes(index.asi8)[1]
+
+#tz-aware timestamp of a minute offset on the date
+def minute_to_timestamp(date, minute):
+    return get_calendar().minute_to_timestamp(date, minute)
+
+#stack the closes of many ticker-days (DataFrames indexed by the tz-aware timestamp) into a (days, SESSION_MINUTES) grid
+#bars outside the session are dropped and the first bar is kept for duplicated minutes (as .loc[...].iloc[0] would)
+def stack_closes(frames, column='close'):
+    dtype = np.result_type(*[frame[column].dtype for frame in frames]) if frames else np.float32
+    closes = np.full((len(frames), SESSION_MINUTES), np.nan, dtype=dtype)
+    for row, frame in enumerate(frames):
+        minutes = minute_offsets(frame.index)
+        values = frame[column].to_numpy()
+        inside = (minutes >= 0) & (minutes < SESSION_MINUTES)
+        minutes, values = minutes[inside][::-1], values[inside][::-1] #reversed so the first of duplicated minutes is written last
+        closes[row, minutes] = values
+
+    return closes
+
+#bullish candles (close > open) and lowest/highest open or close of the opening bars (09:30 to 09:35) of a batch of rows
+#opens, closes: the opening bars of all the rows, rows: row of each bar
+#a missing minute is an absent bar (or NaN prices, which never count), a row without bars has 0 candles and NaN prices
+def opening_range_stats(opens, closes, rows, n_rows):
+    opens, closes, rows = np.asarray(opens), np.asarray(closes), np.asarray(rows, dtype='int64')
+    bullish = np.bincount(rows, weights=closes > opens, minlength=n_rows).astype('int64')
+    dtype = np.result_type(opens.dtype, closes.dtype, np.float32)
+    body_lows = np.full(n_rows, np.nan, dtype=dtype)
+    body_highs = np.full(n_rows, np.nan, dtype=dtype)
+    np.fmin.at(body_lows, rows, np.fmin(opens, closes))
+    np.fmax.at(body_highs, rows, np.fmax(opens, closes))
+
+    return bullish, body_lows, body_highs
+
+#long/short decision of each row: 5 or 6 bullish opening candles go long (ob price: lowest open/close of the candles),
+#0 or 1 go short (ob price: highest open/close), no trade (0, ob price 0) otherwise
+def opening_range_decisions(bullish, body_lows, body_highs):
+    bullish = np.asarray(bullish)
+    positions = np.where(bullish >= 5, LONG, np.where(bullish <= 1, SHORT, 0))
+    ob_prices = np.where(positions == LONG, body_lows, np.where(positions == SHORT, body_highs, 0))
+
+    return positions, ob_prices
+
+#percentage change entry level of each row: first close of the entry window -/+ entry_change for long/short
+#window_start is the first minute of the entry window with a bar (-1 if none)
+def percentage_entry_levels(closes, positions, window_start, entry_change):
+    rows = np.arange(len(closes))
+    init = closes[rows, np.maximum(window_start, 0)]
+    #same arithmetic (and dtype) as init - (init * entry_change) on the close column
+    return np.where(positions == LONG, init - (init * entry_change), init + (init * entry_change))
+
+#first minute of the entry window (09:35 to the session end) with a bar, -1 if the window is empty
+def entry_window_start(closes, end_minutes):
+    minutes = np.arange(SESSION_MINUTES)
+    window = ~np.isnan(closes) & (minutes >= ENTRY_START_MINUTE) & (minutes <= end_minutes[:, None])
+    return np.where(window.any(axis=1), window.argmax(axis=1), -1), window
+
+#first bar of the window that crosses the entry level (close <= level for long, close >= level for short), -1 if none
+def find_entries(closes, window, positions, levels):
+    long_hit = (positions == LONG)[:, None] & (closes <= levels[:, None])
+    short_hit = (positions == SHORT)[:, None] & (closes >= levels[:, None])
+    hit = window & (long_hit | short_hit)
+
+    return np.where(hit.any(axis=1), hit.argmax(axis=1), -1)
+
+#last close of each check_interval bin of the bars after the entry (up to the session end), like resample().last().dropna()
+#returns bin closes (rows, bins) and whether each bin has a bar, bins are labelled by their first minute
+def interval_closes(closes, entry_minutes, end_minutes, check_interval):
+    rows, n_minutes = closes.shape
+    minutes = np.arange(n_minutes)
+    after_entry = ~np.isnan(closes) & (minutes > entry_minutes[:, None]) & (minutes <= end_minutes[:, None])
+
+    #09:30 is a multiple of 5 minutes (and of 1), so bins of the offsets line up with the wall clock bins of resample
+    n_bins = -(-n_minutes // check_interval)
+    pad = n_bins * check_interval - n_minutes
+    binned_mask = np.pad(after_entry, ((0, 0), (0, pad))).reshape(rows, n_bins, check_interval)
+    binned_closes = np.pad(closes, ((0, 0), (0, pad)), constant_values=np.nan).reshape(rows, n_bins, check_interval)
+
+    has_bar = binned_mask.any(axis=2)
+    last = check_interval - 1 - binned_mask[:, :, ::-1].argmax(axis=2)
+    bin_closes = np.take_along_axis(binned_closes, last[:, :, None], axis=2)[:, :, 0]
+
+    return bin_closes, has_bar
+
+#interval_closes from precomputed coarse bars: coarse_closes and coarse_last_minutes (rows, bins) of the check_interval
+#(close and minute of the last bar of each bin, -1 if empty), the minute grid is only read for the bin of the session end
+#whose coarse bar can hold bars after the end minute
+def coarse_interval_closes(closes, coarse_closes, coarse_last_minutes, entry_minutes, end_minutes, check_interval):
+    rows = np.arange(len(coarse_closes))
+    bin_starts = np.arange(coarse_closes.shape[1]) * check_interval
+    has_bar = (coarse_last_minutes > entry_minutes[:, None]) & (bin_starts <= end_minutes[:, None])
+    bin_closes = np.array(coarse_closes, dtype=closes.dtype)
+
+    #bin of the session end: last bar after the entry up to the end minute
+    end_bins = end_minutes // check_interval
+    minutes = np.minimum(end_bins[:, None] * check_interval + np.arange(check_interval), closes.shape[1] - 1)
+    values = closes[rows[:, None], minutes]
+    window = ~np.isnan(values) & (minutes > entry_minutes[:, None]) & (minutes <= end_minutes[:, None])
+    last = check_interval - 1 - window[:, ::-1].argmax(axis=1)
+    has_bar[rows, end_bins] = window.any(axis=1)
+    bin_closes[rows, end_bins] = values[rows, last]
+
+    return bin_closes, has_bar
+
+#stop loss level: entry price -/+ entry price * stop_loss_percentage * atr (long/short), the one stop formula of the batch,
+#sweep and streaming engines (arrays broadcast, e.g. rows x settings)
+def stop_loss_levels(entry_prices, positions, stop_loss_percentage, atr):
+    offset = entry_prices * stop_loss_percentage * atr
+    return np.where(positions == LONG, entry_prices - offset, entry_prices + offset)
+
+#entries of a batch of ticker-days: entry minute (-1 if none), entry price (float64) and whether a trade was entered
+#entry_levels: entry level per row (percentage_entry_levels if None), e.g. the opening range low/high for a limit entry
+def find_batch_entries(closes, positions, end_minutes, entry_change, entry_levels=None):
+    rows = np.arange(len(closes))
+    window_start, window = entry_window_start(closes, end_minutes)
+    if entry_levels is None:
+        entry_levels = percentage_entry_levels(closes, positions, window_start, entry_change)
+    entry_minutes = find_entries(closes, window, positions, np.asarray(entry_levels))
+    entered = (entry_minutes >= 0) & (positions != 0)
+    entry_prices = closes[rows, np.maximum(entry_minutes, 0)].astype('float64')
+
+    return np.where(entered, entry_minutes, -1), entry_prices, entered
+
+#exits of a batch of entries for many stop settings at once (rows x settings)
+#stop_loss_percentages, atrs, trail_percents: one value per setting, trail_percent NaN for a fixed stop
+#with a trailing stop the stop moves to the best check close so far -/+ trail_percent once the price moved past the entry
+#(same as update_trailing_stop_loss), until then the fixed stop applies
+#coarse: (coarse closes, coarse last minutes) of the check_interval (see coarse_interval_closes), binned from closes if None
+#returns stop_hit, exit_minute and the check close at the stop (NaN if not hit), the exit is at the session end otherwise
+def sweep_exits(closes, positions, entry_minutes, entry_prices, end_minutes, stop_loss_percentages, atrs, trail_percents, check_interval=5, coarse=None):
+    long = (positions == LONG)[:, None]
+    after = np.where(entry_minutes >= 0, entry_minutes, SESSION_MINUTES)
+    if coarse is not None:
+        bin_closes, has_bar = coarse_interval_closes(closes, coarse[0], coarse[1], after, end_minutes, check_interval)
+    else:
+        bin_closes, has_bar = interval_closes(closes, after, end_minutes, check_interval)
+
+    stops = stop_loss_levels(entry_prices[:, None], positions[:, None], np.asarray(stop_loss_percentages)[None, :], np.asarray(atrs)[None, :])[:, :, None] #(rows, settings, 1)
+
+    trail_percents = np.asarray(trail_percents, dtype='float64')
+    if np.isfinite(trail_percents).any():
+        #best check close so far (highest for long, lowest for short) and whether it moved past the entry price
+        observed = np.where(has_bar, bin_closes, np.nan)
+        best = np.where(long, np.fmax.accumulate(observed, axis=1), np.fmin.accumulate(observed, axis=1))
+        with np.errstate(invalid='ignore'):
+            moved = np.where(long, best > entry_prices[:, None], best < entry_prices[:, None])
+        trail = trail_percents.astype(bin_closes.dtype)[None, :, None]
+        best = best[:, None, :]
+        trailing = np.where(long[:, :, None], best - (trail * best), best + (trail * best))
+        stops = np.where(moved[:, None, :] & np.isfinite(trail), trailing, stops)
+
+    with np.errstate(invalid='ignore'):
+        breach = has_bar[:, None, :] & np.where(long[:, :, None], bin_closes[:, None, :] < stops, bin_closes[:, None, :] > stops)
+    stop_hit = (entry_minutes >= 0)[:, None] & breach.any(axis=2)
+    stop_bin = breach.argmax(axis=2)
+
+    exit_minutes = np.where(stop_hit, stop_bin * check_interval, end_minutes[:, None])
+    stop_closes = np.where(stop_hit, np.take_along_axis(bin_closes, stop_bin, axis=1), np.nan)
+
+    return stop_hit, exit_minutes, stop_closes
+
+#evaluate a batch of ticker-days
+#closes: (rows, SESSION_MINUTES) grid of stack_closes, positions: LONG/SHORT/0 per row, end_minutes: session_end_minute per row
+#entry_levels: entry level per row (percentage_entry_levels if None), e.g. the opening range low/high for a limit entry
+#coarse: precomputed coarse bars of the check_interval (see sweep_exits)
+#returns a dict of arrays per row: entered, entry_minute, entry_price, stop_loss, stop_hit, exit_minute, exit_price,
+#exit_missing (trade entered, stop not hit and no bar at the session end; exit_price is NaN)
+#entry and exit prices (stop or session end) are all closes of the grid as float64, so every logged price has the same precision
+def run_batch(closes, positions, end_minutes, entry_change, stop_loss_percentage, atr, check_interval=5, entry_levels=None, coarse=None):
+    rows = np.arange(len(closes))
+    positions = np.asarray(positions)
+    end_minutes = np.asarray(end_minutes)
+
+    entry_minutes, entry_prices, entered = find_batch_entries(closes, positions, end_minutes, entry_change, entry_levels)
+    stop_loss = stop_loss_levels(entry_prices, positions, stop_loss_percentage, atr)
+    stop_hit, exit_minutes, stop_closes = sweep_exits(closes, positions, entry_minutes, entry_prices, end_minutes,
+                                                      [stop_loss_percentage], [atr], [np.nan], check_interval, coarse)
+
+    eod_prices = closes[rows, end_minutes].astype('float64')
+    stop_hit = stop_hit[:, 0]
+    exit_prices = np.where(stop_hit, stop_closes[:, 0].astype('float64'), eod_prices)
+
+    return {
+        'entered': entered,
+        'entry_minute': entry_minutes,
+        'entry_price': np.where(entered, entry_prices, np.nan),
+        'stop_loss': np.where(entered, stop_loss, np.nan),
+        'stop_hit': stop_hit,
+        'exit_minute': np.where(entered, exit_minutes[:, 0], -1),
+        'exit_price': np.where(entered, exit_prices, np.nan),
+        'exit_missing': entered & ~stop_hit & np.isnan(eod_prices)
+    }
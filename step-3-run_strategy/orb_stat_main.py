@@ -1,27 +1,71 @@
 '''This file has the core logic (buy/sell) that applies to the candidate stocks from step-2'''
 
 import pandas as pd # type: ignore
+import numpy as np # type: ignore
 from datetime import datetime
 import os
 import time
-import pytz # type: ignore
 import shutil
+import sys
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append('./step-1-process_historical_data')
+from market_data_store import read_bars, STORE_FOLDER # type: ignore
+from opening_range import load_opening_range_table, OPENING_RANGE_FILE # type: ignore
+from bar_cache import BarCache # type: ignore
+from bar_cube import open_bar_cube, bar_cube_versions, CUBE_FOLDER, OPEN, CLOSE # type: ignore
+from arrow_data_plane import open_arrow_data_plane, ARROW_DATA_FILE # type: ignore
+from trade_ledger import TradeLedger # type: ignore
+from orb_engine import (stack_closes, run_batch, opening_range_stats, opening_range_decisions, session_end_minute, minute_to_timestamp, # type: ignore
+                        LONG, SHORT, SESSION_MINUTES, ENTRY_START_MINUTE)
+from trading_calendar import get_calendar, TIMEZONE # type: ignore
+from process_historical_data import processed_data_versions, MANIFEST_FILE # type: ignore
+import instrumentation # type: ignore
 
 TOP_STOCKS_FILE = './step-2-get_candidate_stocks/top_20_qualified_daily_stocks.csv' #file from step-2
 PROCESSED_DATA_FOLDER = './processed_data_new'
-LOG_FILE = 'trade_log_initial.csv'
+USE_OPENING_RANGE_TABLE = True #take the long/short decision off the opening range table of step 1 (if it exists), bars are only loaded for tickers to trade
+USE_MARKET_DATA_STORE = True #read the day's bars from the consolidated store of step 1 (falls back to the per ticker files if it doesn't exist)
+USE_BAR_CACHE = True #keep the bars in memory across trading days (a ticker's file is read once per prefetch window and not once per day)
+BAR_CACHE_MEMORY_MB = 1024 #memory budget of the bar cache, least recently used days are evicted above it
+BAR_CACHE_PREFETCH_DAYS = 90 #calendar days of bars loaded after the requested day on a cache miss
+BAR_COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'ATR_14'] #columns used by the strategy
+USE_ARROW_DATA_PLANE = True #take the bars from the memory-mapped Arrow file of step 1 (if it was built, BUILD_ARROW_DATA_PLANE in step 1, and holds the bars of the last step 1 run): views of pages shared by all the workers, no parquet reads and no bar cache
+USE_BAR_CUBE = True #take the day's bars from the memory-mapped bar cube of step 1 (if it was built, BUILD_BAR_CUBE in step 1, and holds the bars of the last step 1 run)
+STOP_CHECK_INTERVAL = 5 #minutes between stop loss checks (1 for 1-minute checks), the cube's coarse bars of that interval are used if step 1 built them
+LOG_FORMAT = 'csv' #'csv' or 'parquet'
+LOG_FILE = f'trade_log_initial.{LOG_FORMAT}'
+LOG_COLUMNS = ['status', 'ticker', 'price', 'timestamp', 'position_type']
+LEDGER_FLUSH_RECORDS = 10_000 #log entries buffered before they are written to the log file
+RUN_TRADE_CALCULATIONS = False #run step 4 at the end on the trade log held in memory (no round trip through the log file)
 STOP_LOSS_PERCENTAGE = 0.05 #5% of atr
 atr_value = 0.15 #fixed atr_value used for calculating stop loss (so net stop loss will be atr_value * STOP_LOSS_PERCENTAGE = 0.15 * 0.05 = 0.0075 which is 0.75%)
 PERCENTAGE_CHANGE_BEFORE_ENTRY = 0.0025 #0.25% change before entry
+USE_PROCESS_POOL = True #spread the trading days across the cores (set False to process one day at a time)
+NUM_WORKERS = os.cpu_count()
+DAYS_PER_SHARD = 20 #consecutive trading days handled by a worker at a time (consecutive days reuse the worker's bar cache)
+POOL_START_METHOD = None #start method of the worker processes: 'fork', 'spawn' or 'forkserver' (None for the platform default)
+#module constants read by the worker processes, passed to them when the pool starts (a spawned worker imports this module
+#again and would otherwise run with the defaults and not with the values set by e.g. run_pipeline.py)
+WORKER_CONSTANTS = ['TOP_STOCKS_FILE', 'PROCESSED_DATA_FOLDER', 'USE_OPENING_RANGE_TABLE', 'USE_MARKET_DATA_STORE', 'USE_BAR_CACHE', 'BAR_COLUMNS',
+                    'USE_ARROW_DATA_PLANE', 'USE_BAR_CUBE', 'STOP_CHECK_INTERVAL', 'STOP_LOSS_PERCENTAGE', 'atr_value', 'PERCENTAGE_CHANGE_BEFORE_ENTRY']
 #trail_percent = 0.02 # 2% (can be used for trailing stop loss, not used in this script because of lower return)
 
+logger = instrumentation.get_logger('step3')
+
+#candidate tickers of each date (in the order of the step-2 file), read once for all the trading days
+_tickers_by_date = None
+
 #helper function to get tickers for a given date
 def get_tickers_for_date(date):
-    df = pd.read_csv(TOP_STOCKS_FILE)
-    daily_stocks = df[df['date'] == date]
-    tickers = daily_stocks['ticker'].tolist()
+    global _tickers_by_date
+    if _tickers_by_date is None:
+        df = pd.read_csv(TOP_STOCKS_FILE, usecols=['date', 'ticker'])
+        _tickers_by_date = {day: group['ticker'].tolist() for day, group in df.groupby('date', sort=False)}
 
-    return tickers
+    return list(_tickers_by_date.get(date, []))
 
 # load historical data for selected tickers (for .csv) - if not willing to use parquet files
 '''
@@ -40,55 +84,187 @@ def load_historical_data(tickers):
 '''
 
 # loading function based on processed parquet files
-def load_historical_data(tickers):
+# with a date the bars of that day are served from the bar cache (or read from the market data store), the whole history otherwise
+def load_historical_data(tickers, date=None):
+    data_plane = open_arrow_data_plane() if USE_ARROW_DATA_PLANE else None
+    if data_plane is not None and source_is_current('Arrow data plane', ARROW_DATA_FILE, lambda: data_plane.versions):
+        return load_historical_data_from_plane(data_plane, tickers, date)
+    if USE_BAR_CACHE and date is not None:
+        return load_historical_data_from_cache(tickers, date)
+    if USE_MARKET_DATA_STORE and date is not None and os.path.exists(STORE_FOLDER):
+        return load_historical_data_from_store(tickers, date)
+
     data = {}
     for ticker in tickers:
         file_path = f'{PROCESSED_DATA_FOLDER}/{ticker}.parquet'
         try:
             # Load preprocessed Parquet file
-            df = pd.read_parquet(file_path)
+            with instrumentation.timer('parquet_read', file=file_path):
+                df = pd.read_parquet(file_path)
+            instrumentation.count_parquet_read(file_path, len(df))
             data[ticker] = df
         except FileNotFoundError:
-            print(f'Processed data not found for ticker: {ticker}')
+            logger.warning(f'Processed data not found for ticker: {ticker}')
         except Exception as e:
-            print(f"Error loading data for {ticker}: {e}")
+            logger.error(f"Error loading data for {ticker}: {e}")
 
     return data
 
-#check price movement between 09:30 and 09:35 and decide to go long or short
-def check_price_movement(data, date):
-    # Define the US/Eastern timezone using pytz
-    eastern = pytz.timezone('US/Eastern')
-    
-    # Construct the start and end times dynamically based on the date
-    start_time = pd.Timestamp(f"{date} 09:30:00").tz_localize(eastern, ambiguous='NaT')
-    end_time = pd.Timestamp(f"{date} 09:35:00").tz_localize(eastern, ambiguous='NaT')
-    
+def load_historical_data_from_store(tickers, date):
+    data = {}
     try:
-        data_filtered = data.loc[start_time:end_time]
-    except KeyError as e:
-        print(f"Missing data for the range {start_time} to {end_time}.") #for any missing timestamp
-        return 'no_trade',0
-
-    #count how many of the candles (from 09:30 to 09:35) had close > open
-    positive_movement = sum(data_filtered['close'] > data_filtered['open'])
-
-    #if more than 5 candles had close > open, go long; if less than 1, go short else no trade
-    if positive_movement >= 5:
-        lowest_ob_price = data_filtered[['open', 'close']].min().min()
-        return 'long', lowest_ob_price
-    elif positive_movement <= 1:
-        highest_ob_price = data_filtered[['open', 'close']].max().max()
-        return 'short', highest_ob_price
+        bars = read_bars(tickers, date, columns=BAR_COLUMNS)
+    except Exception as e:
+        logger.error(f"Error loading data for {date}: {e}")
+        return data
+
+    bars_by_ticker = {ticker: df.drop(columns='ticker') for ticker, df in bars.groupby('ticker', sort=False)}
+    for ticker in tickers: #keep the order of the candidate list
+        if ticker in bars_by_ticker:
+            data[ticker] = bars_by_ticker[ticker]
+        else:
+            logger.warning(f'Processed data not found for ticker: {ticker}')
+
+    return data
+
+#bars of the tickers (of the date, or the whole history) as DataFrames backed by the mapped Arrow file (no copy)
+def load_historical_data_from_plane(data_plane, tickers, date=None):
+    data = {}
+    for ticker in tickers: #keep the order of the candidate list
+        df = data_plane.frame(ticker, BAR_COLUMNS, *get_calendar().date_range_ns(date, date)) if date is not None else data_plane.frame(ticker)
+        if df is not None:
+            data[ticker] = df
+        else:
+            logger.warning(f'Processed data not found for ticker: {ticker}')
+
+    return data
+
+#bars of the tickers between two dates (inclusive) in one DataFrame with a 'ticker' column, used to fill the bar cache
+def load_bars_for_cache(tickers, start_date, end_date):
+    if USE_MARKET_DATA_STORE and os.path.exists(STORE_FOLDER):
+        return read_bars(tickers, start_date=start_date, end_date=end_date, columns=BAR_COLUMNS)
+
+    start, end = (pd.Timestamp(epoch_ns, tz=TIMEZONE) for epoch_ns in get_calendar().date_range_ns(start_date, end_date))
+    frames = []
+    for ticker in tickers:
+        file_path = f'{PROCESSED_DATA_FOLDER}/{ticker}.parquet'
+        try:
+            with instrumentation.timer('parquet_read', file=file_path):
+                df = pd.read_parquet(file_path, columns=BAR_COLUMNS, filters=[('timestamp', '>=', start), ('timestamp', '<', end)])
+            instrumentation.count_parquet_read(file_path, len(df))
+            frames.append(df.assign(ticker=ticker))
+        except FileNotFoundError:
+            pass #reported by load_historical_data_from_cache
+        except Exception as e:
+            logger.error(f"Error loading data for {ticker}: {e}")
+
+    if not frames:
+        return pd.DataFrame(columns=['ticker'] + BAR_COLUMNS)
+    return pd.concat(frames)
+
+BAR_CACHE = BarCache(load_bars_for_cache, BAR_COLUMNS, BAR_CACHE_MEMORY_MB * 1024**2, prefetch_days=BAR_CACHE_PREFETCH_DAYS)
+
+def load_historical_data_from_cache(tickers, date):
+    day_bars = BAR_CACHE.get_days(tickers, date)
+
+    data = {}
+    for ticker in tickers: #keep the order of the candidate list
+        if ticker in day_bars:
+            data[ticker] = day_bars[ticker].to_frame()
+        else:
+            logger.warning(f'Processed data not found for ticker: {ticker}')
+
+    return data
+
+#the bar cube and the Arrow data plane are only updated by the step 1 runs with BUILD_BAR_CUBE / BUILD_ARROW_DATA_PLANE, so
+#they are only read while the versions they were built from match the processed data of the manifest (checked once per
+#manifest and source change, a warning is logged when a source is stale)
+_current_sources = {} #(source, manifest mtime, source mtime) -> True if the source holds the processed bars of the manifest
+
+def source_is_current(source, path, recorded_versions):
+    if not os.path.exists(MANIFEST_FILE):
+        return False
+    key = (source, os.stat(MANIFEST_FILE).st_mtime_ns, os.stat(path).st_mtime_ns)
+    if key not in _current_sources:
+        recorded = recorded_versions()
+        stale = [ticker for ticker, version in processed_data_versions().items() if recorded.get(ticker) != version]
+        if stale:
+            logger.warning(f"The {source} is older than the processed data of step 1 ({len(stale)} tickers changed), it isn't used until step 1 rebuilds it")
+        _current_sources[key] = not stale
+
+    return _current_sources[key]
+
+#True if the day's bars are taken from the bar cube
+def use_bar_cube():
+    return USE_BAR_CUBE and os.path.exists(CUBE_FOLDER) and source_is_current('bar cube', CUBE_FOLDER, bar_cube_versions)
+
+#bars of the tickers on the date from the bar cube, as (391 minutes, open/high/low/close) views of the memory-mapped files
+def load_day_grids(tickers, date):
+    grids = {}
+    for ticker in tickers:
+        cube = open_bar_cube(ticker)
+        grid = cube.day_prices(date) if cube is not None else None
+        if grid is not None:
+            grids[ticker] = grid
+        else:
+            logger.warning(f'Processed data not found for ticker: {ticker}')
+
+    return grids
+
+#coarse bars of the tickers on the date from the bar cube: (closes, last minutes) as (tickers, bins) arrays
+#None if a ticker has no coarse bars of the interval (the check closes are then binned from the minute grid)
+def load_day_coarse(tickers, date, interval):
+    closes, last_minutes = [], []
+    for ticker in tickers:
+        cube = open_bar_cube(ticker)
+        coarse = cube.day_coarse(date, interval) if cube is not None else None
+        if coarse is None:
+            return None
+        closes.append(coarse[0][:, CLOSE])
+        last_minutes.append(coarse[1])
+
+    return np.stack(closes), np.stack(last_minutes)
+
+#check price movement between 09:30 and 09:35 and decide to go long or short, for all the tickers of the day at once
+#day_bars: (391 minutes, open/high/low/close) grids of the bar cube (minutes 0 to 5 are 09:30 to 09:35, missing bars are NaN)
+#or DataFrames of the tickers' bars (the bars from 09:30 to 09:35 of the date are located on the sorted epochs of the index)
+#returns positions (LONG, SHORT or 0 for no trade) and ob prices (lowest/highest open or close of the candles, 0 for no trade)
+def check_price_movements(day_bars, date, use_cube=False):
+    if use_cube:
+        opening = np.stack([grid[:ENTRY_START_MINUTE + 1] for grid in day_bars]) if day_bars else np.zeros((0, ENTRY_START_MINUTE + 1, 4))
+        opens, closes = opening[:, :, OPEN].ravel(), opening[:, :, CLOSE].ravel()
+        rows = np.repeat(np.arange(len(day_bars)), ENTRY_START_MINUTE + 1)
     else:
-        return 'no_trade',0
+        calendar = get_calendar()
+        opening = [data.iloc[slice(*calendar.minute_range(data.index.asi8, date, 0, ENTRY_START_MINUTE))] for data in day_bars]
+        opens = np.concatenate([bars['open'].to_numpy() for bars in opening]) if opening else np.zeros(0)
+        closes = np.concatenate([bars['close'].to_numpy() for bars in opening]) if opening else np.zeros(0)
+        rows = np.repeat(np.arange(len(opening)), [len(bars) for bars in opening])
 
-#stop loss calculation
-def calculate_stop_loss(entry_price, atr, position_type):
-    if position_type == 'long':
-        return entry_price - (entry_price * STOP_LOSS_PERCENTAGE * atr)
-    elif position_type == 'short':
-        return entry_price + (entry_price * STOP_LOSS_PERCENTAGE * atr)
+    #if 5 or more candles had close > open, go long; if 1 or less, go short else no trade
+    return opening_range_decisions(*opening_range_stats(opens, closes, rows, len(day_bars)))
+
+#long/short decision of every candidate (date, ticker) from the opening range table, same rules as check_price_movements
+#loaded once and kept for all the trading days
+_opening_range_decisions = None
+
+def load_opening_range_decisions():
+    candidates = pd.read_csv(TOP_STOCKS_FILE, usecols=['date', 'ticker'])
+    table = load_opening_range_table(columns=['bullish_count', 'body_low', 'body_high'],
+                                     start_date=candidates['date'].min(), end_date=candidates['date'].max())
+    table = table.merge(candidates, on=['date', 'ticker'], how='inner')
+
+    positions, ob_prices = opening_range_decisions(table['bullish_count'].to_numpy(), table['body_low'].to_numpy(), table['body_high'].to_numpy())
+    positions = np.array(['short', 'no_trade', 'long'])[positions + 1] #SHORT, 0, LONG
+
+    return {(date, ticker): (position, ob_price) for date, ticker, position, ob_price in zip(table['date'], table['ticker'], positions, ob_prices)}
+
+def check_opening_range(date, ticker):
+    global _opening_range_decisions
+    if _opening_range_decisions is None:
+        _opening_range_decisions = load_opening_range_decisions()
+
+    return _opening_range_decisions.get((date, ticker), ('no_trade', 0))
 
 #trailing stop loss calculation (uncomment this function to use trailing stop loss)
 '''
@@ -109,13 +285,12 @@ def update_trailing_stop_loss(current_price, highest_price, atr, trail_percent,
     return trailing_stop, highest_price
 '''
 
-#log trades
-def log_trade(action, ticker, price, entry_time, position_type):
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-
-    log_file_path = f'logs/{LOG_FILE}'
+#trade log of the run, entries are buffered and written in bulk (every LEDGER_FLUSH_RECORDS entries and at the end)
+TRADE_LEDGER = TradeLedger(f'logs/{LOG_FILE}', columns=LOG_COLUMNS, flush_every=LEDGER_FLUSH_RECORDS)
 
+#log trades
+#trade_log is the ledger the entry goes to (the trade log of the run if None)
+def log_trade(action, ticker, price, entry_time, position_type, trade_log=None):
     log_entry = {
         'status': action,
         'ticker': ticker,
@@ -124,167 +299,122 @@ def log_trade(action, ticker, price, entry_time, position_type):
         'position_type': position_type
     }
 
-    write_header = not os.path.exists(log_file_path) #true only if file doesn't exists
-    log_df = pd.DataFrame([log_entry])
-    log_df.to_csv(log_file_path, mode='a', header=write_header, index=False)
+    (TRADE_LEDGER if trade_log is None else trade_log).append(log_entry)
 
-# main logic for a given trading day
-def process_trading_day(date):
+#long/short decision and bars of the tickers to trade on a given day
+#returns (tickers, positions (LONG/SHORT), opening range prices, closes as a (tickers, 391 minutes) grid)
+def prepare_trading_day(date):
     #get tickers for the selected day
     tickers = get_tickers_for_date(date)
-    print(f'Tickers for {date}: {tickers}')
+    logger.debug(f'Tickers for {date}: {tickers}')
+
+    #with the opening range table the decision is known before loading the bars, so only the tickers to trade are loaded
+    decisions = None
+    if USE_OPENING_RANGE_TABLE and os.path.exists(OPENING_RANGE_FILE):
+        decisions = {ticker: check_opening_range(date, ticker) for ticker in tickers}
+        tickers = [ticker for ticker in tickers if decisions[ticker][0] != 'no_trade']
+
+    #load the bars of the tickers on the selected day, as minute grids of the bar cube or as DataFrames
+    use_cube = use_bar_cube()
+    with instrumentation.timer('load_bars', date=date):
+        historical_data = load_day_grids(tickers, date) if use_cube else load_historical_data(tickers, date)
+
+    tickers = list(historical_data) #tickers with bars, in the order of the candidate list
+    if not tickers:
+        return [], np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, SESSION_MINUTES), dtype='float32')
+    day_bars = list(historical_data.values())
+    if not use_cube:
+        #bars of the session (historical data can hold the whole history of a ticker)
+        calendar = get_calendar()
+        day_bars = [data.iloc[slice(*calendar.minute_range(data.index.asi8, date))] for data in day_bars]
+
+    #long/short decision of all the tickers at once
+    if decisions is not None:
+        positions = np.array([LONG if decisions[ticker][0] == 'long' else SHORT for ticker in tickers])
+        ob_prices = np.array([decisions[ticker][1] for ticker in tickers], dtype='float64')
+    else:
+        with instrumentation.timer('opening_range', tickers=len(tickers)):
+            positions, ob_prices = check_price_movements(day_bars, date, use_cube)
 
-    #load historical data for tickers on the selected day
-    historical_data = load_historical_data(tickers)
+    trade_rows = np.flatnonzero(positions != 0)
+    if not len(trade_rows):
+        return [], np.zeros(0, dtype=int), np.zeros(0), np.zeros((0, SESSION_MINUTES), dtype='float32')
+    with instrumentation.timer('timezone_filter' if not use_cube else 'stack_grids'):
+        closes = np.stack([day_bars[i][:, CLOSE] for i in trade_rows]) if use_cube else stack_closes([day_bars[i] for i in trade_rows])
 
-    positions = [] #to store open positions for the day
+    return [tickers[i] for i in trade_rows], positions[trade_rows], np.asarray(ob_prices, dtype='float64')[trade_rows], closes
 
-    #check price movement for each ticker
-    for ticker, data in historical_data.items():
-        print(f"Analyzing {ticker}...")
-        position, ob_price = check_price_movement(data, date)
-
-        if position != 'no_trade':
-            # Define the US/Eastern timezone using pytz
-            eastern = pytz.timezone('US/Eastern')
-            # Construct the start and end times dynamically based on the date
-            start_time = pd.Timestamp(f"{date} 09:35:00").tz_localize(eastern, ambiguous='NaT')
-
-            #checking for half day
-            half_days = ['2022-07-03', '2023-07-03', '2023-11-24', '2024-07-03']
-
-            #end time is fixed for all days (full or half), unless it hit the stop loss
-            if date in half_days:
-                end_time = pd.Timestamp(f"{date} 12:55:00").tz_localize(eastern, ambiguous='NaT')
-            else:
-                end_time = pd.Timestamp(f"{date} 15:55:00").tz_localize(eastern, ambiguous='NaT')
-
-            #filtering the trading time data for a certain day (1-minute interval - intraday)
-            entry_data = data[(data.index >= start_time) & (data.index <= end_time)]
-
-            if entry_data.empty:
-                continue
-
-            #this is the time & price for the lookout of entry
-            entry_time_init = entry_data.index[0]
-            entry_price_init = data.loc[entry_time_init,'close']
-
-            entry_time = None
-            entry_price = None
-
-            #loop through the data to find the entry time that satisfy PERCENTAGE_CHANGE_BEFORE_ENTRY
-            for timestamp, row in entry_data.iterrows():
-                current_price = row['close']
-
-                if position == 'long' and current_price <= (entry_price_init - (entry_price_init * PERCENTAGE_CHANGE_BEFORE_ENTRY)):
-                    entry_time = timestamp
-                    entry_price = current_price
-                    break #got the entry, exit out of loop
-                elif position == 'short' and current_price >= (entry_price_init + (entry_price_init * PERCENTAGE_CHANGE_BEFORE_ENTRY)):
-                    entry_time = timestamp
-                    entry_price = current_price
-                    break #got the entry, exit out of loop
-
-            '''this part of code is to put a limit buy (either lowest or highest in the first 5 mins)'''
-            '''
-            entry_time = None
-            entry_price = None
-
-            #entering the trade only when we get the price (low or high in the first 5 minutes) -- (limit buy)
-            for timestamp, row in entry_data.iterrows():
-                current_price = row['close']
-
-                if position == 'long' and current_price <= ob_price:
-                    entry_time = timestamp
-                    entry_price = current_price
-                    break
-                elif position == 'short' and current_price >= ob_price:
-                    entry_time = timestamp
-                    entry_price = current_price
-                    break
-
-            #skip to the next ticker if no trade entry occured
-            if entry_time is None or entry_price is None:
-                continue
-            '''
-
-            #incase there are multiple values at the entry_price, choose the first one
-            if isinstance (entry_price, pd.Series):
-                entry_price = entry_price.iloc[0] #handle ambiguity
-            
-            '''if we want to use ATR (from processed data file) for stop loss calculation'''
-            # atr_value = data.loc[entry_time, 'ATR_14']
-            # if atr_value > 0.3: #max_atr value is 0.3 which would limit max stop loss to 3%
-            #     atr_value = 0.3
-
-            #only go for any calculation or exit position if we entered a position
-            if entry_price is not None:
-                
-                #for the exit time, the timestamp need to start from the entry time
-                entry_data = data[(data.index > entry_time) & (data.index <= end_time)] #start_time is entry_time now
-
-                #calculate stop loss for long or short
-                stop_loss = calculate_stop_loss(entry_price, atr_value, position)
-
-                #for trailing stop loss (for long it's the highest price and for short it's the lowest price)
-                #highest_price = entry_price #+ (entry_price * 0.015) 
-
-                #log the opening of the trade
-                log_trade('open', ticker, entry_price, entry_time, position)
-                
-                #monitor the intraday price action
-                exit_time = None
-                exit_price = None
-
-                #start: for setting the check interval to 5-minutes ###############################################################
-                #NOTE: this 5 minute check is only applied to exit the trade (if stop-loss hit) and not for entry
-                entry_data = entry_data.reset_index() # resetting the column to make timestamp a regular column
-                entry_data_resampled_for_5_min = entry_data.resample('5T', on='timestamp').agg({'close': 'last'}).dropna()
-                #end: for the 5-minute check code ###############################################################
-
-                #for timestamp, row in entry_data.iterrows(): 
-                #NOTE: To switch to 1-min check for exit, just replace entry_data_resampled_for_5_min with entry_data
-                for timestamp, row in entry_data_resampled_for_5_min.iterrows():
-                    current_price = row['close']
-                    
-                    if isinstance(current_price, pd.Series):
-                        current_price = current_price.iloc[0] #handle ambiguity
-
-                    #calling the trailing stop loss to get the udpated stop_loss (if applicable) and new highest price
-                    # if (position == 'long' and current_price > highest_price) or (position == 'short' and current_price < highest_price) :
-                    #     stop_loss, highest_price = update_trailing_stop_loss(current_price=current_price, highest_price=highest_price, atr=atr_value, trail_percent=trail_percent, position_type=position)
-
-                    '''this applies only for 5x timestamp; for 1-min interval, comment the next 2 lines'''
-                    time_part = timestamp.strftime('%H:%M:%S')
-                    if time_part != '09:30:00' or time_part != '09:35:00': #skip the first 2 timestamps as our start time is 09:36
-                        if position == 'long' and current_price < stop_loss:
-                            exit_time = timestamp
-                            exit_price = current_price
-                            break #stop-loss hit, exit trade
-                        elif position == 'short' and current_price > stop_loss:
-                            exit_time = timestamp
-                            exit_price = current_price
-                            break #stop-loss hit, exit trade
-
-                #if stop-loss wasn't hit, close at EOD
-                if exit_time is None:
-                    exit_time = end_time
-                    exit_price = data.loc[end_time]['close']
-
-                #log the closing of the trade
-                log_trade('close', ticker, exit_price, exit_time, position)
-
-                #store the postion
-                positions.append({
-                    'ticker': ticker,
-                    'position': positions,
-                    'entry_time': entry_time,
-                    'entry_price': entry_price,
-                    'stop_loss': stop_loss,
-                    'closing_time': exit_time,
-                    'closing_price': exit_price
-                })
+#strategy settings of the entry/exit scan (the module constants, the backtest service passes its own)
+def strategy_settings():
+    return {'stop_loss_percentage': STOP_LOSS_PERCENTAGE, 'atr': atr_value, 'entry_change': PERCENTAGE_CHANGE_BEFORE_ENTRY,
+            'check_interval': STOP_CHECK_INTERVAL}
 
+# main logic for a given trading day
+#prepared is the output of prepare_trading_day(date) if it is already loaded, settings as in strategy_settings()
+def process_trading_day(date, trade_log=None, prepared=None, settings=None):
+    trade_tickers, trade_positions, ob_prices, closes = prepared if prepared is not None else prepare_trading_day(date)
+    settings = settings if settings is not None else strategy_settings()
+
+    positions = [] #to store open positions for the day
+    if not trade_tickers:
+        return positions
+
+    #entry and exit of all the tickers of the day at once (see orb_engine.py), the trading window ends at 15:55 (12:55 on half days)
+    #entry: first close from 09:35 on that moved PERCENTAGE_CHANGE_BEFORE_ENTRY against the opening close
+    #exit: first 5-minute close after the entry beyond the stop loss, else the close at the end of the trading window
+    #the 5-minute closes are the precomputed coarse bars of the bar cube if there are any
+    #NOTE: To switch to 1-min check for exit, set STOP_CHECK_INTERVAL = 1 (check_interval of the settings)
+    #NOTE: for a limit buy (lowest or highest price in the first 5 mins), pass entry_levels=[ob_price of each ticker]
+    end_minute = session_end_minute(date)
+    use_cube = use_bar_cube()
+    check_interval = settings['check_interval']
+    coarse = load_day_coarse(trade_tickers, date, check_interval) if use_cube and check_interval > 1 else None
+    with instrumentation.timer('entry_exit_scan', tickers=len(trade_tickers)):
+        results = run_batch(closes, trade_positions, np.full(len(trade_tickers), end_minute),
+                            entry_change=settings['entry_change'], stop_loss_percentage=settings['stop_loss_percentage'], atr=settings['atr'],
+                            check_interval=check_interval, coarse=coarse)
+    instrumentation.count('ticker_days_scanned', len(trade_tickers))
+
+    '''if we want to use ATR (from processed data file) for stop loss calculation, pass atr=np.minimum(atr_14 at the entry, 0.3)'''
+    #max_atr value is 0.3 which would limit max stop loss to 3%
+
+    for i, ticker in enumerate(trade_tickers):
+        #only go for any calculation or exit position if we entered a position
+        if not results['entered'][i]:
+            continue
+        if results['exit_missing'][i]:
+            #stop loss not hit and no bar at the end of the trading window to close at: the trade is skipped (as in the parameter sweep)
+            logger.warning(f"Skipped the {ticker} trade of {date}: no bar at {minute_to_timestamp(date, end_minute)} to close it")
+            instrumentation.count('trades_missing_exit')
+            continue
+
+        position = 'long' if trade_positions[i] == LONG else 'short'
+        entry_time = minute_to_timestamp(date, results['entry_minute'][i])
+        entry_price = float(results['entry_price'][i]) #every logged price is the bar's close as float64 (see run_batch)
+
+        #log the opening of the trade
+        log_trade('open', ticker, entry_price, entry_time, position, trade_log)
+
+        if results['stop_hit'][i]:
+            exit_time = minute_to_timestamp(date, results['exit_minute'][i])
+        else:
+            #if stop-loss wasn't hit, close at EOD
+            exit_time = minute_to_timestamp(date, end_minute)
+        exit_price = float(results['exit_price'][i]) #5-minute close at the stop or close at the end of the trading window
+
+        #log the closing of the trade
+        log_trade('close', ticker, exit_price, exit_time, position, trade_log)
+
+        #store the postion
+        positions.append({
+            'ticker': ticker,
+            'position': position,
+            'entry_time': entry_time,
+            'entry_price': entry_price,
+            'stop_loss': results['stop_loss'][i],
+            'closing_time': exit_time,
+            'closing_price': exit_price
+        })
     return positions
 
 #get each trading days from the top_daily_stocks.csv file
@@ -293,21 +423,73 @@ def get_unique_dates(file_path):
     unique_dates = df['date'].dt.date.unique()
     return sorted(unique_dates) #sort before returning
 
-if __name__ == "__main__":
+def worker_constants():
+    return {name: globals()[name] for name in WORKER_CONSTANTS}
+
+#initializer of the worker processes
+def set_worker_constants(constants):
+    globals().update(constants)
+
+#run consecutive trading days in a worker process, returns the log entries of the days in date order
+def process_trading_days(dates):
+    trade_log = TradeLedger(columns=LOG_COLUMNS) #in memory only
+    for trading_date_str in dates:
+        logger.debug(f"Processing trading day: {trading_date_str}")
+        with instrumentation.timer('trading_day', date=trading_date_str):
+            process_trading_day(trading_date_str, trade_log)
+
+    return trade_log.records()
 
+#run the strategy over every trading day of the step-2 file and write the trade log
+def run_backtest():
     #delete the log folder (all content of it) before running the script (to store new log files)
     folder_path = 'logs/'
     if os.path.exists(folder_path):
         shutil.rmtree(folder_path)
 
     unique_date = get_unique_dates(TOP_STOCKS_FILE)
-    
-    for trading_date in unique_date:
-        # Process the trading for each day and get the list of positions
-        print(f"Processing trading day: {trading_date}")
 
-        trading_date_str = trading_date.strftime('%Y-%m-%d')
-        positions = process_trading_day(trading_date_str)
+    if USE_PROCESS_POOL and NUM_WORKERS and NUM_WORKERS > 1:
+        #days don't depend on each other, shards of consecutive days run in parallel and their log entries are
+        #written in date order, so the log file is the same as the one of a serial run
+        dates = [trading_date.strftime('%Y-%m-%d') for trading_date in unique_date]
+        shards = [dates[i:i + DAYS_PER_SHARD] for i in range(0, len(dates), DAYS_PER_SHARD)]
+        worker = partial(instrumentation.worker_call, instrumentation.worker_settings(), process_trading_days)
+        context = multiprocessing.get_context(POOL_START_METHOD) if POOL_START_METHOD else None
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS, mp_context=context, initializer=set_worker_constants,
+                                 initargs=(worker_constants(),)) as executor:
+            for result in executor.map(worker, shards):
+                TRADE_LEDGER.extend(instrumentation.merge_worker_result(result))
+    else:
+        for trading_date in unique_date:
+            # Process the trading for each day and get the list of positions
+            logger.debug(f"Processing trading day: {trading_date}")
+
+            trading_date_str = trading_date.strftime('%Y-%m-%d')
+            with instrumentation.timer('trading_day', date=trading_date_str):
+                positions = process_trading_day(trading_date_str)
+
+    TRADE_LEDGER.close()
+    logger.info(f"Backtest done: {len(unique_date)} trading days")
+
+    if USE_BAR_CACHE and BAR_CACHE.loads:
+        logger.info(f"Bar cache: {BAR_CACHE.stats()}")
+
+    return TRADE_LEDGER
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Run the strategy on the candidate stocks of step 2')
+    with instrumentation.stage('step3'):
+        run_backtest()
+
+    if RUN_TRADE_CALCULATIONS:
+        sys.path.append('./step-4-result')
+        from trade_calculations import run_trade_calculations # type: ignore
+        with instrumentation.stage('step4'):
+            run_trade_calculations(TRADE_LEDGER.to_frame(), strategy_params={'stop_loss_percent': STOP_LOSS_PERCENTAGE, 'atr_value': atr_value,
+                                                                            'entry_%_change (X 100)': PERCENTAGE_CHANGE_BEFORE_ENTRY,
+                                                                            'check_interval': STOP_CHECK_INTERVAL})
+    instrumentation.finish()
 
 # for test on a certain date
 # if __name__ == "__main__":
@@ -0,0 +1,147 @@
+'''
+Parameter sweep of the ORB strategy (steps 3 and 4 for a whole grid of settings in one run).
+The bars of every traded ticker-day are loaded once (same decisions and data sources as orb_stat_main.py) and each entry
+setting is evaluated on all of them at once, with every stop setting of the grid as an extra array axis (orb_engine.sweep_exits).
+The capital of every setting is then compounded day by day like trade_calculations.py does, vectorized across the settings.
+The result has one row per setting in the test_results.csv schema (plus entry_mode and trail_percent)
+
+Run it from the main folder: python step-3-run_strategy/parameter_sweep.py
+'''
+
+import itertools
+import os
+import sys
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+
+from orb_engine import find_batch_entries, sweep_exits, session_end_minute, LONG # type: ignore
+from orb_stat_main import prepare_trading_day, get_unique_dates, TOP_STOCKS_FILE # type: ignore
+import instrumentation # type: ignore
+
+sys.path.append('./step-4-result')
+from trade_calculations import starting_capital, commission_per_share # type: ignore
+
+logger = instrumentation.get_logger('parameter_sweep')
+
+SWEEP_RESULTS_FILE = 'step-4-result/sweep_results.csv'
+SWEEP_CHUNK_ROWS = 1024 #ticker-days evaluated at a time (memory is rows x stop settings x 79 check bins)
+
+#grid of settings, every combination is evaluated
+SWEEP_GRID = {
+    'stop_loss_percent': [0.03, 0.05, 0.075, 0.1],
+    'atr_value': [0.1, 0.15, 0.2, 0.3],
+    'entry_%_change (X 100)': [0.0, 0.0025, 0.005], #not used by the limit entry
+    'check_interval': [1, 5], #minutes between stop loss checks (1_min or 5_min Data_Interval)
+    'entry_mode': ['percentage', 'limit'], #'limit' enters at the lowest (long) or highest (short) price of the first 5 mins
+    'trail_percent': [None, 0.02] #trailing stop (None for the fixed stop loss)
+}
+
+#traded ticker-days of the backtest, loaded once: day index, positions, opening range prices, end minutes and closes
+def load_sweep_data():
+    days, positions, ob_prices, end_minutes, closes = [], [], [], [], []
+    for day, trading_date in enumerate(get_unique_dates(TOP_STOCKS_FILE)):
+        date = trading_date.strftime('%Y-%m-%d')
+        logger.debug(f"Loading trading day: {date}")
+        tickers, day_positions, day_ob_prices, day_closes = prepare_trading_day(date)
+        days.append(np.full(len(tickers), day))
+        positions.append(day_positions)
+        ob_prices.append(day_ob_prices)
+        end_minutes.append(np.full(len(tickers), session_end_minute(date)))
+        closes.append(day_closes)
+
+    return (np.concatenate(days), np.concatenate(positions), np.concatenate(ob_prices), np.concatenate(end_minutes),
+            np.concatenate(closes))
+
+#compound the capital day by day for every setting (columns), same arithmetic as trade_calculations.py
+#prices are (rows, settings), rows are sorted by day and not entered trades are masked out by 'entered'
+def compound_capital(days, positions, entered, entry_prices, exit_prices):
+    settings = entered.shape[1]
+    capital = np.full(settings, float(starting_capital))
+    percent_sums = {LONG: np.zeros(settings), -LONG: np.zeros(settings)}
+    trade_counts = {LONG: np.zeros(settings, dtype=int), -LONG: np.zeros(settings, dtype=int)}
+
+    day_starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if len(days) else np.zeros(0, dtype=int)
+    for start, end in zip(day_starts, np.r_[day_starts[1:], len(days)].astype(int)):
+        traded = entered[start:end]
+        n_traded = traded.sum(axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            capital_per_stock = np.where(n_traded > 0, capital / n_traded, 0.0)
+            shares = capital_per_stock / entry_prices[start:end]
+            commission = commission_per_share * shares
+            long = (positions[start:end] == LONG)[:, None]
+            change = np.where(long, exit_prices[start:end] - entry_prices[start:end], entry_prices[start:end] - exit_prices[start:end])
+            trade_profit = np.where(traded, change * shares - 2 * commission, 0.0)
+            profit_loss_percent = np.where(traded, (trade_profit / capital_per_stock) * 100, 0.0)
+
+        #capital += trade_profit one trade after the other (accumulate adds in the same order)
+        capital = np.add.accumulate(np.vstack([capital, trade_profit]), axis=0)[-1]
+        for side in (LONG, -LONG):
+            on_side = traded & ((positions[start:end] == side)[:, None])
+            percent_sums[side] += np.where(on_side, profit_loss_percent, 0.0).sum(axis=0)
+            trade_counts[side] += on_side.sum(axis=0)
+
+    return capital, percent_sums, trade_counts
+
+#evaluate every setting of the grid, returns one row per setting in the test_results.csv schema
+def run_parameter_sweep(grid=SWEEP_GRID, data=None):
+    days, positions, ob_prices, end_minutes, closes = load_sweep_data() if data is None else data
+    stop_settings = list(itertools.product(grid['stop_loss_percent'], grid['atr_value'], grid['trail_percent']))
+    stop_loss_percentages = np.array([setting[0] for setting in stop_settings], dtype='float64')
+    atrs = np.array([setting[1] for setting in stop_settings], dtype='float64')
+    trail_percents = np.array([np.nan if setting[2] is None else setting[2] for setting in stop_settings], dtype='float64')
+
+    entry_settings = [(mode, change) for mode in grid['entry_mode']
+                      for change in (grid['entry_%_change (X 100)'] if mode == 'percentage' else [None])]
+
+    results = []
+    for entry_mode, entry_change in entry_settings:
+        #entries only depend on the entry setting
+        entry_levels = ob_prices if entry_mode == 'limit' else None
+        entry_minutes, entry_prices, entered = find_batch_entries(closes, positions, end_minutes, entry_change, entry_levels)
+        eod_prices = closes[np.arange(len(closes)), end_minutes].astype('float64')
+
+        for check_interval in grid['check_interval']:
+            logger.info(f"Sweeping entry_mode={entry_mode} entry_change={entry_change} check_interval={check_interval}: {len(stop_settings)} stop settings")
+            stop_hit = np.zeros((len(closes), len(stop_settings)), dtype=bool)
+            exit_prices = np.zeros((len(closes), len(stop_settings)))
+            for start in range(0, len(closes), SWEEP_CHUNK_ROWS):
+                chunk = slice(start, start + SWEEP_CHUNK_ROWS)
+                with instrumentation.timer('entry_exit_scan', rows=len(closes[chunk]), settings=len(stop_settings)):
+                    hit, _, stop_closes = sweep_exits(closes[chunk], positions[chunk], entry_minutes[chunk], entry_prices[chunk], end_minutes[chunk],
+                                                      stop_loss_percentages, atrs, trail_percents, check_interval)
+                stop_hit[chunk] = hit
+                #float64 closes, the prices of the trade log (see run_batch)
+                exit_prices[chunk] = np.where(hit, stop_closes.astype('float64'), eod_prices[chunk][:, None])
+
+            traded = entered[:, None] & (stop_hit | ~np.isnan(eod_prices)[:, None])
+            missing = int((entered[:, None] & ~traded).any(axis=1).sum())
+            if missing:
+                logger.warning(f"Skipped {missing} trades without a bar at the end of the trading window")
+            capital, percent_sums, trade_counts = compound_capital(days, positions, traded, np.broadcast_to(entry_prices[:, None], traded.shape), exit_prices)
+
+            for i, (stop_loss_percent, atr_value, trail_percent) in enumerate(stop_settings):
+                results.append({
+                    'stop_loss_percent': stop_loss_percent,
+                    'atr_value': atr_value,
+                    'entry_%_change (X 100)': entry_change if entry_change is not None else np.nan,
+                    'long_%_return': round(percent_sums[LONG][i], 2),
+                    'total_long_trades': trade_counts[LONG][i],
+                    'short_%_return': round(percent_sums[-LONG][i], 2),
+                    'total_short_trades': trade_counts[-LONG][i],
+                    'total_%_return': round(((capital[i] - starting_capital) / starting_capital) * 100, 2),
+                    'final_capital': round(capital[i], 2),
+                    'Data_Interval': f'{check_interval}_min',
+                    'entry_mode': entry_mode,
+                    'trail_percent': trail_percent if trail_percent is not None else np.nan
+                })
+
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Evaluate a grid of strategy settings in one run')
+    with instrumentation.stage('step3'):
+        sweep_results = run_parameter_sweep()
+    sweep_results.to_csv(SWEEP_RESULTS_FILE, index=False)
+    logger.info(f"{len(sweep_results)} settings evaluated, results saved in {SWEEP_RESULTS_FILE}\n"
+                f"{sweep_results.sort_values('total_%_return', ascending=False).head(10).to_string(index=False)}")
+    instrumentation.finish()
@@ -0,0 +1,338 @@
+'''
+Event-driven (streaming) mode of the ORB strategy for live minute bars.
+Bars are consumed one at a time per ticker, in time order, from a pluggable source (a replay of the processed parquet
+files, a queue fed by another thread or a local socket) and the whole strategy runs on them as they arrive:
+- every ticker keeps its own indicator engine of step 1 (indicator_engine.py: ATR_14, Avg_Volume_14d and Relative_Volume
+  as running sums over ring buffers, O(1) per bar) with the same values as the processed files
+- the step-2 screen runs once the 09:35 bars are in (on the first later bar), followed by the check_price_movements decision
+- the entry trigger and the 5-minute stop check of orb_engine.py are evaluated on every bar of the candidates
+Signals (open/close log entries) are published as soon as they happen (on_signal), the trade log is written at the end of
+each session in the order of the batch log, so a replay of the historical data gives the same trade log as orb_stat_main.py
+
+Run it from the main folder: python step-3-run_strategy/streaming_engine.py (replays the processed data of step 1)
+'''
+
+import os
+import sys
+import time
+import socket
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+
+from orb_engine import stop_loss_levels, session_end_minute, minute_to_timestamp, TIMEZONE, SESSION_MINUTES, ENTRY_START_MINUTE, LONG, SHORT # type: ignore
+from orb_stat_main import STOP_LOSS_PERCENTAGE, atr_value, PERCENTAGE_CHANGE_BEFORE_ENTRY, LOG_COLUMNS, USE_MARKET_DATA_STORE, PROCESSED_DATA_FOLDER # type: ignore
+from trade_ledger import TradeLedger # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+from process_historical_data import indicator_engine, HISTORY_BARS # type: ignore
+from market_data_store import read_bars, list_dates, STORE_FOLDER # type: ignore
+from opening_range import OPENING_RANGE_MINUTES # type: ignore
+from trading_calendar import get_calendar # type: ignore
+import instrumentation # type: ignore
+
+sys.path.append('./step-2-get_candidate_stocks')
+from get_candidate_stocks import SCREEN_CRITERIA, TOP_STOCKS_COUNT, start_date, end_date # type: ignore
+
+logger = instrumentation.get_logger('streaming')
+
+STREAM_LOG_FILE = 'logs/trade_log_stream.csv' #trade log of the streaming run (same format as the batch log)
+STREAM_COLUMNS = ['open', 'high', 'low', 'close', 'volume'] #fields of a bar, the indicators are calculated by the engine
+STOP_CHECK_INTERVAL = 5 #minutes between stop loss checks (5-minute closes, same as the batch run)
+STREAM_HOST = '127.0.0.1' #socket_source listens on localhost only
+STREAM_PORT = 9009
+
+#opening candles (09:30 to 09:35) of a ticker in the current session
+class OpeningRange:
+    __slots__ = ('bullish', 'entry_close', 'relative_volume')
+
+    def __init__(self):
+        self.bullish = 0 #candles with close > open
+        self.entry_close = None #close of the 09:35 bar (first bar of the entry window)
+        self.relative_volume = None #Relative_Volume of the first candle that passed the screen
+
+#trade of a candidate in the current session
+class Trade:
+    __slots__ = ('ticker', 'side', 'level', 'entry_minute', 'entry_price', 'stop_loss', 'bin', 'bin_close', 'records')
+
+    def __init__(self, ticker, side):
+        self.ticker = ticker
+        self.side = side
+        self.level = None #entry level, set on the first bar of the entry window
+        self.entry_minute = -1
+        self.entry_price = None
+        self.stop_loss = None
+        self.bin = -1 #stop check bin of the last bar after the entry
+        self.bin_close = None #last close of that bin if it wasn't checked yet
+        self.records = [] #open/close log entries
+
+class StreamingEngine:
+    #trade_log: ledger the trade log is written to at the end of each session (None to only publish the signals)
+    #on_signal: called with every log entry (open/close) as soon as it happens
+    #first_date, last_date: sessions the screen runs on (same range as step 2), the indicators are updated on every bar
+    def __init__(self, trade_log=None, on_signal=None, entry_change=PERCENTAGE_CHANGE_BEFORE_ENTRY, stop_loss_percentage=STOP_LOSS_PERCENTAGE,
+                 atr=atr_value, check_interval=STOP_CHECK_INTERVAL, screen_criteria=SCREEN_CRITERIA, top_n=TOP_STOCKS_COUNT,
+                 first_date=start_date, last_date=end_date):
+        self.trade_log = trade_log
+        self.on_signal = on_signal
+        self.entry_change = entry_change
+        self.stop_loss_percentage = stop_loss_percentage
+        self.atr = atr
+        self.check_interval = check_interval
+        self.screen_criteria = screen_criteria
+        self.top_n = top_n
+        self.first_date = first_date
+        self.last_date = last_date
+        self.indicators = {} #ticker -> indicator engine, kept across sessions
+        self.date = None
+        self.bars = 0
+        self.busy_seconds = 0.0
+
+    #fill the indicator windows of a ticker from its bars before the stream starts (oldest first, the last HISTORY_BARS + 1 bars are enough)
+    def seed(self, ticker, highs, lows, closes, volumes):
+        self.indicators.setdefault(ticker, indicator_engine()).compute({'high': highs, 'low': lows, 'close': closes, 'volume': volumes})
+
+    def start_session(self, date):
+        if self.date is not None:
+            self.end_session()
+        self.date = date
+        self.end_minute = session_end_minute(date)
+        self.screen_day = self.first_date <= date <= self.last_date
+        self.last_minutes = {} #last minute of each ticker in the session (the first bar of a minute is used)
+        self.opening = {} #ticker -> OpeningRange
+        self.screened = False
+        self.trades = {} #candidates to trade in the order of the screen -> Trade
+
+    #one minute bar of a ticker, minute is the offset from 09:30 of the date (YYYY-MM-DD, US/Eastern)
+    def on_bar(self, ticker, date, minute, open_, high, low, close, volume):
+        if minute < 0 or minute >= SESSION_MINUTES:
+            return #outside trading hours (dropped by step 1 as well)
+        if date != self.date:
+            self.start_session(date)
+
+        engine = self.indicators.get(ticker)
+        if engine is None:
+            engine = self.indicators[ticker] = indicator_engine()
+        engine.update({'high': high, 'low': low, 'close': close, 'volume': volume})
+
+        if minute <= self.last_minutes.get(ticker, -1):
+            return
+        self.last_minutes[ticker] = minute
+
+        if minute < OPENING_RANGE_MINUTES:
+            if self.screen_day:
+                self.on_opening_bar(ticker, minute, open_, close, engine)
+            return
+        if not self.screened:
+            self.run_screen()
+
+        trade = self.trades.get(ticker)
+        if trade is not None:
+            self.on_trade_bar(trade, minute, close)
+
+    def on_opening_bar(self, ticker, minute, open_, close, engine):
+        opening = self.opening.get(ticker)
+        if opening is None:
+            opening = self.opening[ticker] = OpeningRange()
+        opening.bullish += close > open_
+        if minute == ENTRY_START_MINUTE:
+            opening.entry_close = close
+
+        if opening.relative_volume is None:
+            values = dict(engine.values(), open=open_)
+            if all(values[column] >= minimum for column, minimum in self.screen_criteria.items()): #NaN never qualifies
+                opening.relative_volume = values['Relative_Volume']
+
+    #top stocks of the day by Relative_Volume (ties by ticker, as rank_top_stocks) and their long/short decision
+    #called on the first bar after 09:35 (or at the end of the session), the 09:35 bars of the candidates are replayed
+    def run_screen(self):
+        self.screened = True
+        if not self.screen_day:
+            return
+        qualified = sorted((-opening.relative_volume, ticker) for ticker, opening in self.opening.items() if opening.relative_volume is not None)
+        candidates = [ticker for _, ticker in qualified[:self.top_n]]
+        if candidates:
+            logger.debug(f'Tickers for {self.date}: {candidates}')
+
+        for ticker in candidates:
+            #same rule as check_price_movements: 5 or 6 bullish candles go long, 0 or 1 go short
+            bullish = self.opening[ticker].bullish
+            side = LONG if bullish >= 5 else SHORT if bullish <= 1 else 0
+            if side:
+                trade = self.trades[ticker] = Trade(ticker, side)
+                if self.opening[ticker].entry_close is not None:
+                    self.on_trade_bar(trade, ENTRY_START_MINUTE, self.opening[ticker].entry_close)
+
+    #entry trigger and stop check of a candidate, same decisions as orb_engine.run_batch
+    def on_trade_bar(self, trade, minute, close):
+        if minute > self.end_minute or len(trade.records) == 2: #after the trading window or already closed
+            return
+
+        if trade.entry_minute < 0:
+            if trade.level is None:
+                #first close of the entry window -/+ entry_change, in the bars' float32 arithmetic
+                init = np.float32(close)
+                trade.level = float(init - (init * self.entry_change) if trade.side == LONG else init + (init * self.entry_change))
+            if close <= trade.level if trade.side == LONG else close >= trade.level:
+                trade.entry_minute = minute
+                trade.entry_price = close
+                trade.stop_loss = float(stop_loss_levels(close, trade.side, self.stop_loss_percentage, self.atr))
+                self.signal(trade, 'open', close, minute)
+                if minute == self.end_minute:
+                    self.signal(trade, 'close', close, minute)
+            return
+
+        #bars after the entry are binned by check_interval minutes, a bin is checked once it is complete
+        bin = minute // self.check_interval
+        if bin != trade.bin:
+            if self.check_stop(trade):
+                return
+            trade.bin = bin
+        trade.bin_close = close
+        if (minute + 1) % self.check_interval == 0 or minute == self.end_minute:
+            if self.check_stop(trade):
+                return
+        if minute == self.end_minute:
+            #stop loss wasn't hit, close at the end of the trading window
+            self.signal(trade, 'close', close, minute)
+
+    #check the last bin of a trade against its stop loss, the exit is logged at the bin's time and close
+    def check_stop(self, trade):
+        close = trade.bin_close
+        if close is None:
+            return False
+        trade.bin_close = None
+        if close < trade.stop_loss if trade.side == LONG else close > trade.stop_loss:
+            self.signal(trade, 'close', close, trade.bin * self.check_interval)
+            return True
+
+        return False
+
+    def signal(self, trade, action, price, minute):
+        log_entry = {
+            'status': action,
+            'ticker': trade.ticker,
+            'price': price,
+            'timestamp': minute_to_timestamp(self.date, minute),
+            'position_type': 'long' if trade.side == LONG else 'short'
+        }
+        trade.records.append(log_entry)
+        if self.on_signal is not None:
+            self.on_signal(log_entry)
+
+    #close the session: open trades are checked one last time and the day's log entries are written in the batch order
+    def end_session(self):
+        if self.date is None:
+            return
+        if not self.screened:
+            self.run_screen()
+
+        for trade in self.trades.values():
+            if len(trade.records) == 1 and not self.check_stop(trade):
+                #no bar at the end of the trading window to close at: the trade is left out of the log, as in the batch run
+                logger.warning(f"Skipped the {trade.ticker} trade of {self.date}: no bar at {minute_to_timestamp(self.date, self.end_minute)} to close it")
+                continue
+            if self.trade_log is not None:
+                self.trade_log.extend(trade.records)
+        self.date = None
+
+    #consume a source of bars (tuples of on_bar's arguments) until it ends
+    def run(self, source):
+        for bar in source:
+            start = time.perf_counter()
+            self.on_bar(*bar)
+            self.busy_seconds += time.perf_counter() - start
+            self.bars += 1
+        self.end_session()
+
+    def stats(self):
+        return {'bars': self.bars, 'tickers': len(self.indicators),
+                'us_per_bar': round(self.busy_seconds / self.bars * 1e6, 2) if self.bars else 0.0}
+
+#bars of a DataFrame (indexed by the tz-aware timestamp, with a 'ticker' column and the STREAM_COLUMNS) as stream tuples in time order
+def frame_to_bars(df):
+    if df.empty:
+        return iter(())
+    epoch_ns = df.index.asi8
+    order = np.lexsort((df['ticker'].to_numpy(), epoch_ns))
+    days, minutes = get_calendar().session_minutes(epoch_ns)
+
+    columns = [df['ticker'].to_numpy(), get_calendar().date_strings(days), minutes] + [df[column].to_numpy() for column in STREAM_COLUMNS]
+    return zip(*[column[order].tolist() for column in columns])
+
+#replay of the processed bars between two dates (inclusive), read from the market data store one trading day at a time
+#(or from the processed files one month at a time)
+def replay_processed_bars(first_date, last_date, tickers=None):
+    if USE_MARKET_DATA_STORE and os.path.exists(STORE_FOLDER):
+        for date in list_dates():
+            if first_date <= date <= last_date:
+                yield from frame_to_bars(read_bars(tickers, date=date, columns=STREAM_COLUMNS))
+        return
+
+    tickers = tickers if tickers is not None else sorted(file[:-len('.parquet')] for file in os.listdir(PROCESSED_DATA_FOLDER) if file.endswith('.parquet'))
+    for month in pd.period_range(first_date, last_date, freq='M'):
+        start_ns, end_ns = get_calendar().date_range_ns(max(first_date, str(month.start_time.date())), min(last_date, str(month.end_time.date())))
+        start, end = pd.Timestamp(start_ns, tz=TIMEZONE), pd.Timestamp(end_ns, tz=TIMEZONE)
+        frames = []
+        for ticker in tickers:
+            file_path = os.path.join(PROCESSED_DATA_FOLDER, f'{ticker}.parquet')
+            if os.path.exists(file_path):
+                frames.append(pd.read_parquet(file_path, columns=STREAM_COLUMNS, filters=[('timestamp', '>=', start), ('timestamp', '<', end)]).assign(ticker=ticker))
+        if frames:
+            yield from frame_to_bars(pd.concat(frames))
+
+#seed the indicator windows of every ticker with its last bars before first_date (from the processed files)
+def warm_up(engine, first_date, tickers=None):
+    tickers = tickers if tickers is not None else sorted(file[:-len('.parquet')] for file in os.listdir(PROCESSED_DATA_FOLDER) if file.endswith('.parquet'))
+    start = pd.Timestamp(get_calendar().date_range_ns(first_date, first_date)[0], tz=TIMEZONE)
+    for ticker in tickers:
+        file_path = os.path.join(PROCESSED_DATA_FOLDER, f'{ticker}.parquet')
+        if not os.path.exists(file_path):
+            continue
+        bars = pd.read_parquet(file_path, columns=['high', 'low', 'close', 'volume'], filters=[('timestamp', '<', start)]).iloc[-(HISTORY_BARS + 1):]
+        engine.seed(ticker, bars['high'], bars['low'], bars['close'], bars['volume'])
+
+#bars put on a queue by another thread (e.g. a broker feed) as on_bar tuples, None ends the stream
+def queue_source(bar_queue):
+    while True:
+        bar = bar_queue.get()
+        if bar is None:
+            return
+        yield bar
+
+#on_bar tuple of a text line 'ticker,epoch_seconds,open,high,low,close,volume', the US/Eastern date and minute offset of every
+#bar come from the trading calendar, prices are rounded to float32 like the processed data
+#returns None for a bar outside the trading hours (pre-market, after-hours or a day without a session)
+def parse_bar_line(line):
+    ticker, epoch, open_, high, low, close, volume = line.rstrip('\n').split(',')
+    calendar = get_calendar()
+    days, minutes = calendar.session_minutes([int(epoch) * 10**9])
+    day, minute = int(days[0]), int(minutes[0])
+    if not calendar.is_session[day] or minute < 0 or minute >= SESSION_MINUTES:
+        return None
+    return (ticker, calendar.date_strings(day), minute, float(np.float32(open_)), float(np.float32(high)), float(np.float32(low)),
+            float(np.float32(close)), int(round(float(volume))))
+
+#bars sent to a local TCP socket as text lines (see parse_bar_line, one connection, the stream ends when it is closed)
+def socket_source(host=STREAM_HOST, port=STREAM_PORT):
+    with socket.create_server((host, port)) as server:
+        connection, _ = server.accept()
+        with connection, connection.makefile('r') as lines:
+            for line in lines:
+                bar = parse_bar_line(line)
+                if bar is not None:
+                    yield bar
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Replay the processed bars through the streaming engine')
+    if os.path.exists(STREAM_LOG_FILE):
+        os.remove(STREAM_LOG_FILE)
+    trade_log = TradeLedger(STREAM_LOG_FILE, columns=LOG_COLUMNS)
+    engine = StreamingEngine(trade_log)
+
+    #replay the screen's date range, the indicator windows start from the bars before it
+    with instrumentation.stage('step3'):
+        warm_up(engine, start_date)
+        engine.run(replay_processed_bars(start_date, end_date))
+        trade_log.close()
+    logger.info(f"Streaming replay: {engine.stats()}, trade log saved in {STREAM_LOG_FILE}")
+    instrumentation.finish()
@@ -0,0 +1,117 @@
+'''
+Buffered, columnar trade ledger used for the trade log of step 3 and the trade details of step 4.
+Records are appended to in-memory columns and written in bulk (every flush_every records and on close) instead of one
+append to the file per trade. The output is CSV or Parquet (by the file extension). The CSV is the same as the one written
+by one DataFrame.to_csv(mode='a') per record, and the records stay available in memory (to_frame()) so step 4 can take the
+trade log straight from step 3's process
+'''
+
+import os
+import sys
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.parquet as pq # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+import instrumentation # type: ignore
+
+LEDGER_FLUSH_RECORDS = 10_000 #records buffered before they are written to the file
+
+class TradeLedger:
+    #file_path: output file (.csv or .parquet), None to keep the records in memory only
+    #columns: column names in output order (taken from the first record if None)
+    #keep_records: keep the flushed records in memory for to_frame() (only the unflushed ones are kept otherwise)
+    def __init__(self, file_path=None, columns=None, flush_every=LEDGER_FLUSH_RECORDS, keep_records=True):
+        self.file_path = file_path
+        self.columns = {column: [] for column in columns} if columns is not None else None
+        self.flush_every = flush_every
+        self.keep_records = keep_records
+        self.flushed = 0 #records of the columns already written to the file
+        self.parquet_writer = None
+        self.output_format = 'parquet' if file_path is not None and file_path.endswith('.parquet') else 'csv'
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def append(self, record):
+        if self.columns is None:
+            self.columns = {column: [] for column in record}
+        for column, values in self.columns.items():
+            values.append(record[column])
+        if self.file_path is not None and len(self) - self.flushed >= self.flush_every:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    #records as a list of dicts (e.g. to send the records of a worker process back)
+    def records(self):
+        if not self.columns:
+            return []
+        return [dict(zip(self.columns, values)) for values in zip(*self.columns.values())]
+
+    #object columns keep every value formatted as its own type (ints stay ints, prices are float64 and written in full)
+    def _frame(self, start=0):
+        return pd.DataFrame({column: pd.Series(values[start:], dtype=object) for column, values in self.columns.items()})
+
+    #typed DataFrame of the records (from record 'start' on) with the dtypes the CSV is read back with: numbers as int64 or
+    #float64 and timestamps as tz-aware datetimes
+    def to_frame(self, start=0):
+        if self.columns is None:
+            return pd.DataFrame()
+        df = self._frame(start)
+        if df.empty:
+            return df
+        for column in df.columns:
+            values = df[column]
+            if values.map(lambda value: isinstance(value, (int, float)) or (hasattr(value, 'dtype') and value.dtype.kind in 'iuf')).all():
+                df[column] = pd.to_numeric(values)
+                if df[column].dtype.kind == 'f':
+                    df[column] = df[column].astype('float64')
+            elif values.map(lambda value: isinstance(value, pd.Timestamp)).all():
+                tz = values.iloc[0].tz
+                df[column] = pd.to_datetime(values.tolist(), utc=tz is not None)
+                if tz is not None:
+                    df[column] = df[column].dt.tz_convert(tz)
+
+        return df
+
+    #write the records not written yet
+    def flush(self):
+        if self.file_path is None or self.columns is None:
+            return
+        instrumentation.count('log_records_written', len(self) - self.flushed)
+        with instrumentation.timer('log_write', file=self.file_path, records=len(self) - self.flushed):
+            self._write_pending()
+
+        if self.keep_records:
+            self.flushed = len(self)
+        else:
+            for values in self.columns.values():
+                values.clear()
+            self.flushed = 0
+
+    def _write_pending(self):
+        directory = os.path.dirname(self.file_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if self.output_format == 'csv':
+            write_header = not os.path.exists(self.file_path)
+            pending = self._frame(self.flushed)
+            if len(pending) or write_header:
+                pending.to_csv(self.file_path, mode='a', header=write_header, index=False)
+        elif len(self) > self.flushed:
+            table = pa.Table.from_pandas(self.to_frame(self.flushed), preserve_index=False)
+            if self.parquet_writer is None:
+                self.parquet_writer = pq.ParquetWriter(self.file_path, table.schema, compression='zstd')
+            else:
+                table = table.cast(self.parquet_writer.schema)
+            self.parquet_writer.write_table(table)
+
+    def close(self):
+        self.flush()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+            self.parquet_writer = None
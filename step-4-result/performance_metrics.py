@@ -0,0 +1,123 @@
+'''
+Vectorized trade accounting and performance metrics used by trade_calculations.py.
+The open/close events of the trade log are paired into a trade table in one step, every trading day gets an equal share
+of the capital per traded ticker (capital at the start of the day / tickers of the day), and the compounded equity curve,
+the daily returns and the metrics (max drawdown, annualized volatility and Sharpe ratio, alpha and beta against a benchmark
+read from a local file) are calculated with array operations instead of a loop over days and tickers
+'''
+
+import os
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+
+TRADING_DAYS_PER_YEAR = 252
+BENCHMARK_FILE = 'step-4-result/benchmark.csv' #daily closes of the benchmark (columns: date, close), .csv or .parquet
+BENCHMARK_TICKER = 'SPY' #used when there is no BENCHMARK_FILE: daily closes from the processed 1-minute file of this ticker (step 1)
+PROCESSED_DATA_FOLDER = './processed_data_new'
+
+#one row per (date, ticker) with both an open and a close event, in the order the tickers first show up on each day
+#(the first open and the first close of the ticker on that day are used), n_tickers is the number of tickers in the log that day
+def build_trade_table(log_df):
+    log_df = log_df.reset_index(drop=True)
+    first_seen = log_df.drop_duplicates(['date', 'ticker'])[['date', 'ticker']]
+    first_seen['order'] = np.arange(len(first_seen))
+    n_tickers = first_seen.groupby('date').size().rename('n_tickers')
+
+    opens = log_df[log_df['status'] == 'open'].drop_duplicates(['date', 'ticker'])
+    closes = log_df[log_df['status'] == 'close'].drop_duplicates(['date', 'ticker'])
+    trades = opens[['date', 'ticker', 'position_type', 'timestamp', 'price']].rename(columns={'timestamp': 'entry_time', 'price': 'entry_price'})
+    trades = trades.merge(closes[['date', 'ticker', 'timestamp', 'price']].rename(columns={'timestamp': 'exit_time', 'price': 'exit_price'}),
+                          on=['date', 'ticker'], how='inner')
+    trades = trades.merge(first_seen, on=['date', 'ticker']).sort_values(['date', 'order'], kind='stable')
+
+    return trades.drop(columns='order').join(n_tickers, on='date').reset_index(drop=True)
+
+#capital allocation, shares, commission and profit/loss of every trade, capital is compounded from one day to the next
+#returns (trade details, daily equity curve (capital at the end of each day) indexed by date)
+def apply_sizing(trades, starting_capital, commission_per_share):
+    entry = trades['entry_price'].to_numpy(dtype='float64')
+    exit = trades['exit_price'].to_numpy(dtype='float64')
+    n_tickers = trades['n_tickers'].to_numpy(dtype='float64')
+    change = np.where(trades['position_type'].to_numpy() == 'long', exit - entry, entry - exit)
+
+    #return of each trade on its allocated capital, the day return is the mean over the tickers of the day
+    trade_return = (change - 2 * commission_per_share) / entry / n_tickers
+    day_codes, day_index = np.unique(trades['date'].to_numpy(), return_inverse=True)
+    day_return = np.bincount(day_index, weights=trade_return, minlength=len(day_codes))
+    day_end_capital = starting_capital * np.cumprod(1 + day_return)
+    day_start_capital = np.r_[starting_capital, day_end_capital[:-1]]
+
+    capital_per_stock = day_start_capital[day_index] / n_tickers
+    shares = capital_per_stock / entry
+    commission = commission_per_share * shares
+    trade_profit = change * shares - 2 * commission
+    updated_capital = day_start_capital[day_index] + pd.Series(trade_profit).groupby(day_index).cumsum().to_numpy()
+
+    details = pd.DataFrame({
+        'ticker': trades['ticker'],
+        'position_type': trades['position_type'],
+        'entry_time': trades['entry_time'],
+        'exit_time': trades['exit_time'],
+        'entry_price': entry,
+        'exit_price': exit,
+        'capital_allocated': capital_per_stock,
+        'shares_traded': shares,
+        'profit/loss': trade_profit,
+        '% of profit/loss': np.where(capital_per_stock > 0, trade_profit / capital_per_stock * 100, 0.0),
+        'updated_capital': updated_capital
+    })
+    equity = pd.Series(day_end_capital, index=pd.Index(day_codes, name='date'), name='capital')
+
+    return details, equity
+
+#daily closes of the benchmark indexed by date, None if there is neither a benchmark file nor a processed file of BENCHMARK_TICKER
+def load_benchmark(file_path=BENCHMARK_FILE, ticker=BENCHMARK_TICKER, processed_folder=PROCESSED_DATA_FOLDER):
+    if os.path.exists(file_path):
+        df = pd.read_parquet(file_path) if file_path.endswith('.parquet') else pd.read_csv(file_path)
+        closes = df.set_index(pd.to_datetime(df['date']).dt.date)['close']
+    elif os.path.exists(os.path.join(processed_folder, f'{ticker}.parquet')):
+        bars = pd.read_parquet(os.path.join(processed_folder, f'{ticker}.parquet'), columns=['close'])
+        closes = bars['close'].groupby(bars.index.tz_convert('US/Eastern').date).last()
+    else:
+        return None
+
+    return closes.astype('float64').sort_index()
+
+#daily returns of the strategy on every trading day of the backtest (0 on days without trades)
+#trading days are the benchmark's days inside the backtest when a benchmark is given, the days of the trade log otherwise
+def daily_returns_from_equity(equity, starting_capital, benchmark=None):
+    returns = pd.concat([pd.Series([starting_capital]), pd.Series(equity.to_numpy())]).pct_change().iloc[1:]
+    returns.index = equity.index
+    if benchmark is not None and len(equity):
+        days = benchmark.index[(benchmark.index >= equity.index[0]) & (benchmark.index <= equity.index[-1])]
+        returns = returns.reindex(returns.index.union(days), fill_value=0.0)
+
+    return returns
+
+#Alpha (annualized), Beta, Sharpe Ratio (annualized), Max Drawdown and Volatility (annualized) as fractions
+def calculate_metrics(equity, starting_capital, risk_free_rate, benchmark=None):
+    returns = daily_returns_from_equity(equity, starting_capital, benchmark)
+    daily_risk_free = risk_free_rate / TRADING_DAYS_PER_YEAR
+
+    curve = np.r_[starting_capital, equity.to_numpy()]
+    drawdown = 1 - curve / np.maximum.accumulate(curve)
+    volatility = returns.std(ddof=0) * np.sqrt(TRADING_DAYS_PER_YEAR) if len(returns) else np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = (returns.mean() - daily_risk_free) / returns.std(ddof=0) * np.sqrt(TRADING_DAYS_PER_YEAR) if len(returns) else np.nan
+
+    alpha = beta = np.nan
+    if benchmark is not None:
+        benchmark_returns = benchmark.pct_change().reindex(returns.index)
+        paired = pd.DataFrame({'strategy': returns, 'benchmark': benchmark_returns}).dropna()
+        if len(paired) > 1 and paired['benchmark'].var(ddof=0) > 0:
+            beta = np.cov(paired['strategy'], paired['benchmark'], ddof=0)[0, 1] / paired['benchmark'].var(ddof=0)
+            excess = (paired['strategy'].mean() - daily_risk_free) - beta * (paired['benchmark'].mean() - daily_risk_free)
+            alpha = excess * TRADING_DAYS_PER_YEAR
+
+    return {
+        'Alpha': alpha,
+        'Beta': beta,
+        'Sharpe Ratio': sharpe,
+        'Max Drawdown': drawdown.max(),
+        'Volatility': volatility
+    }
@@ -0,0 +1,166 @@
+'''
+Minute-resolution mark-to-market of the portfolio of the backtest.
+trade_calculations.py books every trade at its close; this simulator marks all the positions that are open at the same time
+on every minute of every session (09:30 to the close of the trading calendar), with the sizing of the trade details
+(shares, commissions and the compounded capital at the start of the day):
+- a position is held from its entry minute to its exit minute, marked at the last close of its ticker (forward filled,
+  the entry price until the first later bar) and booked at its exit price from the exit minute on
+- commissions are charged at the entry and at the exit, so the equity at the end of a day is the capital of trade_calculations.py
+Per minute it gives equity, P&L of the day, gross and net exposure, open positions and the drawdown from the running peak
+of the minute equity (the intraday drawdown the end of day equity curve can't see).
+A session is a (trades, minutes) array computation and only one session is in memory at a time; the minute rows are
+written to PORTFOLIO_MINUTES_FILE session by session
+
+Run it from the main folder after step 4: python step-4-result/portfolio_simulator.py
+'''
+
+import os
+import sys
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pyarrow as pa # type: ignore
+import pyarrow.parquet as pq # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+sys.path.append('./step-3-run_strategy')
+sys.path.append('./step-4-result')
+import instrumentation # type: ignore
+from trading_calendar import get_calendar, SESSION_MINUTES # type: ignore
+from bar_cube import CLOSE # type: ignore
+from trade_calculations import load_trade_log, calculate_trades, trade_details_file, commission_per_share # type: ignore
+
+logger = instrumentation.get_logger('portfolio')
+
+PORTFOLIO_MINUTES_FILE = 'logs/portfolio_minutes.parquet' #one row per session minute with trades
+PORTFOLIO_SUMMARY_FILE = 'logs/portfolio_summary.csv'
+MINUTE_COLUMNS = ['timestamp', 'equity', 'day_pnl', 'gross_exposure', 'net_exposure', 'open_positions', 'drawdown']
+
+#trade details of step 4 (csv or parquet), calculated from the trade log of step 3 if the file doesn't exist
+def load_trade_details(file_path=trade_details_file):
+    if os.path.exists(file_path):
+        return pd.read_parquet(file_path) if file_path.endswith('.parquet') else pd.read_csv(file_path)
+
+    trade_details, _ = calculate_trades(load_trade_log())
+    return trade_details
+
+#trades as arrays: date, entry/exit minute offsets from 09:30, side (+1 long, -1 short), prices and shares, in date order
+def prepare_trades(trade_details):
+    calendar = get_calendar()
+    days, entry_minutes = calendar.session_minutes(pd.DatetimeIndex(pd.to_datetime(trade_details['entry_time'], utc=True)).asi8)
+    _, exit_minutes = calendar.session_minutes(pd.DatetimeIndex(pd.to_datetime(trade_details['exit_time'], utc=True)).asi8)
+
+    return pd.DataFrame({
+        'date': calendar.date_strings(days),
+        'ticker': trade_details['ticker'].to_numpy(),
+        'entry_minute': entry_minutes,
+        'exit_minute': exit_minutes,
+        'side': np.where(trade_details['position_type'].to_numpy() == 'long', 1.0, -1.0),
+        'entry_price': trade_details['entry_price'].to_numpy(dtype='float64'),
+        'exit_price': trade_details['exit_price'].to_numpy(dtype='float64'),
+        'shares': trade_details['shares_traded'].to_numpy(dtype='float64'),
+        'day_start_capital': trade_details['updated_capital'].to_numpy(dtype='float64') - trade_details['profit/loss'].to_numpy(dtype='float64')
+    })
+
+#closes of the tickers on the date as a (tickers, SESSION_MINUTES) grid (NaN where there is no bar), from the bar cube if
+#step 1 built it, from the day's bars of step 3's data sources otherwise
+def load_day_closes(tickers, date):
+    from orb_stat_main import load_day_grids, load_historical_data, use_bar_cube # type: ignore
+    from orb_engine import stack_closes # type: ignore
+
+    if use_bar_cube():
+        grids = load_day_grids(tickers, date)
+        return np.stack([grids[ticker][:, CLOSE] if ticker in grids else np.full(SESSION_MINUTES, np.nan) for ticker in tickers]).astype('float64')
+
+    data = load_historical_data(tickers, date)
+    frames = [data[ticker].iloc[slice(*get_calendar().minute_range(data[ticker].index.asi8, date))] if ticker in data
+              else pd.DataFrame({'close': np.zeros(0)}, index=pd.DatetimeIndex([], tz='UTC')) for ticker in tickers]
+    return stack_closes(frames).astype('float64')
+
+#last close at or before every minute (NaN before the first bar)
+def forward_fill(closes):
+    positions = np.where(np.isfinite(closes), np.arange(closes.shape[1]), 0)
+    np.maximum.accumulate(positions, axis=1, out=positions)
+    return np.take_along_axis(closes, positions, axis=1)
+
+#minute marks of one session: trades of the day (rows of prepare_trades) and their (trades, minutes) closes
+#returns equity, day P&L, gross and net exposure and open positions for the minutes 0 to n_minutes - 1
+def mark_session(trades, closes, n_minutes):
+    minutes = np.arange(n_minutes)
+    entry = trades['entry_minute'].to_numpy()[:, None]
+    exit = trades['exit_minute'].to_numpy()[:, None]
+    side = trades['side'].to_numpy()[:, None]
+    shares = trades['shares'].to_numpy()[:, None]
+    entry_price = trades['entry_price'].to_numpy()[:, None]
+    exit_price = trades['exit_price'].to_numpy()[:, None]
+
+    held = (minutes >= entry) & (minutes < exit)
+    marks = forward_fill(closes[:, :n_minutes])
+    marks = np.where(np.isfinite(marks) & (minutes > entry), marks, entry_price) #entry price until the first bar after the entry
+    marks = np.where(minutes >= exit, exit_price, marks)
+
+    commission = commission_per_share * shares
+    pnl = np.where(minutes >= entry, side * shares * (marks - entry_price) - commission, 0.0) - np.where(minutes >= exit, commission, 0.0)
+    value = np.where(held, shares * marks, 0.0)
+    day_pnl = pnl.sum(axis=0)
+
+    return {
+        'equity': trades['day_start_capital'].iloc[0] + day_pnl,
+        'day_pnl': day_pnl,
+        'gross_exposure': value.sum(axis=0),
+        'net_exposure': (side * value).sum(axis=0),
+        'open_positions': held.sum(axis=0).astype('int32')
+    }
+
+#mark every session of the trade details, writes the minute rows to minutes_file and returns the summary metrics
+def run_portfolio_simulation(trade_details=None, minutes_file=PORTFOLIO_MINUTES_FILE):
+    if trade_details is None:
+        trade_details = load_trade_details()
+    trades = prepare_trades(trade_details)
+    calendar = get_calendar()
+
+    writer = None
+    peak = trades['day_start_capital'].iloc[0] if len(trades) else 0.0
+    summary = {'sessions': 0, 'minutes': 0, 'max_intraday_drawdown': 0.0, 'max_gross_exposure': 0.0, 'max_gross_leverage': 0.0,
+               'max_net_exposure': 0.0, 'min_net_exposure': 0.0, 'max_open_positions': 0, 'min_equity': np.nan, 'final_equity': np.nan}
+    try:
+        for date, day_trades in trades.groupby('date', sort=True):
+            with instrumentation.timer('mark_session', date=date, trades=len(day_trades)):
+                n_minutes = calendar.close_minute[calendar.day_number(date)] + 1
+                closes = load_day_closes(day_trades['ticker'].tolist(), date)
+                marks = mark_session(day_trades, closes, n_minutes)
+
+                #drawdown from the running peak of the minute equity (the peak carries over from the previous sessions)
+                running_peak = np.maximum.accumulate(np.maximum(marks['equity'], peak))
+                marks['drawdown'] = 1 - marks['equity'] / running_peak
+                peak = running_peak[-1]
+                marks['timestamp'] = pd.DatetimeIndex(calendar.minute_epoch_ns(date, 0) + np.arange(n_minutes, dtype='int64') * 60 * 10**9).tz_localize('UTC').tz_convert('US/Eastern')
+
+            with instrumentation.timer('log_write', file=minutes_file):
+                table = pa.Table.from_pandas(pd.DataFrame({column: marks[column] for column in MINUTE_COLUMNS}), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(minutes_file, table.schema, compression='zstd')
+                writer.write_table(table)
+
+            summary['sessions'] += 1
+            summary['minutes'] += n_minutes
+            summary['max_intraday_drawdown'] = max(summary['max_intraday_drawdown'], marks['drawdown'].max())
+            summary['max_gross_exposure'] = max(summary['max_gross_exposure'], marks['gross_exposure'].max())
+            summary['max_gross_leverage'] = max(summary['max_gross_leverage'], (marks['gross_exposure'] / marks['equity']).max())
+            summary['max_net_exposure'] = max(summary['max_net_exposure'], marks['net_exposure'].max())
+            summary['min_net_exposure'] = min(summary['min_net_exposure'], marks['net_exposure'].min())
+            summary['max_open_positions'] = max(summary['max_open_positions'], int(marks['open_positions'].max()))
+            summary['min_equity'] = np.fmin(summary['min_equity'], marks['equity'].min())
+            summary['final_equity'] = marks['equity'][-1]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return summary
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Minute mark-to-market equity, exposure and drawdown of the backtest trades')
+    with instrumentation.stage('step4'):
+        summary = run_portfolio_simulation()
+    pd.DataFrame([summary]).to_csv(PORTFOLIO_SUMMARY_FILE, index=False)
+    logger.info(f"Minute equity saved in {PORTFOLIO_MINUTES_FILE}, summary in {PORTFOLIO_SUMMARY_FILE}\n{pd.Series(summary).to_string()}")
+    instrumentation.finish()
@@ -0,0 +1,167 @@
+'''
+Monte Carlo robustness analysis of the backtest result: percentile bands for the headline metrics of final_metrics.csv
+(Total Return (%), Sharpe Ratio, Max Drawdown, Volatility) instead of the single estimate of one path.
+The daily returns are rebuilt from the trade details of step 4 (or from the trade log of step 3) with the same compounding
+as trade_calculations.py, and resampled in two ways:
+- block_bootstrap: circular block bootstrap of the daily returns (blocks of BLOCK_DAYS days keep short runs of good and bad days)
+- trade_shuffle: the trade returns (on their allocated capital) are shuffled across the trade slots of the backtest, so
+  every day keeps its number of trades and capital split but gets other trades
+Resamples are evaluated as (resamples, days) arrays, RESAMPLE_CHUNK at a time, and chunks are spread across the cores.
+Every chunk has its own random stream (spawned from SEED), so the result doesn't depend on the number of workers.
+Alpha and Beta are not resampled (they need the benchmark path of the same days)
+
+Run it from the main folder after step 4: python step-4-result/robustness_analysis.py
+'''
+
+import os
+import sys
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+
+sys.path.append('./step-1-process_historical_data')
+sys.path.append('./step-4-result')
+import instrumentation # type: ignore
+from performance_metrics import load_benchmark, daily_returns_from_equity, TRADING_DAYS_PER_YEAR # type: ignore
+from trade_calculations import load_trade_log, calculate_trades, trade_details_file, starting_capital, risk_free_rate # type: ignore
+
+logger = instrumentation.get_logger('robustness')
+
+ROBUSTNESS_OUTPUT_FILE = 'logs/robustness_metrics.csv'
+RESAMPLE_METHODS = ['block_bootstrap', 'trade_shuffle']
+NUM_RESAMPLES = 100_000 #resamples per method
+BLOCK_DAYS = 5 #days per block of the block bootstrap
+RESAMPLE_CHUNK = 5_000 #resamples evaluated at a time (memory is chunk x trades x 8 bytes)
+SEED = 0
+PERCENTILES = [2.5, 5, 25, 50, 75, 95, 97.5]
+METRICS = ['Total Return (%)', 'Sharpe Ratio', 'Max Drawdown', 'Volatility']
+USE_PROCESS_POOL = True #spread the chunks across the cores
+NUM_WORKERS = os.cpu_count()
+
+#trade details of step 4 (csv or parquet), calculated from the trade log of step 3 if the file doesn't exist
+def load_trade_details(file_path=trade_details_file):
+    if os.path.exists(file_path):
+        return pd.read_parquet(file_path) if file_path.endswith('.parquet') else pd.read_csv(file_path)
+
+    trade_details, _ = calculate_trades(load_trade_log())
+    return trade_details
+
+#inputs of the resampling from the trade details (rows in date order, as written by trade_calculations.py)
+#returns (daily returns of every trading day, trade returns on their allocated capital, capital share of each trade slot,
+#day of each trade slot as a position in the daily returns)
+def prepare_returns(trade_details, benchmark=None):
+    dates = trade_details['entry_time'].astype(str).str[:10].to_numpy()
+    profit = trade_details['profit/loss'].to_numpy(dtype='float64')
+    allocated = trade_details['capital_allocated'].to_numpy(dtype='float64')
+
+    day_codes, day_index = np.unique(dates, return_inverse=True)
+    first_trade = np.r_[0, np.flatnonzero(np.diff(day_index)) + 1]
+    day_start_capital = (trade_details['updated_capital'].to_numpy(dtype='float64') - profit)[first_trade]
+    day_end_capital = day_start_capital + np.bincount(day_index, weights=profit, minlength=len(day_codes))
+
+    #zero return days (benchmark days without trades) are kept, as in calculate_metrics
+    equity = pd.Series(day_end_capital, index=pd.Index(pd.to_datetime(day_codes).date, name='date'), name='capital')
+    returns = daily_returns_from_equity(equity, starting_capital, benchmark)
+
+    trade_returns = np.where(allocated > 0, profit / np.where(allocated > 0, allocated, 1), 0.0)
+    slot_weights = allocated / day_start_capital[day_index]
+    slot_days = returns.index.get_indexer(equity.index)[day_index]
+
+    return returns.to_numpy(dtype='float64'), trade_returns, slot_weights, slot_days
+
+#metrics of many return paths at once, returns is a (paths, days) array of daily returns
+def path_metrics(returns, daily_risk_free):
+    curve = np.cumprod(1 + returns, axis=1)
+    peak = np.maximum(np.maximum.accumulate(curve, axis=1), 1.0) #the starting capital is the first peak
+    mean = returns.mean(axis=1)
+    std = returns.std(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = (mean - daily_risk_free) / std * np.sqrt(TRADING_DAYS_PER_YEAR)
+
+    return {
+        'Total Return (%)': (curve[:, -1] - 1) * 100,
+        'Sharpe Ratio': sharpe,
+        'Max Drawdown': np.maximum((1 - curve / peak).max(axis=1), 0.0),
+        'Volatility': std * np.sqrt(TRADING_DAYS_PER_YEAR)
+    }
+
+#daily returns of circular block bootstrap resamples, (size, days)
+def block_bootstrap_paths(rng, returns, size, block_days=BLOCK_DAYS):
+    n_days = len(returns)
+    n_blocks = -(-n_days // block_days)
+    starts = rng.integers(0, n_days, size=(size, n_blocks))
+    positions = (starts[:, :, None] + np.arange(block_days)) % n_days
+
+    return returns[positions.reshape(size, -1)[:, :n_days]]
+
+#daily returns of trade shuffle resamples, (size, days): the trade returns are permuted across the trade slots
+def trade_shuffle_paths(rng, returns, size, trade_returns, slot_weights, slot_days):
+    shuffled = rng.permuted(np.broadcast_to(trade_returns, (size, len(trade_returns))), axis=1)
+    paths = np.zeros((size, len(returns)))
+    day_starts = np.r_[0, np.flatnonzero(np.diff(slot_days)) + 1]
+    paths[:, slot_days[day_starts]] = np.add.reduceat(shuffled * slot_weights, day_starts, axis=1)
+
+    return paths
+
+#metrics of one chunk of resamples of a method (seed is the chunk's SeedSequence)
+def resample_chunk(method, seed, size, inputs, daily_risk_free, block_days=BLOCK_DAYS):
+    with instrumentation.timer('resample_chunk', method=method, size=size):
+        rng = np.random.default_rng(seed)
+        returns, trade_returns, slot_weights, slot_days = inputs
+        if method == 'block_bootstrap':
+            paths = block_bootstrap_paths(rng, returns, size, block_days)
+        elif method == 'trade_shuffle':
+            paths = trade_shuffle_paths(rng, returns, size, trade_returns, slot_weights, slot_days)
+        else:
+            raise ValueError(f"Unknown resample method: {method}")
+
+        return path_metrics(paths, daily_risk_free)
+
+#percentile bands of every metric and method, one row per (method, metric)
+def run_robustness_analysis(trade_details=None, methods=RESAMPLE_METHODS, num_resamples=NUM_RESAMPLES, seed=SEED):
+    if trade_details is None:
+        trade_details = load_trade_details()
+    if trade_details.empty:
+        logger.warning("No trades, nothing to resample")
+        return pd.DataFrame()
+
+    inputs = prepare_returns(trade_details, load_benchmark())
+    daily_risk_free = risk_free_rate / TRADING_DAYS_PER_YEAR
+    observed = {name: values[0] for name, values in path_metrics(inputs[0][None, :], daily_risk_free).items()}
+
+    #chunks of every method with their own random stream, same streams whatever the number of workers
+    sizes = [min(RESAMPLE_CHUNK, num_resamples - start) for start in range(0, num_resamples, RESAMPLE_CHUNK)]
+    tasks = [(method, chunk_seed, size) for method, method_seed in zip(methods, np.random.SeedSequence(seed).spawn(len(methods)))
+             for chunk_seed, size in zip(method_seed.spawn(len(sizes)), sizes)]
+
+    chunks = {method: [] for method in methods}
+    if USE_PROCESS_POOL and NUM_WORKERS and NUM_WORKERS > 1:
+        worker = partial(instrumentation.worker_call, instrumentation.worker_settings(), resample_chunk)
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS) as executor:
+            results = executor.map(worker, *zip(*[(method, chunk_seed, size, inputs, daily_risk_free) for method, chunk_seed, size in tasks]))
+            for (method, _, _), result in zip(tasks, results):
+                chunks[method].append(instrumentation.merge_worker_result(result))
+    else:
+        for method, chunk_seed, size in tasks:
+            chunks[method].append(resample_chunk(method, chunk_seed, size, inputs, daily_risk_free))
+
+    rows = []
+    for method in methods:
+        for metric in METRICS:
+            values = np.concatenate([chunk[metric] for chunk in chunks[method]])
+            values = values[np.isfinite(values)]
+            row = {'method': method, 'metric': metric, 'observed': observed[metric], 'resamples': len(values),
+                   'mean': values.mean() if len(values) else np.nan, 'std': values.std() if len(values) else np.nan}
+            row.update(zip([f'p{q:g}' for q in PERCENTILES], np.percentile(values, PERCENTILES) if len(values) else [np.nan] * len(PERCENTILES)))
+            rows.append(row)
+
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Percentile bands of the backtest metrics from bootstrap and trade shuffle resamples')
+    with instrumentation.stage('step4'):
+        bands = run_robustness_analysis()
+    bands.to_csv(ROBUSTNESS_OUTPUT_FILE, index=False)
+    logger.info(f"{NUM_RESAMPLES} resamples per method, percentile bands saved in {ROBUSTNESS_OUTPUT_FILE}\n{bands.to_string(index=False)}")
+    instrumentation.finish()
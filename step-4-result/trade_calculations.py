@@ -3,159 +3,139 @@
 import pandas as pd  # type: ignore
 import numpy as np # type: ignore
 import os
+import sys
 import pytz # type: ignore
 
+sys.path.append('./step-1-process_historical_data')
+sys.path.append('./step-3-run_strategy')
+import instrumentation # type: ignore
+from performance_metrics import build_trade_table, apply_sizing, load_benchmark, calculate_metrics, BENCHMARK_FILE, BENCHMARK_TICKER # type: ignore
+
 # File paths
-log_file = "logs/trade_log_initial.csv"  #Path to trade log file which will be used for trade calculation
+log_file = "logs/trade_log_initial.csv"  #Path to trade log file which will be used for trade calculation (the .parquet log is read if there is no .csv)
 metrics_output_file = "logs/final_metrics.csv"  #Path to save final results
-trade_details_file = "logs/trade_details.csv" #file for detailed trade logs
+trade_details_file = "logs/trade_details.csv" #file for detailed trade logs (.parquet for a parquet file)
+test_results_file = "step-4-result/test_results.csv" #one row appended per run (for testing - by comparing with previous results)
 
-#delete the previously generated log file (trade_details); final_metrics file replaces its value so no need to delete
-if os.path.exists(trade_details_file):
-    os.remove(trade_details_file)
+logger = instrumentation.get_logger('step4')
 
 # Initialize variables
 starting_capital = 100000
-capital = starting_capital
-risk_free_rate = 0.03  # risk-free rate for sharpe ratio calculation (adjust if needed)
-daily_returns = []  # To track daily returns
-current_date = None
-metrics = {
-    "Alpha": 0,
-    "Beta": 0,
-    "Sharpe Ratio": 0,
-    "Max Drawdown": 0,
-    "Volatility": 0,
-    "Total Return (%)": 0,
-    "Final Capital": 0
-}
-
-# Read the trade log file
-log_df = pd.read_csv(log_file)
-log_df['timestamp'] = pd.to_datetime(log_df['timestamp'], errors='coerce', utc=True)
-
-# Convert UTC timestamps to US/Eastern
-eastern = pytz.timezone('US/Eastern')
-log_df['timestamp'] = log_df['timestamp'].dt.tz_convert(eastern)
-log_df['date'] = log_df['timestamp'].dt.date
-
-# Initialize the trade details file
-if not os.path.exists(trade_details_file):
-    pd.DataFrame(columns=[
-        "ticker", "position_type", "entry_time", "exit_time", "entry_price", "exit_price", "capital_allocated", "shares_traded", 
-        "profit/loss", "% of profit/loss", "updated_capital"
-    ]).to_csv(trade_details_file, index=False)
-
-# Process trades day by day
-for date, daily_data in log_df.groupby('date'):
-    # Get unique tickers for the day
-    unique_tickers = daily_data['ticker'].unique()
-
-    # Capital allocation for the day (equally weighted)
-    capital_per_stock = capital / len(unique_tickers) if len(unique_tickers) > 0 else 0
-
-    # Track day-level returns
-    daily_return = 0
-    for ticker in unique_tickers:
-        ticker_trades = daily_data[daily_data['ticker'] == ticker]
-
-        # Get open and close trades
-        open_trade = ticker_trades[ticker_trades['status'] == 'open']
-        close_trade = ticker_trades[ticker_trades['status'] == 'close']
-
-        if open_trade.empty or close_trade.empty:
-            continue
-
-        # Calculate shares, commission, and borrow fees
-        open_price = open_trade.iloc[0]['price']
-        close_price = close_trade.iloc[0]['price']
-        entry_time = open_trade.iloc[0]['timestamp']
-        exit_time = close_trade.iloc[0]['timestamp']
-        position_type = open_trade.iloc[0]['position_type']
-        shares = capital_per_stock / open_price
-        commission = 0.0035 * shares
-        #since we are not holding the position overnight, there is no borrow fee
-        #borrow_fee = 0.005 * capital_per_stock if position_type == "short" else 0
-
-        # Calculate profit/loss
-        if position_type == "long":
-            trade_profit = ((close_price - open_price) * shares - 2 * commission) # - borrow_fee)
-        else: 
-            trade_profit = ((open_price - close_price) * shares - 2 * commission) # - borrow_fee)
-
-        # Update capital and returns
-        capital += trade_profit
-        daily_return += trade_profit / capital_per_stock
-
-        #% of profit/loss
-        profit_loss_percent = (trade_profit/capital_per_stock) * 100 if capital_per_stock > 0 else 0
-
-        # Append trade details
-        trade_details = {
-            "ticker": ticker,
-            "position_type": position_type,
-            "entry_time": entry_time,
-            "exit_time": exit_time,
-            "entry_price": open_price,
-            "exit_price": close_price,
-            "capital_allocated": capital_per_stock,
-            "shares_traded": shares,
-            "profit/loss": trade_profit,
-            "% of profit/loss": profit_loss_percent,
-            "updated_capital": capital
-        }
-
-        pd.DataFrame([trade_details]).to_csv(trade_details_file, mode='a', header=False, index=False)
-
-    daily_returns.append(daily_return)
-
-# Calculate metrics
-metrics["Final Capital"] = capital
-metrics["Total Return (%)"] = ((capital - starting_capital) / starting_capital) * 100
-metrics["Volatility"] = np.std(daily_returns)
-metrics["Sharpe Ratio"] = (np.mean(daily_returns) - risk_free_rate) / metrics["Volatility"]
-
-# Save metrics to metrics_output_file
-metrics_df = pd.DataFrame([metrics])
-metrics_df.to_csv(metrics_output_file, index=False)
-
-#print the results ######################################################################
-print(f"Final Capital = {round(capital,2)}")
-total_percent_return = round(((capital - starting_capital) / starting_capital) * 100,2)
-print(f"Total % Return =  {total_percent_return}")
-df = pd.read_csv('logs/trade_details.csv') #read the trade details file for return based on position type (long and short)
-result = df.groupby('position_type')['% of profit/loss'].agg(['sum', 'count']).reset_index()
-result.columns = ['position_type', '%_return(not actual, just sum)', 'Num_of_Trades'] #rename the columns for readability 
-print(result)
-
-#extract values from result
-long_return = round(result.loc[result['position_type'] == 'long', '%_return(not actual, just sum)'].values[0],2)
-short_return = round(result.loc[result['position_type'] == 'short', '%_return(not actual, just sum)'].values[0],2)
-long_trades = result.loc[result['position_type'] == 'long', 'Num_of_Trades'].values[0]
-short_trades = result.loc[result['position_type'] == 'short', 'Num_of_Trades'].values[0]
-
-#append the final result to a test_result.csv file (for testing - by comparing with previous results) #######################################################
-import sys
-sys.path.append('./step-3-run_strategy')
-from orb_stat_main import STOP_LOSS_PERCENTAGE, atr_value, PERCENTAGE_CHANGE_BEFORE_ENTRY # type: ignore
-
-test_result_data = {
-    'stop_loss_percent': STOP_LOSS_PERCENTAGE,
-    'atr_value' : atr_value,
-    'entry_%_change (X 100)': PERCENTAGE_CHANGE_BEFORE_ENTRY,
-    'long_%_return': long_return,
-    'total_long_trades': long_trades,
-    'short_%_return': short_return,
-    'total_short_trades': short_trades,
-    'total_%_return': total_percent_return,
-    'final_capital': round(capital,2),
-    'Data_Interval': '5_min'
-}
-
-result_df = pd.DataFrame([test_result_data])
-csv_file = 'step-4-result/test_results.csv'
-
-if not os.path.isfile(csv_file):
-    result_df.to_csv(csv_file, index=False)
-else:
-    result_df.to_csv(csv_file, mode='a', header=False, index=False)
+risk_free_rate = 0.03  # annual risk-free rate for sharpe ratio and alpha calculation (adjust if needed)
+commission_per_share = 0.0035
+
+#read the trade log file of step 3 (csv or parquet), prices are parsed back to the exact float64 values step 3 logged
+def load_trade_log(file_path=log_file):
+    if not os.path.exists(file_path) and os.path.exists(os.path.splitext(file_path)[0] + '.parquet'):
+        file_path = os.path.splitext(file_path)[0] + '.parquet'
+
+    return pd.read_parquet(file_path) if file_path.endswith('.parquet') else pd.read_csv(file_path, float_precision='round_trip')
+
+#trade details of every trade in the log and the equity curve (capital at the end of each day), see performance_metrics.py
+def calculate_trades(log_df):
+    log_df = log_df.copy()
+    log_df['timestamp'] = pd.to_datetime(log_df['timestamp'], errors='coerce', utc=True)
+
+    # Convert UTC timestamps to US/Eastern
+    eastern = pytz.timezone('US/Eastern')
+    log_df['timestamp'] = log_df['timestamp'].dt.tz_convert(eastern)
+    log_df['date'] = log_df['timestamp'].dt.date
+
+    #pair the open and close events of each ticker and day, capital is split equally between the tickers of the day
+    #since we are not holding the position overnight, there is no borrow fee
+    trades = build_trade_table(log_df)
+
+    return apply_sizing(trades, starting_capital, commission_per_share)
+
+#final metrics of an equity curve (capital at the end of each day): calculate_metrics plus total return and final capital
+def final_metrics(equity, benchmark=None):
+    capital = equity.iloc[-1] if len(equity) else starting_capital
+    metrics = calculate_metrics(equity, starting_capital, risk_free_rate, benchmark)
+    metrics["Total Return (%)"] = ((capital - starting_capital) / starting_capital) * 100
+    metrics["Final Capital"] = capital
+
+    return metrics
+
+#save the trade details (csv or parquet by the file extension)
+def save_trade_details(trade_details, file_path=trade_details_file):
+    if file_path.endswith('.parquet'):
+        trade_details.to_parquet(file_path, index=False)
+    else:
+        trade_details.to_csv(file_path, index=False)
+
+#append the final result to a test_result.csv file (for testing - by comparing with previous results)
+#strategy_params: stop_loss_percent, atr_value, entry_%_change (X 100) and check_interval (minutes between stop loss checks) of the run (read from step 3 if None)
+def save_test_result(result, capital, total_percent_return, strategy_params=None):
+    if strategy_params is None:
+        from orb_stat_main import STOP_LOSS_PERCENTAGE, atr_value, PERCENTAGE_CHANGE_BEFORE_ENTRY, STOP_CHECK_INTERVAL # type: ignore
+        strategy_params = {'stop_loss_percent': STOP_LOSS_PERCENTAGE, 'atr_value': atr_value, 'entry_%_change (X 100)': PERCENTAGE_CHANGE_BEFORE_ENTRY,
+                           'check_interval': STOP_CHECK_INTERVAL}
+
+    #extract values from result
+    long_return = round(result.loc[result['position_type'] == 'long', '%_return(not actual, just sum)'].values[0],2)
+    short_return = round(result.loc[result['position_type'] == 'short', '%_return(not actual, just sum)'].values[0],2)
+    long_trades = result.loc[result['position_type'] == 'long', 'Num_of_Trades'].values[0]
+    short_trades = result.loc[result['position_type'] == 'short', 'Num_of_Trades'].values[0]
+
+    test_result_data = {
+        'stop_loss_percent': strategy_params['stop_loss_percent'],
+        'atr_value' : strategy_params['atr_value'],
+        'entry_%_change (X 100)': strategy_params['entry_%_change (X 100)'],
+        'long_%_return': long_return,
+        'total_long_trades': long_trades,
+        'short_%_return': short_return,
+        'total_short_trades': short_trades,
+        'total_%_return': total_percent_return,
+        'final_capital': round(capital,2),
+        'Data_Interval': f"{strategy_params['check_interval']}_min"
+    }
+
+    result_df = pd.DataFrame([test_result_data])
+
+    if not os.path.isfile(test_results_file):
+        result_df.to_csv(test_results_file, index=False)
+    else:
+        result_df.to_csv(test_results_file, mode='a', header=False, index=False)
+
+#calculate the trade details and final metrics of a trade log (the log file of step 3 if log_df is None)
+def run_trade_calculations(log_df=None, strategy_params=None):
+    if log_df is None:
+        log_df = load_trade_log()
+
+    #delete the previously generated log file (trade_details); final_metrics file replaces its value so no need to delete
+    if os.path.exists(trade_details_file):
+        os.remove(trade_details_file)
+
+    with instrumentation.timer('trade_table', trades=len(log_df) // 2):
+        trade_details, equity = calculate_trades(log_df)
+    with instrumentation.timer('log_write', file=trade_details_file):
+        save_trade_details(trade_details)
+    capital = equity.iloc[-1] if len(equity) else starting_capital
+
+    # Calculate metrics (alpha and beta against the daily closes of the benchmark)
+    benchmark = load_benchmark()
+    if benchmark is None:
+        logger.warning(f"No benchmark data ({BENCHMARK_FILE} or the processed file of {BENCHMARK_TICKER}), Alpha and Beta are not calculated")
+    metrics = final_metrics(equity, benchmark)
+
+    # Save metrics to metrics_output_file
+    metrics_df = pd.DataFrame([metrics])
+    metrics_df.to_csv(metrics_output_file, index=False)
+
+    #log the results ######################################################################
+    logger.info(f"Final Capital = {round(capital,2)}")
+    total_percent_return = round(((capital - starting_capital) / starting_capital) * 100,2)
+    logger.info(f"Total % Return =  {total_percent_return}")
+    result = trade_details.groupby('position_type')['% of profit/loss'].agg(['sum', 'count']).reset_index()
+    result.columns = ['position_type', '%_return(not actual, just sum)', 'Num_of_Trades'] #rename the columns for readability
+    logger.info(f"\n{result}")
+
+    save_test_result(result, capital, total_percent_return, strategy_params)
+
+    return metrics
+
+if __name__ == "__main__":
+    instrumentation.setup(description='Calculate the trade details and final metrics of the trade log')
+    with instrumentation.stage('step4'):
+        run_trade_calculations()
+    instrumentation.finish()
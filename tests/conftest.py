@@ -0,0 +1,59 @@
+'''
+Shared fixtures of the tests: a scratch folder with synthetic raw data (benchmarks/generate_synthetic_data.py) processed by
+steps 1 and 2. The tests run from that folder like the scripts run from the main folder, so the real data is never touched
+
+Run them from the main folder: python -m pytest tests
+'''
+
+import os
+import sys
+import pandas as pd # type: ignore
+import pytest # type: ignore
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEP_FOLDERS = ['.', 'step-1-process_historical_data', 'step-2-get_candidate_stocks', 'step-3-run_strategy', 'step-4-result', 'benchmarks']
+for folder in STEP_FOLDERS:
+    sys.path.insert(0, os.path.join(REPO_ROOT, folder)) #spawned worker processes get the same sys.path
+
+NUM_TICKERS = 24
+NUM_DAYS = 50 #sessions from 2022-11-01, the screen of step 2 starts on 2022-11-30
+
+@pytest.fixture(scope='session')
+def workspace(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('workspace')
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        os.makedirs('step-2-get_candidate_stocks')
+        os.makedirs('step-4-result')
+
+        from generate_synthetic_data import generate_synthetic_data # type: ignore
+        generate_synthetic_data(num_tickers=NUM_TICKERS, num_days=NUM_DAYS)
+
+        import process_historical_data # type: ignore
+        process_historical_data.preprocess_historical_data()
+
+        import get_candidate_stocks # type: ignore
+        from orb_stat_main import TOP_STOCKS_FILE # type: ignore
+        get_candidate_stocks.find_top_stocks(get_candidate_stocks.data_folder).to_csv(TOP_STOCKS_FILE, index=False)
+        yield folder
+    finally:
+        os.chdir(cwd)
+
+#run the backtest of step 3 with module constants overridden, returns the bytes of the trade log
+def run_step3(monkeypatch, **constants):
+    import orb_stat_main # type: ignore
+    for name, value in constants.items():
+        monkeypatch.setattr(orb_stat_main, name, value)
+    monkeypatch.setattr(orb_stat_main, 'TRADE_LEDGER', orb_stat_main.TradeLedger(f'logs/{orb_stat_main.LOG_FILE}', columns=orb_stat_main.LOG_COLUMNS))
+    orb_stat_main.run_backtest()
+    with open(f'logs/{orb_stat_main.LOG_FILE}', 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def step3(workspace, monkeypatch):
+    return lambda **constants: run_step3(monkeypatch, **constants)
+
+def read_log(content):
+    import io
+    return pd.read_csv(io.BytesIO(content), float_precision='round_trip')
@@ -0,0 +1,27 @@
+'''
+Screen of step 2 from the Arrow data plane against the screen from the processed files
+'''
+
+import pandas as pd # type: ignore
+
+def test_screen_from_arrow_data_plane(workspace, monkeypatch, tmp_path):
+    import get_candidate_stocks # type: ignore
+    from arrow_data_plane import build_arrow_data_plane, open_arrow_data_plane # type: ignore
+    from process_historical_data import processed_data_versions # type: ignore
+    file_path = str(tmp_path / 'arrow_data_plane.arrow')
+    build_arrow_data_plane(file_path=file_path, versions=processed_data_versions())
+    monkeypatch.setattr(get_candidate_stocks, 'open_arrow_data_plane', lambda: open_arrow_data_plane(file_path))
+    monkeypatch.setattr(get_candidate_stocks, 'USE_OPENING_RANGE_TABLE', False)
+
+    assert get_candidate_stocks.current_arrow_data_plane() is not None
+    from_plane = get_candidate_stocks.find_top_stocks(get_candidate_stocks.data_folder)
+    monkeypatch.setattr(get_candidate_stocks, 'USE_ARROW_DATA_PLANE', False)
+    monkeypatch.setattr(get_candidate_stocks, 'USE_MARKET_DATA_STORE', False)
+    from_files = get_candidate_stocks.find_top_stocks(get_candidate_stocks.data_folder)
+    assert len(from_files) > 0
+    pd.testing.assert_frame_equal(from_plane, from_files)
+
+    #a plane older than the processed data isn't read
+    monkeypatch.setattr(get_candidate_stocks, 'USE_ARROW_DATA_PLANE', True)
+    monkeypatch.setattr(get_candidate_stocks, 'processed_data_versions', lambda: {})
+    assert get_candidate_stocks.current_arrow_data_plane() is None
@@ -0,0 +1,75 @@
+'''
+Indicators of step 1 in batch, bar by bar and checkpoint-resumed modes against the pandas calculate_indicators of the
+original step 1 (on the float32 prices of the raw files, float32 results)
+'''
+
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pytest # type: ignore
+from indicator_engine import window_sums, save_checkpoint, load_checkpoint # type: ignore
+from process_historical_data import indicator_engine, RAW_DTYPES, INDICATOR_COLUMNS # type: ignore
+
+#the original calculate_indicators of step 1
+def calculate_indicators(df):
+    df['high_low'] = df['high'] - df['low']
+    df['high_close'] = np.abs(df['high'] - df['close'].shift())
+    df['low_close'] = np.abs(df['low'] - df['close'].shift())
+    df['true_range'] = df[['high_low', 'high_close', 'low_close']].max(axis=1)
+    df['ATR_14'] = df['true_range'].rolling(window=14).mean()
+    df['Avg_Volume_14d'] = df['volume'].rolling(window=14*390).mean()
+    df['Relative_Volume'] = df['volume'] / df['Avg_Volume_14d']
+
+    return df
+
+@pytest.fixture(scope='module')
+def bars():
+    from generate_synthetic_data import generate_ticker, trading_sessions # type: ignore
+    raw = generate_ticker(3, trading_sessions(num_days=20))
+    raw = raw.set_index(raw['timestamp'].dt.tz_convert('US/Eastern')).between_time('09:30', '16:00')
+    return pd.DataFrame({name: raw[name].astype(dtype) for name, dtype in RAW_DTYPES.items()}).assign(volume=lambda df: df['volume'].astype('int64'))
+
+@pytest.fixture(scope='module')
+def reference(bars):
+    values = calculate_indicators(bars.astype({name: 'float64' for name in ['open', 'high', 'low', 'close']}))
+    return {column: values[column].to_numpy('float32') for column in INDICATOR_COLUMNS}
+
+def assert_same(values, reference):
+    for column in INDICATOR_COLUMNS:
+        np.testing.assert_array_equal(np.asarray(values[column], dtype='float32'), reference[column], err_msg=column)
+    assert np.isfinite(reference['Avg_Volume_14d']).any()
+
+def test_batch(bars, reference):
+    assert_same(indicator_engine().compute(bars), reference)
+
+def test_chunks(bars, reference):
+    engine = indicator_engine()
+    chunks = [engine.compute(bars.iloc[start:stop]) for start, stop in zip([0, 1, 7, 13, 1000, 6000], [1, 7, 13, 1000, 6000, len(bars)])]
+    assert_same({column: np.concatenate([chunk[column] for chunk in chunks]) for column in INDICATOR_COLUMNS}, reference)
+
+def test_bar_by_bar(bars, reference):
+    engine = indicator_engine()
+    values = {column: [] for column in INDICATOR_COLUMNS}
+    for bar in bars.to_dict('records'):
+        engine.update(bar)
+        for column, value in engine.values().items():
+            values[column].append(value)
+    assert_same(values, reference)
+
+def test_checkpoint_resumed(bars, reference, tmp_path):
+    split = len(bars) // 2 + 3
+    engine = indicator_engine()
+    first = engine.compute(bars.iloc[:split])
+    save_checkpoint(tmp_path / 'checkpoint.npz', engine, last_timestamp=bars.index[split - 1])
+
+    resumed = indicator_engine()
+    checkpoint, metadata = load_checkpoint(tmp_path / 'checkpoint.npz')
+    resumed.restore(checkpoint)
+    assert metadata['last_timestamp'] == str(bars.index[split - 1])
+    second = resumed.compute(bars.iloc[split:])
+    assert_same({column: np.concatenate([first[column], second[column]]) for column in INDICATOR_COLUMNS}, reference)
+
+def test_window_sums():
+    values = np.random.default_rng(0).integers(0, 1000, 103).astype('float64') / 64
+    for window in [1, 2, 5, 14, 103]:
+        expected = [values[i:i + window].sum() for i in range(len(values) - window + 1)]
+        np.testing.assert_array_equal(window_sums(values, window), expected)
@@ -0,0 +1,73 @@
+'''
+Trade log of step 3 against a reference port of the original row by row (iterrows) strategy: same trades, times and prices
+'''
+
+import numpy as np # type: ignore
+import pandas as pd # type: ignore
+import pytest # type: ignore
+from conftest import read_log # type: ignore
+
+#the original strategy of a day: opening range decision, entry scan and 5-minute stop scan over the rows of the ticker's bars
+def reference_trading_day(date, orb_stat_main):
+    from trading_calendar import get_calendar # type: ignore
+    calendar = get_calendar()
+    eastern = 'US/Eastern'
+    entries = []
+    for ticker in orb_stat_main.get_tickers_for_date(date):
+        data = pd.read_parquet(f'{orb_stat_main.PROCESSED_DATA_FOLDER}/{ticker}.parquet')
+        opening = data.loc[pd.Timestamp(f"{date} 09:30:00").tz_localize(eastern):pd.Timestamp(f"{date} 09:35:00").tz_localize(eastern)]
+        positive_movement = sum(opening['close'] > opening['open'])
+        position = 'long' if positive_movement >= 5 else 'short' if positive_movement <= 1 else None
+        if position is None:
+            continue
+
+        start_time = pd.Timestamp(f"{date} 09:35:00").tz_localize(eastern)
+        end_time = calendar.minute_to_timestamp(date, calendar.session_end_minute(date)) #15:55, 12:55 on half days
+        entry_data = data[(data.index >= start_time) & (data.index <= end_time)]
+        if entry_data.empty:
+            continue
+        entry_price_init = entry_data['close'].iloc[0]
+
+        entry_time = entry_price = None
+        for timestamp, row in entry_data.iterrows():
+            current_price = row['close']
+            change = entry_price_init * orb_stat_main.PERCENTAGE_CHANGE_BEFORE_ENTRY
+            if (position == 'long' and current_price <= entry_price_init - change) or (position == 'short' and current_price >= entry_price_init + change):
+                entry_time, entry_price = timestamp, current_price
+                break
+        if entry_time is None:
+            continue
+
+        stop_percent = orb_stat_main.STOP_LOSS_PERCENTAGE * orb_stat_main.atr_value
+        stop_loss = entry_price - entry_price * stop_percent if position == 'long' else entry_price + entry_price * stop_percent
+        exit_data = data[(data.index > entry_time) & (data.index <= end_time)].reset_index()
+        exit_time = exit_price = None
+        for timestamp, row in exit_data.resample('5min', on='timestamp').agg({'close': 'last'}).dropna().iterrows():
+            current_price = row['close']
+            if (position == 'long' and current_price < stop_loss) or (position == 'short' and current_price > stop_loss):
+                exit_time, exit_price = timestamp, current_price
+                break
+        if exit_time is None:
+            if end_time not in data.index:
+                continue #no bar to close at, the trade is skipped
+            exit_time, exit_price = end_time, data.loc[end_time, 'close']
+
+        entries.append(('open', ticker, float(entry_price), entry_time, position))
+        entries.append(('close', ticker, float(exit_price), exit_time, position))
+    return entries
+
+def reference_trade_log(orb_stat_main):
+    dates = [date.strftime('%Y-%m-%d') for date in orb_stat_main.get_unique_dates(orb_stat_main.TOP_STOCKS_FILE)]
+    entries = [entry for date in dates for entry in reference_trading_day(date, orb_stat_main)]
+    return pd.DataFrame(entries, columns=orb_stat_main.LOG_COLUMNS)
+
+@pytest.mark.parametrize('stop_loss_percentage', [0.05, 0.02])
+def test_trade_log_matches_iterrows_reference(step3, stop_loss_percentage):
+    import orb_stat_main # type: ignore
+    log = read_log(step3(STOP_LOSS_PERCENTAGE=stop_loss_percentage, USE_PROCESS_POOL=False))
+    reference = reference_trade_log(orb_stat_main)
+
+    assert len(reference) > 0 and (reference['status'] == 'close').any()
+    assert log[['status', 'ticker', 'position_type']].equals(reference[['status', 'ticker', 'position_type']])
+    assert (pd.to_datetime(log['timestamp'], utc=True) == pd.to_datetime(reference['timestamp'], utc=True)).all()
+    np.testing.assert_array_equal(log['price'].to_numpy(), reference['price'].to_numpy())
@@ -0,0 +1,12 @@
+'''
+Trade log of the process pool against the serial run: shards of days merged in date order give the same file, byte for byte
+'''
+
+import pytest # type: ignore
+
+@pytest.mark.parametrize('start_method', ['fork', 'spawn'])
+def test_pool_log_is_byte_identical_to_serial(step3, start_method):
+    serial = step3(USE_PROCESS_POOL=False)
+    pooled = step3(USE_PROCESS_POOL=True, NUM_WORKERS=3, DAYS_PER_SHARD=4, POOL_START_METHOD=start_method)
+    assert serial.count(b'\n') > 1
+    assert pooled == serial
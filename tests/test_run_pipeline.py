@@ -0,0 +1,18 @@
+'''
+Row of a cached step 4 put back in the shared test results file
+'''
+
+from run_pipeline import append_cached_row # type: ignore
+
+def test_cached_row_is_appended_once(tmp_path):
+    cached, results = tmp_path / 'cached.csv', tmp_path / 'test_results.csv'
+    cached.write_text('a,b\n1,2\n')
+
+    append_cached_row(cached, results)
+    assert results.read_text() == 'a,b\n1,2\n'
+    append_cached_row(cached, results) #fully cached rerun
+    assert results.read_text() == 'a,b\n1,2\n'
+
+    results.write_text('a,b\n3,4\n')
+    append_cached_row(cached, results)
+    assert results.read_text() == 'a,b\n3,4\n1,2\n'
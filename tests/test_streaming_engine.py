@@ -0,0 +1,48 @@
+'''
+Bars of the socket source: US/Eastern date and minute offset of every bar from the trading calendar
+'''
+
+import socket
+import threading
+import pandas as pd # type: ignore
+from streaming_engine import parse_bar_line, socket_source # type: ignore
+
+def bar_line(ticker, eastern_time, close=10.0):
+    epoch = pd.Timestamp(eastern_time, tz='US/Eastern').value // 10**9
+    return f"{ticker},{epoch},{close},{close},{close},{close},100\n"
+
+def test_bars_after_an_after_hours_bar_keep_their_session():
+    lines = [bar_line('AAA', '2023-03-09 15:59'), bar_line('AAA', '2023-03-09 19:30'), bar_line('AAA', '2023-03-10 09:31'),
+             bar_line('AAA', '2023-03-13 09:30')] #2023-03-12 is the DST change
+    bars = [parse_bar_line(line) for line in lines]
+    assert bars[0][1:3] == ('2023-03-09', 389)
+    assert bars[1] is None
+    assert bars[2][1:3] == ('2023-03-10', 1)
+    assert bars[3][1:3] == ('2023-03-13', 0)
+
+def test_bars_outside_the_session_are_ignored():
+    assert parse_bar_line(bar_line('AAA', '2023-03-10 09:29')) is None #pre-market
+    assert parse_bar_line(bar_line('AAA', '2023-03-10 16:01')) is None #after-hours
+    assert parse_bar_line(bar_line('AAA', '2023-03-11 10:00')) is None #Saturday
+    assert parse_bar_line(bar_line('AAA', '2023-03-10 16:00'))[1:3] == ('2023-03-10', 390)
+
+def test_socket_source():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    lines = [bar_line('AAA', '2023-03-09 19:30'), bar_line('AAA', '2023-03-10 09:30', 10.1), bar_line('BBB', '2023-03-10 09:30', 20.2)]
+
+    def send():
+        for _ in range(100):
+            try:
+                with socket.create_connection(('127.0.0.1', port)) as connection:
+                    connection.sendall(''.join(lines).encode())
+                return
+            except ConnectionRefusedError:
+                threading.Event().wait(0.05)
+    sender = threading.Thread(target=send)
+    sender.start()
+    bars = list(socket_source('127.0.0.1', port))
+    sender.join()
+
+    assert [bar[:4] for bar in bars] == [('AAA', '2023-03-10', 0, 10.100000381469727), ('BBB', '2023-03-10', 0, 20.200000762939453)]
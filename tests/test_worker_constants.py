@@ -0,0 +1,32 @@
+'''
+Constants set in the main process (e.g. by run_pipeline.py) reach the worker processes of steps 1 and 3 under spawn too
+'''
+
+import os
+import pandas as pd # type: ignore
+
+def test_step3_override_under_spawn(step3):
+    default = step3(USE_PROCESS_POOL=False)
+    serial = step3(USE_PROCESS_POOL=False, STOP_LOSS_PERCENTAGE=0.02)
+    pooled = step3(USE_PROCESS_POOL=True, NUM_WORKERS=2, DAYS_PER_SHARD=5, POOL_START_METHOD='spawn', STOP_LOSS_PERCENTAGE=0.02)
+    assert serial != default
+    assert pooled == serial
+
+def run_step1(monkeypatch, folder, **constants):
+    import process_historical_data # type: ignore
+    from generate_synthetic_data import generate_synthetic_data # type: ignore
+    os.makedirs(folder)
+    monkeypatch.chdir(folder)
+    generate_synthetic_data(num_tickers=3, num_days=5)
+    constants = dict({'BUILD_OPENING_RANGE_TABLE': False, 'BUILD_MARKET_DATA_STORE': False, 'BUILD_BAR_CUBE': False, 'BUILD_ARROW_DATA_PLANE': False}, **constants)
+    for name, value in constants.items():
+        monkeypatch.setattr(process_historical_data, name, value)
+    process_historical_data.preprocess_historical_data()
+    return pd.concat([pd.read_parquet(f'processed_data_new/SYN000{number}.parquet') for number in range(3)])
+
+def test_step1_override_under_spawn(monkeypatch, tmp_path):
+    default = run_step1(monkeypatch, tmp_path / 'default', USE_PROCESS_POOL=False)
+    serial = run_step1(monkeypatch, tmp_path / 'serial', USE_PROCESS_POOL=False, ATR_WINDOW=5, HISTORY_BARS=14*390)
+    pooled = run_step1(monkeypatch, tmp_path / 'pooled', USE_PROCESS_POOL=True, NUM_WORKERS=2, POOL_START_METHOD='spawn', ATR_WINDOW=5, HISTORY_BARS=14*390)
+    assert not serial['ATR_14'].equals(default['ATR_14'])
+    pd.testing.assert_frame_equal(pooled, serial)